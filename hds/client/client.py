@@ -1,13 +1,20 @@
+import asyncio
 import logging
 import base64
 import base58
+import copy
+import re
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
 from aiohttp import ClientSession, ClientResponse
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, ed25519
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import padding
 from canonicaljson import encode_canonical_json
-from ..util import HDSFailure, HDSBadKeyFailure, verify_payload
+from ..util import HDSFailure, HDSBadKeyFailure, verify_payloads, server_id
+from ..util.encoding import CBOR_CONTENT_TYPE, dumps_cbor, loads_cbor
 
 load_pem_private_key = serialization.load_pem_private_key
 
@@ -15,6 +22,8 @@ logger = logging.getLogger(__name__)
 
 ONE_DAY = 60 * 60 * 24
 SSL_ENABLED = False
+TOPIC_PAGE_SIZE = 100
+RESPONSE_CACHE_SIZE = 256
 
 
 class DirectoryClient:
@@ -31,14 +40,68 @@ class DirectoryClient:
         if res.get("hds.error", False):
             raise HDSFailure(res["hds.error.text"], res["hds.error"])
 
+    @staticmethod
+    async def read_body(res: ClientResponse):
+        if res.content_type == CBOR_CONTENT_TYPE:
+            return loads_cbor(await res.read())
+        return await res.json()
+
+    def request_args(self, payload=None):
+        """
+        The body and headers to give a request, in the encoding chosen by use_cbor.
+        """
+        if not self.use_cbor:
+            return {} if payload is None else {"json": payload}
+        args = {"headers": {"Accept": CBOR_CONTENT_TYPE}}
+        if payload is not None:
+            args["headers"]["Content-Type"] = CBOR_CONTENT_TYPE
+            args["data"] = dumps_cbor(payload)
+        return args
+
+    async def __get_cached(self, session, url):
+        """
+        GET a body, from the response cache if it is still fresh there.
+        """
+        args = self.request_args()
+        cached = self.response_cache.get(url) if self.response_cache is not None else None
+        if cached is not None:
+            self.response_cache.move_to_end(url)
+            if cached[1] > time.monotonic():
+                return copy.deepcopy(cached[2])
+            args.setdefault("headers", {})["If-None-Match"] = cached[0]
+        res: ClientResponse = await session.get(url=url, ssl=SSL_ENABLED, **args)
+        body = cached[2] if res.status == 304 and cached is not None else await self.read_body(res)
+        if self.response_cache is None:
+            return body
+        etag = res.headers.get("ETag")
+        if etag is not None and res.status in (200, 304):
+            max_age = re.search(r"max-age=(\d+)", res.headers.get("Cache-Control", ""))
+            fresh_for = int(max_age.group(1)) if max_age is not None else 0
+            self.response_cache[url] = (etag, time.monotonic() + fresh_for, body)
+            self.response_cache.move_to_end(url)
+            while len(self.response_cache) > RESPONSE_CACHE_SIZE:
+                self.response_cache.popitem(last=False)
+        return copy.deepcopy(body)
+
     @staticmethod
     def format_baseurl(url):
         return (url if url.startswith("http") else "https://" + url) + "/_hds"
 
     def __init__(self, base_url: str = None, private_key_path=None,
                  private_key_data=None,
-                 password=None, paranoid_mode=True):
+                 password=None, paranoid_mode=True, crypto_pool=None, cache_verified=True,
+                 use_cbor=False, cache_responses=False):
         self.paranoid_mode = paranoid_mode
+        # Whether to send payloads and ask for responses in CBOR rather than JSON
+        self.use_cbor = use_cbor
+        # url => (ETag, monotonic time it is fresh until, body) of the host state and topic
+        # responses, if they are to be cached. Stale entries are revalidated with If-None-Match.
+        self.response_cache = OrderedDict() if cache_responses else None
+        # A thread CryptoPool to sign and verify payloads on, see sign_payload_async and
+        # verify_payloads. None does both inline.
+        self.crypto_pool = crypto_pool
+        # Whether to skip verifying payloads that have verified before
+        self.cache_verified = cache_verified
         self.base_url = base_url
         if private_key_path is not None:
             with open(private_key_path, "rb") as f:
@@ -49,13 +112,13 @@ class DirectoryClient:
             return
 
         try:
-            self.key: rsa.RSAPrivateKey = load_pem_private_key(
+            self.key = load_pem_private_key(
                 private_key_data,
                 password=password,
                 backend=default_backend()
             )
-            if not isinstance(self.key, rsa.RSAPrivateKey):
-                raise TypeError("Private key is wrong type, expected public key")
+            if not isinstance(self.key, (rsa.RSAPrivateKey, ed25519.Ed25519PrivateKey)):
+                raise TypeError("Private key is wrong type, expected a RSA or Ed25519 key")
         except Exception as ex:
             raise HDSBadKeyFailure("Failed to read key", inner_ex=ex)
 
@@ -69,6 +132,13 @@ class DirectoryClient:
             raise HDSBadKeyFailure("Client was not initialised with a key")
         return self.pub_key
 
+    def get_server_id(self):
+        """
+        :return: The short server ID of the client's key, which directories accept in place of
+                 the full server name once they know the server
+        """
+        return server_id(self.get_pubkey())
+
     def sign_payload(self, payload):
         if self.pub_key is None:
             raise HDSBadKeyFailure("Client was not initialised with a key, cannot sign payload")
@@ -76,45 +146,78 @@ class DirectoryClient:
             raise HDSFailure(
                 "No keys were given in the payload, cannot sign payload.",
                 "hds.payload.empty")
-        signature = self.key.sign(
-            encode_canonical_json(payload),
-            padding.PSS(
-                mgf=padding.MGF1(hashes.SHA512()),
-                salt_length=padding.PSS.MAX_LENGTH
-            ),
-            hashes.SHA512()
-        )
+        if isinstance(self.key, ed25519.Ed25519PrivateKey):
+            signature = self.key.sign(encode_canonical_json(payload))
+        else:
+            signature = self.key.sign(
+                encode_canonical_json(payload),
+                padding.PSS(
+                    mgf=padding.MGF1(hashes.SHA512()),
+                    salt_length=padding.PSS.MAX_LENGTH
+                ),
+                hashes.SHA512()
+            )
         payload["hds.signature"] = base64.b64encode(signature).decode()
         logger.debug("sign_payload %s", str(payload))
         return payload
 
-    async def send_state(self, key, value, ttl=ONE_DAY, baseurl=None):
+    async def sign_payload_async(self, payload):
+        """
+        As sign_payload, but run on the client's crypto_pool. The private key cannot be sent to
+        another process, so the pool must be a thread pool.
+        """
+        if self.crypto_pool is None:
+            return self.sign_payload(payload)
+        return await self.crypto_pool.run(self.sign_payload, payload)
+
+    async def verify_payloads(self, servername, bodies):
+        """
+        Verify payloads signed by one server. The server's key is parsed once, and on the
+        client's crypto_pool the payloads are split into one job per worker, verified in parallel.
+
+        :param servername: The server name
+        :param bodies: A list of signed payloads
+        :raises HDSFailure: If any fails to verify
+        """
+        if self.crypto_pool is None:
+            verify_payloads(servername, bodies, self.cache_verified)
+            return
+        chunks = [bodies[i::self.crypto_pool.workers] for i in range(self.crypto_pool.workers)]
+        await asyncio.gather(*[
+            self.crypto_pool.run(verify_payloads, servername, chunk, self.cache_verified)
+            for chunk in chunks if len(chunk) > 0
+        ])
+
+    async def sign_state_async(self, key, value, ttl=ONE_DAY):
         if ttl < 10:
             raise ValueError("TTL was < 10")
-        payload = self.sign_payload({"hds.ttl": ttl, key: value})
+        return await self.sign_payload_async({"hds.ttl": ttl, key: value})
+
+    async def send_state(self, key, value, ttl=ONE_DAY, baseurl=None):
+        payload = await self.sign_state_async(key, value, ttl)
         await self.send_state_payload(key, payload, self.pub_key, baseurl)
 
     async def send_state_payload(self, key, payload, pub_key, baseurl=None):
         baseurl = DirectoryClient.format_baseurl(baseurl if baseurl is not None else self.base_url)
         async with self.__get_session() as session:
             url = "{}/hosts/{}/state/{}".format(baseurl, pub_key, key)
-            res = await session.put(url=url, json=payload, ssl=SSL_ENABLED)
+            res = await session.put(url=url, ssl=SSL_ENABLED, **self.request_args(payload))
             if res.status == 201:
                 return
-            DirectoryClient.check_error(await res.json())
+            DirectoryClient.check_error(await self.read_body(res))
 
     async def put_topic(self, topic, subtopics=[], baseurl=None):
-        payload = self.sign_payload({topic: subtopics})
+        payload = await self.sign_payload_async({topic: subtopics})
         await self.put_topic_payload(topic, payload, self.pub_key, baseurl)
 
     async def put_topic_payload(self, topic, payload, pub_key, baseurl=None):
         baseurl = DirectoryClient.format_baseurl(baseurl if baseurl is not None else self.base_url)
         async with self.__get_session() as session:
             url = "{}/hosts/{}/topic/{}".format(baseurl, pub_key, topic)
-            res = await session.put(url=url, json=payload, ssl=SSL_ENABLED)
+            res = await session.put(url=url, ssl=SSL_ENABLED, **self.request_args(payload))
             if res.status == 201:
                 return
-            DirectoryClient.check_error(await res.json())
+            DirectoryClient.check_error(await self.read_body(res))
 
     async def get_topic(self, topic: str, subtopics=[], baseurl=None):
         baseurl = DirectoryClient.format_baseurl(baseurl if baseurl is not None else self.base_url)
@@ -124,8 +227,8 @@ class DirectoryClient:
             url = "{}/topics/{}".format(baseurl, topic)
             if len(subtopics) > 0:
                 url += "/" + "/".join(subtopics)
-            res = await session.get(url=url, ssl=False)
-            j = await res.json()
+            res = await session.get(url=url, ssl=False, **self.request_args())
+            j = await self.read_body(res)
             DirectoryClient.check_error(j)
             return j
 
@@ -135,8 +238,8 @@ class DirectoryClient:
             raise ValueError("Topic should be a non-empty string")
         async with self.__get_session() as session:
             url = "{}/hosts/{}/topic/{}".format(baseurl, server, topic)
-            res = await session.get(url=url, ssl=False)
-            j = await res.json()
+            res = await session.get(url=url, ssl=False, **self.request_args())
+            j = await self.read_body(res)
             print(j)
             DirectoryClient.check_error(j)
             return j
@@ -146,19 +249,84 @@ class DirectoryClient:
         baseurl = DirectoryClient.format_baseurl(baseurl if baseurl is not None else self.base_url)
         async with self.__get_session() as session:
             url = "{}/topics".format(baseurl)
-            res = await session.get(url=url, ssl=False)
-            j = await res.json()
+            j = await self.__get_cached(session, url)
+            DirectoryClient.check_error(j)
+            return j["topics"]
+
+    async def find_topics(self, pattern, hosts=False, baseurl=None):
+        """
+        Find topics matching a pattern. "*" matches within one "." separated segment, and "**"
+        matches anything, so "uk.half-shot.*" finds "uk.half-shot.weather".
+
+        :param pattern: The topic pattern string
+        :param hosts: Whether to fetch the hosts of each topic too
+        :return: A list of topics, or a dict of topic => hosts if hosts is True
+        """
+        baseurl = DirectoryClient.format_baseurl(baseurl if baseurl is not None else self.base_url)
+        query = {"match": pattern}
+        if hosts:
+            query["hosts"] = "true"
+        async with self.__get_session() as session:
+            url = "{}/topics?{}".format(baseurl, urlencode(query))
+            res = await session.get(url=url, ssl=False, **self.request_args())
+            j = await self.read_body(res)
             DirectoryClient.check_error(j)
             return j["topics"]
 
+    async def iter_topics(self, pattern=None, hosts=False, page_size=TOPIC_PAGE_SIZE,
+                          baseurl=None):
+        """
+        Iterate over every topic, or those matching a pattern, a page at a time.
+
+        :param pattern: A topic pattern string, see find_topics. Optional
+        :param hosts: Whether to fetch the hosts of each topic too
+        :param page_size: How many topics to fetch per request
+        :return: An async iterator of topics, or of (topic, hosts) tuples if hosts is True
+        """
+        query = {"limit": page_size}
+        if pattern is not None:
+            query["match"] = pattern
+        if hosts:
+            query["hosts"] = "true"
+        async for topics in self.__iter_pages("topics", query, baseurl):
+            for topic in topics["topics"]:
+                yield (topic, topics["topics"][topic]) if hosts else topic
+
+    async def iter_topic(self, topic: str, subtopics=[], page_size=TOPIC_PAGE_SIZE,
+                         baseurl=None):
+        """
+        Iterate over the hosts of a topic, a page at a time. With subtopics, a host may be
+        yielded more than once with further matching subtopics.
+
+        :return: An async iterator of (host, {"hds.signature", "subtopics"}) tuples
+        """
+        if type(topic) is not str or len(topic) < 1:
+            raise ValueError("Topic should be a non-empty string")
+        path = "topics/" + "/".join([topic] + list(subtopics))
+        async for hosts in self.__iter_pages(path, {"limit": page_size}, baseurl):
+            for host in hosts["hosts"]:
+                yield host, hosts["hosts"][host]
+
+    async def __iter_pages(self, path, query, baseurl=None):
+        baseurl = DirectoryClient.format_baseurl(baseurl if baseurl is not None else self.base_url)
+        async with self.__get_session() as session:
+            while True:
+                url = "{}/{}?{}".format(baseurl, path, urlencode(query))
+                res = await session.get(url=url, ssl=False, **self.request_args())
+                j = await self.read_body(res)
+                DirectoryClient.check_error(j)
+                yield j
+                if j.get("next_cursor") is None:
+                    return
+                query["cursor"] = j["next_cursor"]
+
     async def get_state(self, servername: str, baseurl=None, raw=False):
         short_name = servername[:16]
         baseurl = DirectoryClient.format_baseurl(baseurl if baseurl is not None else self.base_url)
         async with self.__get_session() as session:
             url = "{}/hosts/{}".format(baseurl, servername)
-            res: ClientResponse = await session.get(url=url, ssl=SSL_ENABLED)
-            DirectoryClient.check_error(await res.json())
-            body: dict = await res.json()
+            body: dict = await self.__get_cached(session, url)
+            DirectoryClient.check_error(body)
             if raw:
                 return body
             expired = body.pop("hds.expired", [])
@@ -167,6 +335,7 @@ class DirectoryClient:
                     logging.warning("key %s has expired" % key)
                     body.pop(key)
             state = {}
+            signed = []
             logging.debug("Verifying keys from %s", short_name)
             for key in body.keys():
                 item = body.get(key)
@@ -174,12 +343,13 @@ class DirectoryClient:
                 if sig is None:
                     logging.warning("%s has no signature", key)
                     continue
-                verify_payload(b58_server_key=servername, body={
+                signed.append({
                     key: item.get("value"),
                     "hds.signature": item.get("hds.signature"),
                     "hds.ttl": item.get("hds.ttl"),
                 })
                 state[key] = item.get("value")
+            await self.verify_payloads(servername, signed)
             return state
 
     async def identify(self, baseurl=None):
@@ -187,7 +357,7 @@ class DirectoryClient:
             baseurl if baseurl is not None else self.base_url)
         async with self.__get_session() as session:
             url = "{}/identify".format(baseurl)
-            res: ClientResponse = await session.get(url=url, ssl=SSL_ENABLED)
-            j = await res.json()
+            res: ClientResponse = await session.get(url=url, ssl=SSL_ENABLED, **self.request_args())
+            j = await self.read_body(res)
             DirectoryClient.check_error(j)
             return j
@@ -1,9 +1,25 @@
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, ed25519
 from cryptography.hazmat.primitives import serialization
 
+ALGORITHMS = ("rsa", "ed25519")
 
-def generate_key():
+
+def generate_key(algorithm="rsa"):
+    """
+    Generate a new private key for a server.
+
+    :param algorithm: "rsa", or "ed25519" for much faster signing and a much shorter server name
+    :return: The private key as PEM bytes
+    """
+    if algorithm == "ed25519":
+        return ed25519.Ed25519PrivateKey.generate().private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+    if algorithm != "rsa":
+        raise ValueError("Unknown key algorithm '%s'" % algorithm)
     private_key = rsa.generate_private_key(
         public_exponent=65537,
         key_size=2048,
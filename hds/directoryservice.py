@@ -4,9 +4,14 @@ import ssl
 import logging
 import base64
 import asyncio
-from .store import RedisStore
+import json
+from .store import AsyncRedisStore, AsyncShardedRedisStore, MemoryStore
+from .store.lrucache import LRUCache
+from .store.redis_store import (REAP_BATCH_SIZE, TOPIC_QUERY_LIMIT, HOST_PAGE_SIZE, curr_time,
+                                host_state_expires_at)
 from .hosts import HostHandler
-from .util import HDSFailure
+from .util import HDSFailure, CryptoPool, server_id, is_server_id
+from .util.encoding import JSON_CONTENT_TYPE, CBOR_CONTENT_TYPE, dumps_cbor, loads_cbor
 # from .webinterface import WebInterface
 
 from aiohttp import web
@@ -28,6 +33,15 @@ STATE_HOST = os.environ.get("HDS_HOST", "localhost")
 REGISTER_HOSTS = os.environ.get("HDS_REGISTER_HOSTS", "").split(",")
 
 PORT = int(os.environ.get("HDS_HTTP_PORT", "27012"))
+REAP_INTERVAL = int(os.environ.get("HDS_REAP_INTERVAL_SEC", "60"))
+# "redis", "sharded-redis" to spread hosts over REDIS_SHARDS, or "memory" to keep everything in
+# the process. HDS_STORE_PATH persists the latter.
+STORE = os.environ.get("HDS_STORE", "redis")
+STORE_PATH = os.environ.get("HDS_STORE_PATH")
+CACHE_SIZE = int(os.environ.get("HDS_CACHE_SIZE", "1024"))
+CACHE_TTL = int(os.environ.get("HDS_CACHE_TTL_MS", "5000"))
+# Sent as Accept to have listings streamed, one JSON document per line
+NDJSON = "application/x-ndjson"
 
 logger = logging.getLogger(__name__)
 
@@ -38,12 +52,26 @@ class DirectoryService():
         response.headers["Server"] = "HostDiscoveryService/0.0.1"
 
     def __init__(self):
-        self.store = RedisStore()
+        if STORE == "memory":
+            self.store = MemoryStore(path=STORE_PATH)
+        elif STORE == "redis":
+            self.store = AsyncRedisStore(
+                cache=LRUCache(CACHE_SIZE, CACHE_TTL) if CACHE_SIZE > 0 else None
+            )
+        elif STORE == "sharded-redis":
+            self.store = AsyncShardedRedisStore(
+                cache=LRUCache(CACHE_SIZE, CACHE_TTL) if CACHE_SIZE > 0 else None
+            )
+        else:
+            raise Exception("Unknown HDS_STORE '%s', cannot run" % STORE)
+        # Configured by HDS_CRYPTO_POOL, HDS_CRYPTO_WORKERS and HDS_CRYPTO_MAX_PENDING
+        self.crypto_pool = CryptoPool()
         if PRIVKEY_PATH is not None:
-            self.hosthandler = HostHandler(self.store, key_path=PRIVKEY_PATH, password=PASSWORD)
+            self.hosthandler = HostHandler(self.store, key_path=PRIVKEY_PATH, password=PASSWORD,
+                                           crypto_pool=self.crypto_pool)
         elif PRIVKEY_DATA is not None:
             self.hosthandler = HostHandler(self.store, key_data=base64.b64decode(PRIVKEY_DATA),
-                                           password=PASSWORD)
+                                           password=PASSWORD, crypto_pool=self.crypto_pool)
         else:
             raise Exception("Private key not provided, cannot run")
         # self.webinterface = WebInterface(self.store, self.hosthandler)
@@ -79,6 +107,12 @@ class DirectoryService():
 
     async def start(self):
         logger.info("Started directory service")
+        await self.store.migrate()
+        invalidator = asyncio.ensure_future(self.store.listen_for_invalidations())
+        if isinstance(self.store, AsyncShardedRedisStore):
+            # Picks up any shards added since the last start. Hosts are not found on their new
+            # shards until this has finished, so it must finish before any requests are served.
+            await self.store.rebalance()
 
         if path.exists(CERTPATH) and path.exists(KEYPATH):
             logger.debug("Cert: %s", CERTPATH)
@@ -91,38 +125,38 @@ class DirectoryService():
             logger.warn("Certpath or keypath not given or invalid, not using SSL")
             sslcontext = None
         my_name = self.hosthandler.fedClient.get_pubkey()
-        self.hosthandler.put_state(
+        await self.hosthandler.put_state(
             my_name,
             "hds.host",
-            self.hosthandler.fedClient.sign_payload({
+            await self.hosthandler.fedClient.sign_payload_async({
                 "hds.ttl": 60 * 60 * 24 * 3,
                 "hds.host": STATE_HOST,
             })
         )
 
-        self.hosthandler.put_state(
+        await self.hosthandler.put_state(
             my_name,
             "hds.name",
-            self.hosthandler.fedClient.sign_payload({
+            await self.hosthandler.fedClient.sign_payload_async({
                 "hds.ttl": 60 * 60 * 24 * 3,
                 "hds.name": NAME,
             })
         )
 
         if CONTACT_NAME:
-            self.hosthandler.put_state(
+            await self.hosthandler.put_state(
                 my_name,
                 "hds.contact.name",
-                self.hosthandler.fedClient.sign_payload({
+                await self.hosthandler.fedClient.sign_payload_async({
                     "hds.ttl": 60 * 60 * 24 * 3,
                     "hds.contact.name": CONTACT_NAME,
                 })
             )
         if CONTACT_EMAIL:
-            self.hosthandler.put_state(
+            await self.hosthandler.put_state(
                 my_name,
                 "hds.contact.email",
-                self.hosthandler.fedClient.sign_payload({
+                await self.hosthandler.fedClient.sign_payload_async({
                     "hds.ttl": 60 * 60 * 24 * 3,
                     "hds.contact.email": CONTACT_EMAIL,
                 })
@@ -138,6 +172,8 @@ class DirectoryService():
             await self.hosthandler.federation_register_with(host)
         logger.info("Registered with all hosts")
 
+        reaper = asyncio.ensure_future(self.reap_expired_hosts())
+
         runner = web.AppRunner(self.app)
         await runner.setup()
         site = web.TCPSite(runner, HOST, PORT, ssl_context=sslcontext)
@@ -145,17 +181,97 @@ class DirectoryService():
         while True:
             await asyncio.sleep(1000)
         # wait for finish signal
+        reaper.cancel()
+        invalidator.cancel()
         await runner.cleanup()
+        await self.store.close()
+        self.crypto_pool.shutdown()
+
+    async def reap_expired_hosts(self):
+        while True:
+            try:
+                # Keep going while there are full batches to purge
+                while len(await self.store.reap_expired_hosts()) == REAP_BATCH_SIZE:
+                    pass
+            except Exception as e:
+                logger.warning("Failed to reap expired hosts: %s", e)
+            await asyncio.sleep(REAP_INTERVAL)
 
     async def get_version(self, request: web.Request):
-        return web.json_response({
+        return self.respond(request, {
             "hds.servername": self.hosthandler.fedClient.get_pubkey(),
+            "hds.server_id": server_id(self.hosthandler.fedClient.get_pubkey()),
             "hds.type": "hds.directory"
         })
 
+    @staticmethod
+    def accepts(request: web.Request, content_type):
+        """
+        Whether the Accept header names content_type with a quality no lower than JSON's.
+        JSON's quality is that of its most specific match, so wildcards count for it.
+        """
+        qualities = {}
+        for media_range in request.headers.get("Accept", "").split(","):
+            media_type, *params = media_range.split(";")
+            q = 1.0
+            for param in params:
+                name, _, value = param.partition("=")
+                if name.strip() == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        pass
+            qualities[media_type.strip().lower()] = q
+        wanted = qualities.get(content_type, 0)
+        for json_range in (JSON_CONTENT_TYPE, "application/*", "*/*"):
+            if json_range in qualities:
+                return wanted > 0 and wanted >= qualities[json_range]
+        return wanted > 0
+
+    @classmethod
+    def wants_cbor(cls, request: web.Request):
+        return cls.accepts(request, CBOR_CONTENT_TYPE)
+
+    @classmethod
+    def respond(cls, request: web.Request, data, status=200, headers=None):
+        """
+        Respond with a body in CBOR if the request accepts it, or JSON otherwise.
+        """
+        if cls.wants_cbor(request):
+            return web.Response(body=dumps_cbor(data), status=status, headers=headers,
+                                content_type=CBOR_CONTENT_TYPE)
+        return web.json_response(data, status=status, headers=headers)
+
+    @staticmethod
+    def cache_headers(etag, max_age=None):
+        """
+        Headers for a response that may be cached for max_age seconds, or revalidated with the
+        ETag every time if None. ETags are weak, as the JSON and CBOR bodies share them.
+        """
+        return {
+            "ETag": etag,
+            "Cache-Control": "max-age=%i" % max_age if max_age is not None else "no-cache",
+            "Vary": "Accept",
+        }
+
+    @staticmethod
+    def etag_matches(request: web.Request, etag):
+        """
+        Whether the request's If-None-Match has the ETag.
+        """
+        def opaque(tag):
+            return tag[2:] if tag.startswith("W/") else tag
+        tags = [opaque(t.strip()) for t in request.headers.get("If-None-Match", "").split(",")]
+        return "*" in tags or opaque(etag) in tags
+
     async def get_body(self, request: web.Request):
-        if request.content_type == "application/json":
+        if request.content_type == JSON_CONTENT_TYPE:
             return await request.json()
+        elif request.content_type == CBOR_CONTENT_TYPE:
+            try:
+                return loads_cbor(await request.read())
+            except ValueError as e:
+                raise HDSFailure(str(e), type="hds.error.body.invalid")
         elif request.content_type is None:
             raise HDSFailure(
                 "No Content-Type specified",
@@ -167,70 +283,239 @@ class DirectoryService():
                 type="hds.error.headers.unsupported"
             )
 
-    async def put_state(self, request: web.Request):
+    @staticmethod
+    def failure_status(e: HDSFailure):
+        if e.type == "hds.error.hosts.none":
+            return 404
+        # A full crypto pool is not the client's fault
+        return 503 if e.type == "hds.error.busy" else 400
+
+    async def get_server(self, request: web.Request):
+        """
+        Get the server name of a request, which may have given the server ID instead.
+        """
         server = request.match_info.get("server")
+        if is_server_id(server):
+            return await self.store.find_host(server)
+        return server
+
+    async def put_state(self, request: web.Request):
         key = request.match_info.get("key")
         try:
+            server = await self.get_server(request)
             body = await self.get_body(request)
-            self.hosthandler.put_state(server, key, body)
+            await self.hosthandler.put_state(server, key, body)
         except HDSFailure as e:
-            return web.json_response({
+            return self.respond(request, {
                 "hds.error.text": str(e),
                 "hds.error": e.type,
-            }, status=400)
+            }, status=self.failure_status(e))
         return web.Response(status=201)
 
     async def get_state(self, request: web.Request):
         server = request.match_info.get("server")
         state = None
+        version = None
         try:
-            state = self.store.get_host_state(server)
+            state, version = await self.store.get_versioned_host_state(server)
             if state is None:
                 state = await self.hosthandler.find_via_federation(server)
         except HDSFailure as e:
-            return web.json_response({
+            return self.respond(request, {
                 "hds.error.text": str(e),
                 "hds.error": e.type,
             }, status=400)
         if state is None:
-            return web.json_response({
+            return self.respond(request, {
                 "hds.error.text": "Host could not be found",
                 "hds.error": "hds.error.host.missing",
             }, status=404)
-        return web.json_response(
-            state
-        )
+        if version is None:
+            return self.respond(request, state)
+        # The version doesn't change as keys expire, but keys only ever become expired, so the
+        # number of them tells the states of one version apart
+        etag = 'W/"%i.%i"' % (version, len(state["hds.expired"]))
+        expires_at = host_state_expires_at(state)
+        headers = self.cache_headers(
+            etag, max(0, (expires_at - curr_time()) // 1000) if expires_at is not None else 0)
+        if self.etag_matches(request, etag):
+            return web.Response(status=304, headers=headers)
+        return self.respond(request, state, headers=headers)
+
+    @staticmethod
+    def get_page(request: web.Request, default_limit, max_limit):
+        """
+        Read the ?limit= and ?cursor= of a paginated listing.
 
-    async def get_topics(self, _):
-        topics = self.store.get_topics()
-        return web.json_response({
+        :return: A tuple of the page size, the cursor or None, and whether a page was asked for
+        """
+        cursor = request.query.get("cursor")
+        limit = request.query.get("limit")
+        if limit is None:
+            return default_limit, cursor, cursor is not None
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit < 1 or limit > max_limit:
+            raise HDSFailure(
+                "limit must be between 1 and %i" % max_limit,
+                type="hds.error.topic.bad_query"
+            )
+        return limit, cursor, True
+
+    @classmethod
+    def wants_stream(cls, request: web.Request):
+        return cls.accepts(request, NDJSON)
+
+    @staticmethod
+    async def stream_response(request: web.Request, pages):
+        """
+        Stream every item of an async iterator of pages of items, as NDJSON.
+        """
+        response = web.StreamResponse(headers={"Content-Type": NDJSON})
+        await response.prepare(request)
+        async for page in pages:
+            await response.write(
+                "".join(json.dumps(item) + "\n" for item in page).encode()
+            )
+        await response.write_eof()
+        return response
+
+    async def get_topics(self, request: web.Request):
+        # ?match= takes a topic pattern, like uk.half-shot.*, and ?prefix= a literal prefix
+        pattern = request.query.get("match")
+        prefix = request.query.get("prefix")
+        if prefix is not None:
+            if "*" in prefix:
+                return self.respond(request, {
+                    "hds.error.text": "prefix cannot contain wildcards, use match",
+                    "hds.error": "hds.error.topic.bad_query",
+                }, status=400)
+            pattern = prefix + "**"
+        try:
+            limit, cursor, paged = self.get_page(request, TOPIC_QUERY_LIMIT, TOPIC_QUERY_LIMIT)
+        except HDSFailure as e:
+            return self.respond(request, {
+                "hds.error.text": str(e),
+                "hds.error": e.type,
+            }, status=400)
+        with_hosts = request.query.get("hosts") in ("1", "true")
+        headers = None
+        if not with_hosts and not self.wants_stream(request):
+            # Topics are only ever added, so a listing can be revalidated by the version alone.
+            # Hosts come and go as they expire, so listings with hosts are not.
+            headers = self.cache_headers('W/"%i"' % await self.store.get_topics_version())
+            if self.etag_matches(request, headers["ETag"]):
+                return web.Response(status=304, headers=headers)
+
+        async def topic_page(cursor):
+            # A page of topics that is not full is the last one
+            topics = await self.store.find_topics(pattern or "**", limit, after=cursor)
+            next_cursor = topics[-1] if len(topics) == limit else None
+            if with_hosts:
+                hosts = await asyncio.gather(*[self.store.get_topic_hosts(t) for t in topics])
+                topics = dict(zip(topics, hosts))
+            return topics, next_cursor
+
+        if self.wants_stream(request):
+            async def items(cursor):
+                while True:
+                    topics, cursor = await topic_page(cursor)
+                    if with_hosts:
+                        yield [{"topic": t, "hosts": h} for t, h in topics.items()]
+                    else:
+                        yield [{"topic": t} for t in topics]
+                    if cursor is None:
+                        return
+            return await self.stream_response(request, items(cursor))
+        if paged:
+            topics, next_cursor = await topic_page(cursor)
+            return self.respond(request, {
+                "topics": topics,
+                "next_cursor": next_cursor,
+            }, headers=headers)
+        if pattern is not None:
+            # find_topics stops at TOPIC_QUERY_LIMIT, so walk its pages to match the unfiltered
+            # listing, which has no limit
+            topics = []
+            while True:
+                page = await self.store.find_topics(
+                    pattern, TOPIC_QUERY_LIMIT, after=topics[-1] if len(topics) > 0 else None)
+                topics.extend(page)
+                if len(page) < TOPIC_QUERY_LIMIT:
+                    break
+        else:
+            topics = await self.store.get_topics()
+        if with_hosts:
+            hosts = await asyncio.gather(*[self.store.get_topic_hosts(t) for t in topics])
+            topics = dict(zip(topics, hosts))
+        return self.respond(request, {
             "topics": topics,
-        })
+        }, headers=headers)
 
     async def get_topic(self, request: web.Request):
-        hosts = self.store.get_topic_hosts(
-            request.match_info.get("topic"),
-            request.match_info.get("subtopics")
-        )
+        topic = request.match_info.get("topic")
+        subtopics = request.match_info.get("subtopics")
+        try:
+            limit, cursor, paged = self.get_page(request, HOST_PAGE_SIZE, TOPIC_QUERY_LIMIT)
+        except HDSFailure as e:
+            return self.respond(request, {
+                "hds.error.text": str(e),
+                "hds.error": e.type,
+            }, status=400)
+        stream = self.wants_stream(request)
+        try:
+            # The first page is fetched before streaming, so a bad cursor can still be a 400
+            if stream or paged:
+                hosts, next_cursor = await self.store.get_topic_hosts_page(
+                    topic, subtopics, cursor, limit)
+            else:
+                hosts = await self.store.get_topic_hosts(topic, subtopics)
+        except HDSFailure as e:
+            return self.respond(request, {
+                "hds.error.text": str(e),
+                "hds.error": e.type,
+            }, status=400)
+        if stream:
+            async def items(hosts, cursor):
+                while True:
+                    yield [dict(host=host, **entry) for host, entry in hosts.items()]
+                    if cursor is None:
+                        return
+                    hosts, cursor = await self.store.get_topic_hosts_page(
+                        topic, subtopics, cursor, limit)
+            return await self.stream_response(request, items(hosts, next_cursor))
+        if paged:
+            return self.respond(request, {
+                "hosts": hosts,
+                "next_cursor": next_cursor,
+            })
         if hosts is None:
-            return web.json_response({
+            return self.respond(request, {
                 "hds.error.text": "Topic could not be found",
                 "hds.error": "hds.error.topic.missing",
             }, status=404)
-        return web.json_response({
+        return self.respond(request, {
             "hosts": hosts,
         })
 
     async def put_topic(self, request: web.Request):
-        server = request.match_info.get("server")
-        state = self.store.get_host_state(server)
+        try:
+            server = await self.get_server(request)
+        except HDSFailure as e:
+            return self.respond(request, {
+                "hds.error.text": str(e),
+                "hds.error": e.type,
+            }, status=self.failure_status(e))
+        state = await self.store.get_host_state(server)
         if state is None:
-            return web.json_response({
+            return self.respond(request, {
                 "hds.error.text": "Host could not be found",
                 "hds.error": "hds.error.host.missing",
             }, status=404)
         if "hds.host" in state["hds.expired"]:
-            return web.json_response({
+            return self.respond(request, {
                 "hds.error.text": "hds.host has expired",
                 "hds.error": "hds.error.host.expired",
             }, status=400)
@@ -239,20 +524,20 @@ class DirectoryService():
             body = await self.get_body(request)
             await self.hosthandler.put_topic(server, topic, body)
         except HDSFailure as e:
-            return web.json_response({
+            return self.respond(request, {
                 "hds.error.text": str(e),
                 "hds.error": e.type,
-            }, status=400)
+            }, status=self.failure_status(e))
         return web.Response(status=201)
 
     async def post_register(self, request: web.Request):
         body = await self.get_body(request)
         try:
-            self.hosthandler.federation_register_with(
+            await self.hosthandler.federation_register_with(
                 body.get("host")
             )
         except HDSFailure as e:
-            return web.json_response({
+            return self.respond(request, {
                 "hds.error.text": str(e),
                 "hds.error": e.type,
             }, status=400)
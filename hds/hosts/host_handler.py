@@ -11,14 +11,22 @@ MAX_VALUE_SIZE = 1024 * 64
 
 
 class HostHandler():
-    def __init__(self, store, key_path=None, key_data=None, password=None):
+    def __init__(self, store, key_path=None, key_data=None, password=None, crypto_pool=None):
         self.store = store
+        # Verifies payloads off the event loop. None verifies inline.
+        self.crypto_pool = crypto_pool
+        # Only threads can sign with our key
+        sign_pool = None
+        if crypto_pool is not None and crypto_pool.kind == "thread":
+            sign_pool = crypto_pool
         try:
             if key_path is not None:
                 key_path = path.realpath(path.join(path.curdir, key_path))
-                self.fedClient = DirectoryClient(private_key_path=key_path, password=password)
+                self.fedClient = DirectoryClient(private_key_path=key_path, password=password,
+                                                 crypto_pool=sign_pool)
             elif key_data is not None:
-                self.fedClient = DirectoryClient(private_key_data=key_data, password=password)
+                self.fedClient = DirectoryClient(private_key_data=key_data, password=password,
+                                                 crypto_pool=sign_pool)
             else:
                 raise FileNotFoundError("No key file provided")
         except FileNotFoundError as e:
@@ -29,6 +37,14 @@ class HostHandler():
     def __parseStatePayload(self, body, contentType):
         pass
 
+    async def __verify_payload(self, b58_server_key, body):
+        if self.crypto_pool is None:
+            verify_payload(b58_server_key, body)
+            return
+        # A process pool verifies a copy, so remove the signature as verify_payload would
+        await self.crypto_pool.run(verify_payload, b58_server_key, body)
+        body.pop("hds.signature", None)
+
     def __validate_host(self, b64serverKey, host):
         # Determine whether the given host is the same as the requestor by sending it a
         # random string and expecting a response back with the same signature.
@@ -36,26 +52,26 @@ class HostHandler():
         logger.warning("__validate_host: Skipping validation!")
         return True
 
-    def find_via_federation(self, b58_server_key):
+    async def find_via_federation(self, b58_server_key):
         if self.fedClient is None:
             raise HDSFailure("Federation on this host is disabled",
                              type="hds.error.federation.disabled")
         # Get hosts like us, ensure paranoid mode is set to avoid hijacks.
-        hosts = self.store.get_topic_hosts("hds.directory")
+        hosts = await self.store.get_topic_hosts("hds.directory")
         if hosts is None:
             raise HDSFailure("No hds.directory hosts have been registered",
                              type="hds.error.federation.no_hosts")
         for srvkey in hosts.keys():
-            logger.info("Asking %s.. for information on %s.." % srvkey[:16], b58_server_key[:16])
+            logger.info("Asking %s.. for information on %s..", srvkey[:16], b58_server_key[:16])
             # state = self.fedClient.get_state(b58_server_key, state["hds.host"])
             # TODO: Finish this.
 
     async def federate_topic(self, b58_server_key, topic, body):
-        dir_hosts = self.store.get_topic_hosts("hds.directory")
-        topic_owner_state = self.store.get_host_state(b58_server_key)
-        for host in dir_hosts:
+        dir_hosts = await self.store.get_topic_hosts("hds.directory")
+        topic_owner_state = await self.store.get_host_state(b58_server_key)
+        dir_states = await self.store.get_host_states(list(dir_hosts.keys()))
+        for host, state in dir_states.items():
             logger.info("Federating new topic to %s", host)
-            state = self.store.get_host_state(host)
             if "hds.type" in state["hds.expired"] or "hds.host" in state["hds.expired"]\
                     or "hds.directory.url" not in state:
                 logger.warn("hds.type or hds.host has expired for host, not federating")
@@ -98,15 +114,19 @@ class HostHandler():
         subtopics = body.get(topic, [])
         if not isinstance(subtopics, list):
             raise HDSFailure("subtopics is the wrong type", type="hds.error.payload.bad_type")
+        for subtopic in subtopics:
+            # NUL separates the subtopic from the host in the store's subtopic index
+            if not isinstance(subtopic, str) or "\0" in subtopic:
+                raise HDSFailure("subtopics must be strings", type="hds.error.payload.bad_type")
         sig = body["hds.signature"]
-        verify_payload(b58_server_key, body)
+        await self.__verify_payload(b58_server_key, body)
         logger.info("[%s] Request verified, storing topic", log_id)
-        self.store.store_host_topic(server=b58_server_key, topic=topic,
-                                    subtopics=subtopics, signature=sig)
+        await self.store.store_host_topic(server=b58_server_key, topic=topic,
+                                          subtopics=subtopics, signature=sig)
         body["hds.signature"] = sig
         await self.federate_topic(b58_server_key, topic, body)
 
-    def put_state(self, b58_server_key: str, key, body):
+    async def put_state(self, b58_server_key: str, key, body):
         log_id = b58_server_key[:12]
         logger.info("[%s] Request to set %s = %s ", log_id, key, body.get(key)[:32])
         if len(key) > MAX_KEY_SIZE:
@@ -143,11 +163,11 @@ class HostHandler():
             )
 
         sig = body["hds.signature"]
-        verify_payload(b58_server_key, body)
+        await self.__verify_payload(b58_server_key, body)
 
         # # Check to see if the host exists or has expired.
         try:
-            host = self.store.get_host_state(b58_server_key)
+            host = await self.store.get_host_state(b58_server_key)
         except HDSFailure:
             host = None
         # TODO: What about hds.status
@@ -165,7 +185,7 @@ class HostHandler():
 
         logger.info("[%s] Request verified, storing state", log_id)
 
-        self.store.store_host_state(
+        await self.store.store_host_state(
             server=b58_server_key, key=key, value=body.get(key), ttl=ttl, signature=sig
         )
         # TODO: Figure out how we alert the federation to changes
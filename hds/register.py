@@ -7,6 +7,7 @@ from os import environ
 from time import sleep
 from os.path import exists
 from .client import DirectoryClient, generate_key
+from .client.gen_key import ALGORITHMS
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -31,7 +32,7 @@ async def main(args):
         else:
             logger.info("Generating new key...")
             Path(args.key).parent.mkdir(parents=True, exist_ok=True)
-            key = generate_key()
+            key = generate_key(args.algorithm)
             with open(args.key, "w") as f:
                 f.write(key.decode())
             logger.info("Key written to %s", args.key)
@@ -57,20 +58,33 @@ async def main(args):
         else:
             state[state_name] = ""
     state_host = state.pop("hds.host", None)
+    pub_key = client.get_pubkey()
+    # The values never change, so sign them once. Every pass then resends the same payloads,
+    # which the service recognises without verifying the signatures again.
+    if state_host is not None:
+        host_payload = await client.sign_state_async("hds.host", state_host, args.ttl)
+    state_payloads = {
+        state_name: await client.sign_state_async(state_name, state_value, args.ttl)
+        for state_name, state_value in state.items()
+    }
+    topic_payloads = {
+        topic_name: await client.sign_payload_async({topic_name: topic_value})
+        for topic_name, topic_value in topics.items()
+    }
     run = True
     while run:
         tasks = []
         logger.info("Sending state and topics...")
         if state_host is not None:
             logger.info("Sending host %s" % (state_host))
-            await client.send_state("hds.host", state_host, args.ttl)
+            await client.send_state_payload("hds.host", host_payload, pub_key)
             logger.debug("Sent host")
         for state_name, state_value in state.items():
             logger.info("Sending state %s = %s" % (state_name, state_value))
-            tasks.append(client.send_state(state_name, state_value, args.ttl))
+            tasks.append(client.send_state_payload(state_name, state_payloads[state_name], pub_key))
         for topic_name, topic_value in topics.items():
             logger.info("Sending topic %s = %s" % (topic_name, topic_value))
-            tasks.append(client.put_topic(topic_name, topic_value))
+            tasks.append(client.put_topic_payload(topic_name, topic_payloads[topic_name], pub_key))
         if len(tasks) > 0:
             await asyncio.wait(tasks)
         logger.info("Done...")
@@ -107,6 +121,9 @@ if __name__ == "__main__":
     parser.add_argument('-g', '--generate-keys', dest='generate_keys', action='store_true',
                         default=False,
                         help='Generate a public private key pair')
+    parser.add_argument('-a', '--algorithm', dest='algorithm', action='store', default="rsa",
+                        choices=ALGORITHMS,
+                        help='Algorithm of the generated key. ed25519 keys are faster and shorter')
     parser.add_argument('-k', '--key', dest='key', action='store', type=str,
                         default=DEFAULT_KEY_LOCATION,
                         help='Path where the private key is stored')
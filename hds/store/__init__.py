@@ -1,4 +1,8 @@
 from .store import Store
 from .redis_store import RedisStore
+from .async_redis_store import AsyncRedisStore
+from .memory_store import MemoryStore
+from .sharded_redis_store import ShardedRedisStore, AsyncShardedRedisStore
 
-__all__ = [Store, RedisStore]
+__all__ = [Store, RedisStore, AsyncRedisStore, MemoryStore, ShardedRedisStore,
+           AsyncShardedRedisStore]
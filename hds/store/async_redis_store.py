@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+import redis
+import redis.asyncio
+
+from .redis_store import (BaseRedisStore, HOST, PORT, PASSWORD, REPLICAS, REAP_GRACE_MS,
+                          REAP_BATCH_SIZE, TOPIC_QUERY_LIMIT, HOST_PAGE_SIZE, K_INVALIDATE,
+                          parse_redis_address)
+
+MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", "32"))
+# How long to wait for a free connection before failing, in seconds.
+CONNECTION_TIMEOUT = float(os.environ.get("REDIS_CONNECTION_TIMEOUT", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRedisStore(BaseRedisStore):
+    """
+    An asyncio version of RedisStore, for use inside the event loop. It has the same methods
+    and keyspace as RedisStore, but each method is a coroutine.
+
+    Connections are drawn from a bounded pool, so a burst of requests will wait for a free
+    connection rather than opening an unlimited number of them.
+
+    If a cache or replicas are given, listen_for_invalidations must be running to keep them
+    coherent with writes made by other processes.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, cache=None, replicas=REPLICAS):
+        logger.info("Starting new async redis store instance")
+        self._scripts = {}
+        self.cache = cache
+        self.r = self._connect(HOST, PORT, max_connections)
+        self.replicas = [
+            self._connect(host, port, max_connections)
+            for host, port in map(parse_redis_address, replicas)
+        ]
+        self._next_replica = 0
+        self._recent_writes = OrderedDict()
+        logger.info("Connecting to %s (max %i connections, %i replicas)",
+                    HOST, max_connections, len(self.replicas))
+
+    def _connect(self, host, port, max_connections):
+        return redis.asyncio.Redis(connection_pool=redis.asyncio.BlockingConnectionPool(
+            host=host,
+            port=port,
+            password=PASSWORD,
+            max_connections=max_connections,
+            timeout=CONNECTION_TIMEOUT,
+        ))
+
+    async def _run(self, op):
+        try:
+            pipe = next(op)
+            while True:
+                pipe = op.send(await pipe.execute())
+        except StopIteration as ex:
+            return ex.value
+
+    async def close(self):
+        await self.r.aclose()
+        for replica in self.replicas:
+            await replica.aclose()
+
+    async def listen_for_invalidations(self, on_subscribed=None):
+        """
+        Evict cache entries as they are written to by any process sharing this redis, and read
+        those hosts and topics from the primary for a while. Runs until cancelled. The whole cache
+        is dropped if the subscription is lost, as messages may have been missed.
+
+        :param on_subscribed: Optional callback, called each time the subscription is made
+        """
+        if self.cache is None and len(self.replicas) == 0:
+            return
+        while True:
+            pubsub = self.r.pubsub()
+            try:
+                await pubsub.subscribe(K_INVALIDATE)
+                self._invalidate("")
+                if on_subscribed is not None:
+                    on_subscribed()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self._invalidate(message["data"].decode())
+                        self._mark_written(message["data"].decode())
+            except redis.RedisError as e:
+                logger.warning("Lost cache invalidation subscription, retrying: %s", e)
+                self._invalidate("")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def get_topics(self):
+        """
+        See RedisStore.get_topics
+        """
+        return await self._run(self._op_get_topics())
+
+    async def find_topics(self, pattern, limit=TOPIC_QUERY_LIMIT, after=None):
+        """
+        See RedisStore.find_topics
+        """
+        return await self._run(self._op_find_topics(pattern, limit, after))
+
+    async def get_topic_hosts(self, topic, subtopics=None):
+        """
+        See RedisStore.get_topic_hosts
+        """
+        return await self._run(self._op_get_topic_hosts(topic, subtopics))
+
+    async def get_topic_hosts_page(self, topic, subtopics=None, cursor=None,
+                                   count=HOST_PAGE_SIZE):
+        """
+        See RedisStore.get_topic_hosts_page
+        """
+        return await self._run(self._op_get_topic_hosts_page(topic, subtopics, cursor, count))
+
+    async def store_host_topic(self, server, topic: str, subtopics: list, signature):
+        """
+        See RedisStore.store_host_topic
+        """
+        return await self._run(self._op_store_host_topic(server, topic, subtopics, signature))
+
+    async def get_host_state(self, server):
+        """
+        See RedisStore.get_host_state
+        """
+        return await self._run(self._op_get_host_state(server))
+
+    async def get_versioned_host_state(self, server):
+        """
+        See RedisStore.get_versioned_host_state
+        """
+        return await self._run(self._op_get_versioned_host_state(server))
+
+    async def get_topics_version(self):
+        """
+        See RedisStore.get_topics_version
+        """
+        return await self._run(self._op_get_topics_version())
+
+    async def get_host_states(self, servers):
+        """
+        See RedisStore.get_host_states
+        """
+        return await self._run(self._op_get_host_states(servers))
+
+    async def has_host_expired(self, server):
+        """
+        See RedisStore.has_host_expired
+        """
+        return await self._run(self._op_has_host_expired(server))
+
+    async def find_host(self, server):
+        """
+        See RedisStore.find_host
+        """
+        return await self._run(self._op_find_host(server))
+
+    async def store_host_state(self, server, key, value, ttl, signature, last_updated=None):
+        """
+        See RedisStore.store_host_state
+        """
+        return await self._run(self._op_store_host_state(
+            server, key, value, ttl, signature, last_updated))
+
+    async def is_host_tombstoned(self, server, throw=True):
+        return await self._run(self._op_is_host_tombstoned(server, throw))
+
+    async def reap_expired_hosts(self, grace=REAP_GRACE_MS, limit=REAP_BATCH_SIZE):
+        """
+        See RedisStore.reap_expired_hosts
+        """
+        return await self._run(self._op_reap_expired_hosts(grace, limit))
+
+    async def migrate(self):
+        """
+        See RedisStore.migrate
+        """
+        return await self._run(self._op_migrate())
@@ -0,0 +1,69 @@
+import time
+from collections import OrderedDict
+
+
+class LRUCache():
+    """
+    A bounded in-process cache. Once max_size entries are held, the least recently used entry is
+    dropped, and every entry also expires ttl milliseconds after it was set.
+    """
+
+    def __init__(self, max_size=1024, ttl=5000):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, count=True):
+        """
+        Get a value from the cache.
+
+        :param key: The cache key
+        :param count: Whether to count the lookup as a hit or miss
+        :return: The value, or None if the key isn't cached or has expired
+        """
+        entry = self.__entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            del self.__entries[key]
+            entry = None
+        if entry is None:
+            if count:
+                self.misses += 1
+            return None
+        self.__entries.move_to_end(key)
+        if count:
+            self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value in the cache.
+
+        :param key: The cache key
+        :param value: The value to store. Must not be None
+        :param ttl: How long to keep the value for, in milliseconds. Defaults to the cache's ttl
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        self.__entries[key] = (time.monotonic() + ttl / 1000, value)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.max_size:
+            self.__entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.__entries.pop(key, None)
+
+    def invalidate_prefix(self, prefix):
+        for key in [k for k in self.__entries.keys() if k.startswith(prefix)]:
+            del self.__entries[key]
+
+    def clear(self):
+        self.__entries.clear()
@@ -0,0 +1,403 @@
+import base64
+import json
+import logging
+import os
+from itertools import islice
+from sortedcontainers import SortedDict, SortedList
+
+from .redis_store import (curr_time, raise_tombstoned, raise_bad_cursor, state_value_expired,
+                          state_value_expires_at, subtopic_path, compile_topic_pattern,
+                          STATE_STORAGE_LIMIT, REAP_GRACE_MS, REAP_BATCH_SIZE, TOPIC_QUERY_LIMIT,
+                          HOST_PAGE_SIZE)
+from ..util import HDSFailure, server_id, is_server_id
+
+# Write a new snapshot, and truncate the log, after this many logged writes.
+SNAPSHOT_EVERY = 10000
+
+logger = logging.getLogger(__name__)
+
+# This store keeps everything in the process, for single node and embedded deployments, and
+# for tests. It has the same coroutines as AsyncRedisStore, and the same indexes as the redis
+# layout:
+#
+# topics => dict topic => SortedDict host => {"hds.signature", "subtopics"}
+# topic_index => SortedList topic, for prefix searches in find_topics
+# subtopics => dict topic => SortedList (subtopic, host)
+# host_topics => dict host => set topic
+# state => dict host => dict key => state entry, as found in get_host_state
+# hosts => SortedList host, for prefix searches in find_host
+# server_ids => dict server ID => host, see server_id
+# expiry => SortedList (expires_at, host) of each host's hds.host
+# updated => dict host => SortedList (last_updated, key). Excludes hds.host
+# versions => dict host => version, see RedisStore.get_versioned_host_state
+# topics_version => version of the topic list, see RedisStore.get_topics_version
+#
+# Versions start at the current time, so they are not reused after a restart or reap.
+#
+# If given a path, writes are appended to {path}.log and replayed on startup. The log is
+# periodically folded into a {path}.snapshot.
+
+
+class MemoryStore():
+    def __init__(self, path=None, snapshot_every=SNAPSHOT_EVERY):
+        logger.info("Starting new memory store instance")
+        self.topics = {}
+        self.topic_index = SortedList()
+        self.subtopics = {}
+        self.host_topics = {}
+        self.state = {}
+        self.hosts = SortedList()
+        self.server_ids = {}
+        self.expiry = SortedList()
+        self.host_expiry = {}
+        self.updated = {}
+        self.versions = {}
+        self.topics_version = curr_time()
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self.__log = None
+        self.__log_size = 0
+        if path is not None:
+            self.__load()
+
+    async def close(self):
+        if self.__log is not None:
+            self.__log.close()
+            self.__log = None
+
+    async def listen_for_invalidations(self, on_subscribed=None):
+        # Nothing is cached in front of this store, and no other process can write to it.
+        pass
+
+    async def migrate(self):
+        """
+        The in-memory layout is not versioned, so there is nothing to migrate.
+        """
+        return None
+
+    async def get_topics(self):
+        """
+        See RedisStore.get_topics
+        """
+        return list(self.topics.keys())
+
+    async def find_topics(self, pattern, limit=TOPIC_QUERY_LIMIT, after=None):
+        """
+        See RedisStore.find_topics
+        """
+        literal, regex = compile_topic_pattern(pattern)
+        start = self.topic_index.bisect_left(literal)
+        if after is not None and after >= literal:
+            start = self.topic_index.bisect_right(after)
+        topics = []
+        for topic in self.topic_index.islice(start):
+            if not topic.startswith(literal) or len(topics) == limit:
+                break
+            if regex.fullmatch(topic):
+                topics.append(topic)
+        return topics
+
+    async def get_topic_hosts(self, topic, subtopics=None):
+        """
+        See RedisStore.get_topic_hosts
+        """
+        path = subtopic_path(subtopics)
+        topic_hosts = self.topics.get(topic, {})
+        if path is None:
+            matches = {host: list(entry["subtopics"]) for host, entry in topic_hosts.items()}
+        else:
+            matches = {}
+            for subtopic, host in self.__find_subtopics(topic, path):
+                matches.setdefault(host, []).append(subtopic)
+        return self.__check_topic_hosts(topic, matches)
+
+    async def get_topic_hosts_page(self, topic, subtopics=None, cursor=None,
+                                   count=HOST_PAGE_SIZE):
+        """
+        See RedisStore.get_topic_hosts_page
+        """
+        path = subtopic_path(subtopics)
+        matches = {}
+        if path is None:
+            # The cursor is the last host returned
+            topic_hosts = self.topics.get(topic, SortedDict())
+            page = list(islice(topic_hosts.irange(cursor, inclusive=(False, False)), count + 1))
+            for host in page[:count]:
+                matches[host] = list(topic_hosts[host]["subtopics"])
+            next_cursor = page[count - 1] if len(page) > count else None
+        else:
+            # The cursor is the last (subtopic, host) returned
+            after = None
+            if cursor is not None:
+                try:
+                    after = tuple(base64.urlsafe_b64decode(cursor).decode().rsplit("\0", 1))
+                except ValueError:
+                    raise_bad_cursor()
+                if len(after) != 2:
+                    raise_bad_cursor()
+            members = list(islice((
+                member for member in self.__find_subtopics(topic, path)
+                if after is None or member > after
+            ), count + 1))
+            for subtopic, host in members[:count]:
+                matches.setdefault(host, []).append(subtopic)
+            next_cursor = None
+            if len(members) > count:
+                next_cursor = base64.urlsafe_b64encode(
+                    "\0".join(members[count - 1]).encode()).decode()
+        return self.__check_topic_hosts(topic, matches), next_cursor
+
+    async def store_host_topic(self, server, topic: str, subtopics: list, signature):
+        """
+        See RedisStore.store_host_topic
+        """
+        if self.__is_tombstoned(server):
+            raise_tombstoned()
+        self.__store_host_topic(server, topic, subtopics, signature)
+        self.__append("store_host_topic", server, topic, subtopics, signature)
+
+    async def get_host_state(self, server):
+        """
+        See RedisStore.get_host_state
+        """
+        server = await self.find_host(server)
+        return self.__build_host_state(self.state.get(server, {}))
+
+    async def get_versioned_host_state(self, server):
+        """
+        See RedisStore.get_versioned_host_state
+        """
+        server = await self.find_host(server)
+        return self.__build_host_state(self.state.get(server, {})), self.versions.get(server, 0)
+
+    async def get_topics_version(self):
+        """
+        See RedisStore.get_topics_version
+        """
+        return self.topics_version
+
+    async def get_host_states(self, servers):
+        """
+        See RedisStore.get_host_states
+        """
+        return {
+            server: self.__build_host_state(self.state[server])
+            for server in servers if len(self.state.get(server, {})) > 0
+        }
+
+    async def has_host_expired(self, server):
+        """
+        See RedisStore.has_host_expired
+        """
+        return self.host_expiry.get(server, 0) < curr_time()
+
+    async def find_host(self, server):
+        """
+        See RedisStore.find_host
+        """
+        if server in self.state and server in self.hosts:
+            return server
+        if is_server_id(server):
+            if server not in self.server_ids:
+                raise HDSFailure("No hosts found", type="hds.error.hosts.none")
+            return self.server_ids[server]
+        servers = []
+        for host in self.hosts.islice(self.hosts.bisect_left(server)):
+            if not host.startswith(server) or len(servers) == 2:
+                break
+            servers.append(host)
+        if len(servers) == 0:
+            raise HDSFailure("No hosts found", type="hds.error.hosts.none")
+        elif len(servers) > 1:
+            raise HDSFailure(
+                "Multiple hosts found matching that ID",
+                type="hds.error.hosts.conflict")
+        return servers[0]
+
+    async def store_host_state(self, server, key, value, ttl, signature, last_updated=None):
+        """
+        See RedisStore.store_host_state
+        """
+        if self.__is_tombstoned(server):
+            raise_tombstoned()
+        last_updated = curr_time() if last_updated is None else int(last_updated)
+        self.__store_host_state(server, key, value, ttl, signature, last_updated)
+        self.__append("store_host_state", server, key, value, ttl, signature, last_updated)
+
+    async def is_host_tombstoned(self, server, throw=True):
+        if self.__is_tombstoned(server):
+            if throw:
+                raise_tombstoned()
+            return True
+        return False
+
+    async def reap_expired_hosts(self, grace=REAP_GRACE_MS, limit=REAP_BATCH_SIZE):
+        """
+        See RedisStore.reap_expired_hosts
+        """
+        cutoff = curr_time() - grace
+        expired = []
+        for expires_at, host in self.expiry.islice(0, limit):
+            if expires_at >= cutoff:
+                break
+            expired.append(host)
+        if len(expired) > 0:
+            self.__reap_hosts(expired)
+            self.__append("reap_hosts", expired)
+            logger.info("Purged %i expired hosts", len(expired))
+        return expired
+
+    def snapshot(self):
+        """
+        Write the whole store to {path}.snapshot and truncate the write log.
+        """
+        if self.path is None:
+            return
+        snapshot_path = self.path + ".snapshot"
+        with open(snapshot_path + ".tmp", "w") as f:
+            json.dump({"state": self.state, "topics": self.topics}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(snapshot_path + ".tmp", snapshot_path)
+        if self.__log is not None:
+            self.__log.close()
+        self.__log = open(self.path + ".log", "w")
+        self.__log_size = 0
+        logger.info("Wrote snapshot to %s", snapshot_path)
+
+    def __is_tombstoned(self, server):
+        return "hds.tombstone" in self.state.get(server, {})
+
+    def __find_subtopics(self, topic, path):
+        # The subtopic itself, then everything below it
+        index = self.subtopics.get(topic, SortedList())
+        for prefix, exact in ((path, True), (path + "/", False)):
+            for subtopic, host in index.islice(index.bisect_left((prefix,))):
+                if (subtopic != prefix) if exact else not subtopic.startswith(prefix):
+                    break
+                yield subtopic, host
+
+    def __check_topic_hosts(self, topic, matches):
+        now = curr_time()
+        hosts = {}
+        for host, host_subtopics in matches.items():
+            if self.host_expiry.get(host, 0) < now or self.__is_tombstoned(host):
+                continue
+            hosts[host] = {
+                "hds.signature": self.topics[topic][host]["hds.signature"],
+                "subtopics": host_subtopics,
+            }
+        return hosts
+
+    def __build_host_state(self, host_state):
+        state = {
+            "hds.expired": [],
+        }
+        for key, entry in host_state.items():
+            state[key] = dict(entry)
+            if state_value_expired(entry):
+                state["hds.expired"].append(key)
+        return state
+
+    def __store_host_topic(self, server, topic, subtopics, signature):
+        if topic not in self.topics:
+            self.topic_index.add(topic)
+            self.topics_version += 1
+        entry = self.topics.setdefault(topic, SortedDict()).get(server)
+        if entry is None:
+            logger.debug("Added %s/%s to topic" % (topic, server))
+            entry = self.topics[topic][server] = {"subtopics": []}
+        self.host_topics.setdefault(server, set()).add(topic)
+        if len(subtopics) > 0:
+            index = self.subtopics.setdefault(topic, SortedList())
+            for subtopic in entry["subtopics"]:
+                index.discard((subtopic, server))
+            entry["subtopics"] = list(subtopics)
+            index.update((subtopic, server) for subtopic in subtopics)
+        entry["hds.signature"] = signature
+
+    def __store_host_state(self, server, key, value, ttl, signature, last_updated):
+        host_state = self.state.setdefault(server, {})
+        if server not in self.hosts:
+            self.hosts.add(server)
+            self.server_ids[server_id(server)] = server
+        updated = self.updated.setdefault(server, SortedList())
+        self.versions[server] = self.versions.get(server, curr_time()) + 1
+        existing = host_state.get(key)
+        if existing is not None and key not in ("hds.host", "hds.tombstone"):
+            updated.discard((existing["hds.last_updated"], key))
+        host_state[key] = {
+            "hds.signature": signature,
+            "hds.ttl": ttl,
+            "hds.last_updated": last_updated,
+            "value": value,
+        }
+        if key == "hds.host":
+            if server in self.host_expiry:
+                self.expiry.remove((self.host_expiry[server], server))
+            self.host_expiry[server] = state_value_expires_at(host_state[key])
+            self.expiry.add((self.host_expiry[server], server))
+        elif key != "hds.tombstone":
+            updated.add((last_updated, key))
+        while len(host_state) > STATE_STORAGE_LIMIT:
+            _, evicted = updated.pop(0)
+            del host_state[evicted]
+            logger.debug(
+                "Removed key %s for %s as it has exceeded the key count" % (evicted, server))
+
+    def __reap_hosts(self, hosts):
+        for host in hosts:
+            for topic in self.host_topics.pop(host, set()):
+                entry = self.topics[topic].pop(host, None)
+                for subtopic in entry["subtopics"] if entry is not None else []:
+                    self.subtopics[topic].discard((subtopic, host))
+            self.hosts.discard(host)
+            if host in self.host_expiry:
+                self.expiry.remove((self.host_expiry.pop(host), host))
+            self.updated.pop(host, None)
+            # Keep the state of tombstoned hosts, so they stay tombstoned
+            if not self.__is_tombstoned(host):
+                self.state.pop(host, None)
+                self.versions.pop(host, None)
+                self.server_ids.pop(server_id(host), None)
+
+    def __append(self, op, *args):
+        if self.__log is None:
+            return
+        self.__log.write(json.dumps([op] + list(args)) + "\n")
+        self.__log.flush()
+        self.__log_size += 1
+        if self.__log_size >= self.snapshot_every:
+            self.snapshot()
+
+    def __load(self):
+        snapshot_path = self.path + ".snapshot"
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path) as f:
+                snapshot = json.load(f)
+            for server, host_state in snapshot["state"].items():
+                for key, entry in host_state.items():
+                    self.__store_host_state(
+                        server, key, entry["value"], entry["hds.ttl"],
+                        entry["hds.signature"], entry["hds.last_updated"])
+            for topic, topic_hosts in snapshot["topics"].items():
+                for server, entry in topic_hosts.items():
+                    self.__store_host_topic(
+                        server, topic, entry["subtopics"], entry["hds.signature"])
+        replayed = 0
+        log_path = self.path + ".log"
+        if os.path.exists(log_path):
+            with open(log_path) as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        # A torn final write, everything before it is intact.
+                        logger.warning("Ignoring corrupt entry in %s", log_path)
+                        break
+                    getattr(self, "_MemoryStore__" + op[0])(*op[1:])
+                    replayed += 1
+        logger.info("Loaded %i hosts and replayed %i writes from %s",
+                    len(self.state), replayed, self.path)
+        self.__log = open(log_path, "a")
+        self.__log_size = replayed
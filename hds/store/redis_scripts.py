@@ -0,0 +1,296 @@
+# Lua scripts run server side by the redis stores. Each script runs atomically, so concurrent
+# writers cannot interleave with it. They are loaded with SCRIPT LOAD on first use and then
+# called by their SHA1 with EVALSHA.
+
+# Store a state value for a host, unless it is tombstoned. Updates the host and expiry indexes
+# and evicts the least recently updated keys once the host is over the limit. hds.host and
+# hds.tombstone are never put in the eviction index, so they are never evicted.
+#
+# Publishes the cache keys to invalidate on the invalidation channel: the host, and all topic
+# listings if hds.host changed. Bumps the host's version, or starts it at the current time.
+# Storing hds.tombstone adds the host to the tombstone index, and publishes the listings of each
+# of the host's topics, as the host has left them.
+#
+# KEYS: hds/host/{host}/state, hds/host/{host}/updated, hds/hosts, hds/hosts/expiry,
+#       hds/host/{host}/version, hds/tombstones, hds/host/{host}/topics
+# ARGV: server, key, value, last_updated, limit, expires_at (only used for hds.host),
+#       invalidation channel, current time
+# Returns: {1 if tombstoned else 0, 1 if the key is new else 0, {evicted keys},
+#           {the host's topics if the key is hds.tombstone}}
+STORE_HOST_STATE = """
+if redis.call('HEXISTS', KEYS[1], 'hds.tombstone') == 1 then
+    return {1, 0, {}, {}}
+end
+redis.call('ZADD', KEYS[3], 0, ARGV[1])
+local added = redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+if redis.call('SETNX', KEYS[5], ARGV[8]) == 0 then
+    redis.call('INCR', KEYS[5])
+end
+local topics = {}
+if ARGV[2] == 'hds.tombstone' then
+    redis.call('SADD', KEYS[6], ARGV[1])
+    topics = redis.call('SMEMBERS', KEYS[7])
+    for _, topic in ipairs(topics) do
+        redis.call('PUBLISH', ARGV[7], 'topic/' .. topic .. '/')
+    end
+end
+if ARGV[2] == 'hds.host' then
+    redis.call('ZADD', KEYS[4], ARGV[6], ARGV[1])
+    redis.call('PUBLISH', ARGV[7], 'topic/')
+elseif ARGV[2] ~= 'hds.tombstone' then
+    redis.call('ZADD', KEYS[2], ARGV[4], ARGV[2])
+end
+local evicted = {}
+local excess = redis.call('HLEN', KEYS[1]) - tonumber(ARGV[5])
+if excess > 0 then
+    local popped = redis.call('ZPOPMIN', KEYS[2], excess)
+    for i = 1, #popped, 2 do
+        redis.call('HDEL', KEYS[1], popped[i])
+        evicted[#evicted + 1] = popped[i]
+    end
+end
+redis.call('PUBLISH', ARGV[7], 'host/' .. ARGV[1])
+return {0, added, evicted, topics}
+"""
+
+# Store a topic for a host, unless it is tombstoned. The subtopics are only replaced if some
+# are given, and are kept in the topic's subtopic index as "{subtopic}\0{host}". Publishes the
+# topic's listings to invalidate on the invalidation channel. Bumps the version of the topic list
+# if the topic is new.
+#
+# KEYS: hds/host/{host}/state, hds/topics, hds/topic/{topic}/hosts, hds/host/{host}/topics,
+#       hds/topic/{topic}/hosts/{host}/subtopics, hds/topic/{topic}/host/{host}/signature,
+#       hds/topic/{topic}/subtopics, hds/topics/version
+# ARGV: server, topic, signature, invalidation channel, subtopics...
+# Returns: {1 if tombstoned else 0, 1 if the topic is new else 0, 1 if the host is new else 0}
+STORE_HOST_TOPIC = """
+if redis.call('HEXISTS', KEYS[1], 'hds.tombstone') == 1 then
+    return {1, 0, 0}
+end
+local new_topic = redis.call('ZADD', KEYS[2], 'NX', 0, ARGV[2])
+if new_topic == 1 then
+    redis.call('INCR', KEYS[8])
+end
+local new_host = redis.call('SADD', KEYS[3], ARGV[1])
+redis.call('SADD', KEYS[4], ARGV[2])
+if #ARGV > 4 then
+    for _, subtopic in ipairs(redis.call('LRANGE', KEYS[5], 0, -1)) do
+        redis.call('ZREM', KEYS[7], subtopic .. '\\0' .. ARGV[1])
+    end
+    redis.call('DEL', KEYS[5])
+    for i = 5, #ARGV do
+        redis.call('RPUSH', KEYS[5], ARGV[i])
+        redis.call('ZADD', KEYS[7], 0, ARGV[i] .. '\\0' .. ARGV[1])
+    end
+end
+redis.call('SET', KEYS[6], ARGV[3])
+redis.call('PUBLISH', ARGV[4], 'topic/' .. ARGV[2] .. '/')
+return {0, new_topic, new_host}
+"""
+
+# Find a host by its full server name, or else by a prefix of it. Full names are the common case,
+# so the prefix search is only run if there is no exact match. Two prefix matches are enough to
+# know there is a conflict.
+#
+# KEYS: hds/hosts
+# ARGV: server name or prefix
+# Returns: {1 if the server was found by its full name else 0, {up to two servers by prefix}}
+SEARCH_HOSTS = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return {1, {}}
+end
+return {0, redis.call('ZRANGEBYLEX', KEYS[1], '[' .. ARGV[1], '[' .. ARGV[1] .. '\\255',
+                      'LIMIT', 0, 2)}
+"""
+
+# Remove a host that has expired, unless it has been refreshed since it was found to have expired.
+# Its topics are read here too, so a topic stored in the meantime is removed with the rest. The
+# state of a tombstoned host is kept, so it stays tombstoned. The per-topic keys are named by
+# formatting the key patterns with the topic and server ID.
+#
+# KEYS: hds/hosts/expiry, hds/hosts, hds/tombstones, hds/server_ids, hds/host/{host}/state,
+#       hds/host/{host}/topics, hds/host/{host}/updated, hds/host/{host}/version
+# ARGV: server, server ID, expiry cutoff, invalidation channel, hds/topic/%s/hosts,
+#       hds/topic/%s/host/%s/signature, hds/topic/%s/hosts/%s/subtopics, hds/topic/%s/subtopics
+# Returns: 1 if the host was removed else 0
+REAP_HOST = """
+local expires_at = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not expires_at or tonumber(expires_at) > tonumber(ARGV[3]) then
+    return 0
+end
+for _, topic in ipairs(redis.call('SMEMBERS', KEYS[6])) do
+    redis.call('SREM', string.format(ARGV[5], topic), ARGV[1])
+    local subtopics_key = string.format(ARGV[7], topic, ARGV[2])
+    for _, subtopic in ipairs(redis.call('LRANGE', subtopics_key, 0, -1)) do
+        redis.call('ZREM', string.format(ARGV[8], topic), subtopic .. '\\0' .. ARGV[1])
+    end
+    redis.call('DEL', string.format(ARGV[6], topic, ARGV[2]), subtopics_key)
+end
+redis.call('DEL', KEYS[6], KEYS[7])
+if redis.call('SISMEMBER', KEYS[3], ARGV[1]) == 0 then
+    redis.call('DEL', KEYS[5], KEYS[8])
+    redis.call('HDEL', KEYS[4], ARGV[2])
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('PUBLISH', ARGV[4], 'host/' .. ARGV[1])
+return 1
+"""
+
+# The sharded stores keep a host's state on its own shard, and the global indexes on the
+# coordinator shard, so STORE_HOST_STATE and STORE_HOST_TOPIC are split into a host half and a
+# coordinator half. The coordinator half is only run once the host half has succeeded.
+
+# Store a state value on the host's shard, unless it is tombstoned. As STORE_HOST_STATE, but
+# without the hds/hosts and hds/hosts/expiry indexes or the invalidation message.
+#
+# KEYS: hds/host/{host}/state, hds/host/{host}/updated, hds/host/{host}/version,
+#       hds/host/{host}/topics
+# ARGV: key, value, last_updated, limit, current time
+# Returns: {1 if tombstoned else 0, 1 if the key is new else 0, {evicted keys},
+#           {the host's topics if the key is hds.tombstone}}
+STORE_SHARD_HOST_STATE = """
+if redis.call('HEXISTS', KEYS[1], 'hds.tombstone') == 1 then
+    return {1, 0, {}, {}}
+end
+local added = redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+if redis.call('SETNX', KEYS[3], ARGV[5]) == 0 then
+    redis.call('INCR', KEYS[3])
+end
+if ARGV[1] ~= 'hds.host' and ARGV[1] ~= 'hds.tombstone' then
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+end
+local topics = {}
+if ARGV[1] == 'hds.tombstone' then
+    topics = redis.call('SMEMBERS', KEYS[4])
+end
+local evicted = {}
+local excess = redis.call('HLEN', KEYS[1]) - tonumber(ARGV[4])
+if excess > 0 then
+    local popped = redis.call('ZPOPMIN', KEYS[2], excess)
+    for i = 1, #popped, 2 do
+        redis.call('HDEL', KEYS[1], popped[i])
+        evicted[#evicted + 1] = popped[i]
+    end
+end
+return {0, added, evicted, topics}
+"""
+
+# Record a topic on the host's shard, unless the host is tombstoned.
+#
+# KEYS: hds/host/{host}/state, hds/host/{host}/topics
+# ARGV: topic
+# Returns: 1 if tombstoned else 0
+STORE_SHARD_HOST_TOPIC = """
+if redis.call('HEXISTS', KEYS[1], 'hds.tombstone') == 1 then
+    return 1
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+return 0
+"""
+
+# Merge state moved from another shard into a host's state on its new shard. Each field is only
+# written if the new shard still has the value it was compared against, so a newer write made
+# since is kept. The host is then trimmed to the limit, as in STORE_HOST_STATE.
+#
+# KEYS: hds/host/{host}/state, hds/host/{host}/updated
+# ARGV: limit, then for each field: field, the value it was compared against or "", the value
+#       to write, last_updated or "" to leave it out of the eviction index
+# Returns: {evicted keys}
+MERGE_SHARD_HOST_STATE = """
+for i = 2, #ARGV, 4 do
+    if (redis.call('HGET', KEYS[1], ARGV[i]) or '') == ARGV[i + 1] then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+        if ARGV[i + 3] ~= '' then
+            redis.call('ZADD', KEYS[2], ARGV[i + 3], ARGV[i])
+        end
+    end
+end
+local evicted = {}
+local excess = redis.call('HLEN', KEYS[1]) - tonumber(ARGV[1])
+if excess > 0 then
+    local popped = redis.call('ZPOPMIN', KEYS[2], excess)
+    for i = 1, #popped, 2 do
+        redis.call('HDEL', KEYS[1], popped[i])
+        evicted[#evicted + 1] = popped[i]
+    end
+end
+return evicted
+"""
+
+# Store a topic for a host on the coordinator shard. As STORE_HOST_TOPIC, without the tombstone
+# check or hds/host/{host}/topics.
+#
+# KEYS: hds/topics, hds/topic/{topic}/hosts, hds/topic/{topic}/hosts/{host}/subtopics,
+#       hds/topic/{topic}/host/{host}/signature, hds/topic/{topic}/subtopics,
+#       hds/topics/version
+# ARGV: server, topic, signature, invalidation channel, subtopics...
+# Returns: {1 if the topic is new else 0, 1 if the host is new else 0}
+STORE_COORDINATOR_TOPIC = """
+local new_topic = redis.call('ZADD', KEYS[1], 'NX', 0, ARGV[2])
+if new_topic == 1 then
+    redis.call('INCR', KEYS[6])
+end
+local new_host = redis.call('SADD', KEYS[2], ARGV[1])
+if #ARGV > 4 then
+    for _, subtopic in ipairs(redis.call('LRANGE', KEYS[3], 0, -1)) do
+        redis.call('ZREM', KEYS[5], subtopic .. '\\0' .. ARGV[1])
+    end
+    redis.call('DEL', KEYS[3])
+    for i = 5, #ARGV do
+        redis.call('RPUSH', KEYS[3], ARGV[i])
+        redis.call('ZADD', KEYS[5], 0, ARGV[i] .. '\\0' .. ARGV[1])
+    end
+end
+redis.call('SET', KEYS[4], ARGV[3])
+redis.call('PUBLISH', ARGV[4], 'topic/' .. ARGV[2] .. '/')
+return {new_topic, new_host}
+"""
+
+# Remove an expired host's keys from its shard, unless its hds.host has changed since it was
+# read, as it has been refreshed. The state of a tombstoned host is kept.
+#
+# KEYS: hds/host/{host}/state, hds/host/{host}/topics, hds/host/{host}/updated,
+#       hds/host/{host}/version
+# ARGV: hds.host as read before, or "" if it had none, 1 if tombstoned else 0
+# Returns: {1 if the keys were removed else 0, {the host's topics}}
+REAP_SHARD_HOST = """
+if (redis.call('HGET', KEYS[1], 'hds.host') or '') ~= ARGV[1] then
+    return {0, {}}
+end
+local topics = redis.call('SMEMBERS', KEYS[2])
+redis.call('DEL', KEYS[2], KEYS[3])
+if ARGV[2] == '0' then
+    redis.call('DEL', KEYS[1], KEYS[4])
+end
+return {1, topics}
+"""
+
+# Remove a host reaped by REAP_SHARD_HOST from the indexes on the coordinator shard. The host
+# is only removed from the host indexes if it has not been refreshed since, but its topics are
+# always removed, as its shard no longer lists them.
+#
+# KEYS: hds/hosts/expiry, hds/hosts, hds/tombstones, hds/server_ids
+# ARGV: server, server ID, expiry cutoff, invalidation channel, hds/topic/%s/hosts,
+#       hds/topic/%s/host/%s/signature, hds/topic/%s/hosts/%s/subtopics, hds/topic/%s/subtopics,
+#       topics...
+REAP_COORDINATOR_HOST = """
+for i = 9, #ARGV do
+    local topic = ARGV[i]
+    redis.call('SREM', string.format(ARGV[5], topic), ARGV[1])
+    local subtopics_key = string.format(ARGV[7], topic, ARGV[2])
+    for _, subtopic in ipairs(redis.call('LRANGE', subtopics_key, 0, -1)) do
+        redis.call('ZREM', string.format(ARGV[8], topic), subtopic .. '\\0' .. ARGV[1])
+    end
+    redis.call('DEL', string.format(ARGV[6], topic, ARGV[2]), subtopics_key)
+end
+local expires_at = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if expires_at and tonumber(expires_at) <= tonumber(ARGV[3]) then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    if redis.call('SISMEMBER', KEYS[3], ARGV[1]) == 0 then
+        redis.call('HDEL', KEYS[4], ARGV[2])
+    end
+end
+redis.call('PUBLISH', ARGV[4], 'host/' .. ARGV[1])
+"""
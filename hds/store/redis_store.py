@@ -1,13 +1,24 @@
+import base64
+import binascii
 import logging
 import os
+import re
+import struct
 import time
+from collections import OrderedDict
 import redis
 
-from ..util import HDSFailure
+from ..util import HDSFailure, server_id, is_server_id
+from . import redis_scripts
 
 HOST = os.environ.get("REDIS_HOST", "localhost")
 PORT = int(os.environ.get("REDIS_PORT", "6379"))
 PASSWORD = os.environ.get("REDIS_PASSWORD", None)
+# Comma separated host:port list of replicas of REDIS_HOST to send reads to
+REPLICAS = [r for r in os.environ.get("REDIS_REPLICAS", "").split(",") if r != ""]
+# How long after a write reads of the same host or topic go to the primary, in milliseconds.
+# This should be longer than the replication lag.
+READ_YOUR_WRITES_MS = int(os.environ.get("REDIS_READ_YOUR_WRITES_MS", "5000"))
 
 logger = logging.getLogger(__name__)
 
@@ -16,40 +27,951 @@ K_HOSTS = "hds/hosts"
 K_TOPIC_HOSTS = "hds/topic/%s/hosts"
 K_TOPIC_HOST_SIG = "hds/topic/%s/host/%s/signature"
 K_TOPIC_SUBTOPIC_HOSTS = "hds/topic/%s/hosts/%s/subtopics"
-K_HOST_STATE = "hds/host/%s/state/%s"
-K_HOST_STATE_KEYS = "hds/host/%s/state"
+K_TOPIC_SUBTOPICS = "hds/topic/%s/subtopics"
+K_HOST_STATE = "hds/host/%s/state"
+K_HOST_TOPICS = "hds/host/%s/topics"
+K_HOST_STATE_UPDATED = "hds/host/%s/updated"
+K_HOST_VERSION = "hds/host/%s/version"
+K_HOSTS_EXPIRY = "hds/hosts/expiry"
+K_TOPICS_VERSION = "hds/topics/version"
+# Server ID => server name, see host_key
+K_SERVER_IDS = "hds/server_ids"
+K_TOMBSTONES = "hds/tombstones"
+K_SCHEMA_VERSION = "hds/schema_version"
+# Pub/sub channel of cache key prefixes to invalidate, see BaseRedisStore.cache
+K_INVALIDATE = "hds/invalidate"
 
+# Layout prior to schema version 2, only used by migrations
+K_LEGACY_HOST_STATE = "hds/host/%s/state/%s"
+
+# Stored state values are a STATE_RECORD header, followed by the signature and then the value as
+# UTF-8. The header is: format version, flags, ttl, last_updated, signature length.
+STATE_RECORD = struct.Struct(">BBqqH")
+STATE_RECORD_VERSION = 1
+# The signature is stored as raw bytes, rather than the base64 text it was given as
+STATE_FLAG_RAW_SIGNATURE = 0x01
+# Text format used before schema version 6. It is still read, see parse_state_value
 HOST_STATE_FORMAT = "%s:%i:%i:%s"
 STATE_STORAGE_LIMIT = 255
+SCHEMA_VERSION = 10
+# The most topics find_topics will return
+TOPIC_QUERY_LIMIT = 1000
+# How many hosts get_topic_hosts_page asks for at a time. Pages may be smaller, or slightly larger
+HOST_PAGE_SIZE = 100
+# How long a host's hds.host must have been expired for before it is purged
+REAP_GRACE_MS = int(os.environ.get("HDS_REAP_GRACE_SEC", str(60 * 60 * 24 * 7))) * 1000
+REAP_BATCH_SIZE = 100
 
 # Topic
 
 # This implementation makes use of Redis rather than MongoDB which means queries should be faster.
 #
 # Topics are just:
-# hds/topics => LIST
-# hds/hosts => LIST
-# hds/topic/{topic}/hosts => LIST host
-# hds/topic/{topic}/host/{host}/signature => STR
-# hds/topic/{topic}/hosts/{host}/subtopics => LIST
-# hds/host/{host}/state/{key} => STR signature:ttl:last_updated:value
-# hds/host/state => LIST keys
+# hds/topics => ZSET topic, all scored 0 so that it can be queried by prefix with ZRANGEBYLEX
+# hds/hosts => ZSET host, all scored 0 so that it can be queried by prefix with ZRANGEBYLEX
+# hds/topic/{topic}/hosts => SET host
+# hds/topic/{topic}/host/{server id}/signature => STR
+# hds/topic/{topic}/hosts/{server id}/subtopics => LIST, in the order they were given
+# hds/topic/{topic}/subtopics => ZSET "{subtopic}\0{host}", all scored 0 so that the hosts of a
+#                                 subtopic and its children can be queried with ZRANGEBYLEX
+# hds/host/{server id}/state => HASH key => STATE_RECORD
+# hds/host/{server id}/topics => SET topic
+# hds/host/{server id}/updated => ZSET key, scored by last_updated. Excludes hds.host
+# hds/host/{server id}/version => STR incremented on every change to the host's state
+# hds/hosts/expiry => ZSET host, scored by the time its hds.host expires
+# hds/server_ids => HASH server id => host
+# hds/topics/version => STR incremented whenever a topic is added to hds/topics
+# hds/tombstones => SET host, of every host with a hds.tombstone key. Kept alongside the per-host
+#                   keys so that it is on the coordinator of a sharded store
+#
+# Values and members hold the full server name, which is needed to verify the host's payloads,
+# but per-host key names use the much shorter server id, see host_key.
+#
+# A host's version starts at the time of its first write, in milliseconds, rather than at 1, so
+# a host that is reaped and later comes back does not reuse the versions of its old state.
+# hds/schema_version => STR version of the layout above, see RedisStore.migrate
 
 
 def curr_time():
     return int(time.time() * 1000)
 
 
-class RedisStore():
-    def __init__(self):
+def encode_state_value(signature, ttl, last_updated, value):
+    """
+    Encode a state value as a binary STATE_RECORD.
+
+    :param signature: The base64 signature string
+    :param ttl: The time to live for the key, in seconds
+    :param last_updated: The time of the state update, in milliseconds
+    :param value: The state value string
+    :return: The bytes to store in redis
+    """
+    flags = 0
+    try:
+        sig = base64.b64decode(signature, validate=True)
+        # Only keep the raw bytes if we can give back exactly the string we were given
+        if base64.b64encode(sig).decode() == signature:
+            flags |= STATE_FLAG_RAW_SIGNATURE
+        else:
+            sig = signature.encode()
+    except (binascii.Error, ValueError):
+        sig = signature.encode()
+    return STATE_RECORD.pack(
+        STATE_RECORD_VERSION, flags, int(ttl), int(last_updated), len(sig)
+    ) + sig + str(value).encode()
+
+
+def parse_state_value(raw):
+    """
+    Parse a stored state value, either a STATE_RECORD or the older HOST_STATE_FORMAT text.
+
+    :param raw: The bytes as stored in redis
+    :return: A state entry dict, as found in get_host_state
+    """
+    if raw[0] == STATE_RECORD_VERSION:
+        _, flags, ttl, last_updated, sig_len = STATE_RECORD.unpack_from(raw)
+        sig = raw[STATE_RECORD.size:STATE_RECORD.size + sig_len]
+        return {
+            "hds.signature": (base64.b64encode(sig) if flags & STATE_FLAG_RAW_SIGNATURE
+                              else sig).decode(),
+            "hds.ttl": ttl,
+            "hds.last_updated": last_updated,
+            "value": raw[STATE_RECORD.size + sig_len:].decode(),
+        }
+    # Base64 never starts with a 0x01 byte, so this is a HOST_STATE_FORMAT string
+    vals = raw.decode().split(":", 3)
+    return {
+        "hds.signature": vals[0],
+        "hds.ttl": int(vals[1]),
+        "hds.last_updated": int(vals[2]),
+        "value": vals[3],
+    }
+
+
+def state_value_expires_at(entry):
+    return entry["hds.last_updated"] + entry["hds.ttl"] * 1000
+
+
+def state_value_expired(entry):
+    return curr_time() > state_value_expires_at(entry)
+
+
+def host_state_expires_at(state):
+    """
+    :param state: A state object, as returned by get_host_state
+    :return: The time the first of its unexpired keys expires, in milliseconds, or None if
+             they have all expired
+    """
+    expiries = [
+        state_value_expires_at(v) for k, v in state.items()
+        if k != "hds.expired" and k not in state["hds.expired"]
+    ]
+    return min(expiries) if len(expiries) > 0 else None
+
+
+def build_host_state(raw_state):
+    """
+    Build a state object from the contents of a hds/host/{host}/state hash.
+
+    :param raw_state: A dict of key bytes => value bytes
+    :return: A object containing all the state of the host
+    """
+    state = {
+        "hds.expired": [],
+    }
+    for key, raw in raw_state.items():
+        key = key.decode()
+        state[key] = parse_state_value(raw)
+        if state_value_expired(state[key]):
+            state["hds.expired"].append(key)
+    return state
+
+
+def subtopic_path(subtopics):
+    """
+    Normalise a subtopic query. Subtopics are paths like "local/portsmouth", and a query for a
+    path matches hosts with that subtopic or any subtopic below it.
+
+    :param subtopics: A "/" separated path string, a list of path segments, or None
+    :return: The path string, or None to match every host
+    """
+    if subtopics is None:
+        return None
+    if not isinstance(subtopics, str):
+        subtopics = "/".join(subtopics)
+    subtopics = subtopics.strip("/")
+    return subtopics if subtopics != "" else None
+
+
+def parse_redis_address(address):
+    """
+    :param address: A host:port string. The port defaults to REDIS_PORT
+    :return: A (host, port) tuple
+    """
+    host, _, port = address.partition(":")
+    return host, int(port or PORT)
+
+
+def host_key(key, server):
+    """
+    Name a per-host key, like K_HOST_STATE. These are named by the server_id rather than the
+    full server name, which can be hundreds of characters long.
+    """
+    return key % server_id(server)
+
+
+def topic_host_key(key, topic, server):
+    """
+    Name a per-topic, per-host key, like K_TOPIC_HOST_SIG. See host_key.
+    """
+    return key % (topic, server_id(server))
+
+
+def parse_subtopic_members(members):
+    """
+    :param members: Members of a hds/topic/{topic}/subtopics index
+    :return: A dict of host => list of subtopics
+    """
+    matches = {}
+    for member in members:
+        subtopic, host = member.decode().rsplit("\0", 1)
+        matches.setdefault(host, []).append(subtopic)
+    return matches
+
+
+def compile_topic_pattern(pattern):
+    """
+    Compile a topic pattern. Topics are "." separated, like "uk.half-shot.weather". In a pattern
+    "*" matches within one segment, and "**" matches anything, including further segments. So
+    "uk.half-shot.*" matches "uk.half-shot.weather" but not "uk.half-shot.weather.rain", and
+    "uk.**" matches both.
+
+    :param pattern: The topic pattern string
+    :return: A tuple of the literal prefix of the pattern, and a compiled regex for the pattern
+    """
+    literal = pattern.split("*", 1)[0]
+    regex = ""
+    for i, part in enumerate(pattern.split("**")):
+        if i > 0:
+            regex += ".*"
+        regex += "[^.]*".join(re.escape(literal_part) for literal_part in part.split("*"))
+    return literal, re.compile(regex)
+
+
+def raise_bad_cursor():
+    raise HDSFailure("The cursor is not valid", type="hds.error.topic.bad_query")
+
+
+def raise_tombstoned():
+    raise HDSFailure("Host is tombstoned, it cannot be used", type="hds.error.host.tombstone")
+
+
+class BaseRedisStore():
+    """
+    Store logic shared by RedisStore and AsyncRedisStore.
+
+    Each operation is a generator that queues commands on a pipeline from self._pipeline()
+    and yields it. The concrete store executes the pipeline and sends the results back in, so
+    each yield is exactly one round-trip and the same code drives the blocking and the asyncio
+    redis clients. Operations can be composed with ``yield from``.
+    """
+
+    # An optional LRUCache of host state and topic listings. It is kept coherent by invalidating
+    # entries on write, and by listening on K_INVALIDATE for writes from other processes.
+    cache = None
+
+    # Redis clients for replicas of self.r. If any are given, read-only operations go to them in
+    # turn, except for hosts and topics written in the last READ_YOUR_WRITES_MS.
+    replicas = ()
+    read_your_writes = READ_YOUR_WRITES_MS
+
+    # (schema version, operation) pairs, applied in order by migrate()
+    MIGRATIONS = [
+        (1, "_migrate_list_indexes"),
+        (2, "_migrate_state_hashes"),
+        (3, "_migrate_host_prefix_index"),
+        (4, "_migrate_expiry_index"),
+        (5, "_migrate_eviction_index"),
+        (6, "_migrate_state_records"),
+        (7, "_migrate_subtopic_index"),
+        (8, "_migrate_topic_index"),
+        (9, "_migrate_server_ids"),
+        (10, "_migrate_tombstone_index"),
+    ]
+
+    def _pipeline(self, transaction=False):
+        return self.r.pipeline(transaction=transaction)
+
+    def _read_pipeline(self, *written):
+        """
+        Get a pipeline for a read-only operation, on a replica if there are any.
+
+        :param written: Cache keys (see cache) that, if written recently, require the primary
+        """
+        if len(self.replicas) == 0 or any(self._recently_written(key) for key in written):
+            return self._pipeline()
+        self._next_replica = (self._next_replica + 1) % len(self.replicas)
+        return self.replicas[self._next_replica].pipeline(transaction=False)
+
+    def _recently_written(self, key):
+        expires = self._recent_writes.get(key)
+        return expires is not None and expires > time.monotonic()
+
+    def _mark_written(self, key):
+        if len(self.replicas) == 0 or self.read_your_writes <= 0:
+            return
+        now = time.monotonic()
+        self._recent_writes[key] = now + self.read_your_writes / 1000
+        self._recent_writes.move_to_end(key)
+        # Entries are in expiry order, so drop them from the front
+        while next(iter(self._recent_writes.values())) <= now:
+            self._recent_writes.popitem(last=False)
+
+    def _queue_script(self, pipe, source, keys, args):
+        script = self._scripts.get(source)
+        if script is None:
+            script = self._scripts[source] = self.r.register_script(source)
+        # The pipeline will SCRIPT LOAD it on execute, if redis doesn't have it already
+        pipe.scripts.add(script)
+        pipe.evalsha(script.sha, len(keys), *keys, *args)
+
+    def _invalidate(self, prefix):
+        if self.cache is not None:
+            self.cache.invalidate_prefix(prefix)
+
+    def _op_get_topics(self):
+        logger.debug("redis://%s" % K_TOPICS)
+        pipe = self._read_pipeline("topic/")
+        pipe.zrange(K_TOPICS, 0, -1)
+        topics, = yield pipe
+        return [t.decode() for t in topics]
+
+    def _op_find_topics(self, pattern, limit=TOPIC_QUERY_LIMIT, after=None):
+        literal, regex = compile_topic_pattern(pattern)
+        prefix = literal.encode()
+        start = b"[" + prefix
+        if after is not None and after.encode() >= prefix:
+            start = b"(" + after.encode()
+        topics = []
+        # Only the topics sharing the pattern's literal prefix are read, a page at a time
+        while len(topics) < limit:
+            pipe = self._read_pipeline("topic/")
+            pipe.zrangebylex(K_TOPICS, start, b"[" + prefix + b"\xff", start=0,
+                             num=TOPIC_QUERY_LIMIT)
+            page, = yield pipe
+            topics.extend(t.decode() for t in page if regex.fullmatch(t.decode()))
+            if len(page) < TOPIC_QUERY_LIMIT:
+                break
+            start = b"(" + page[-1]
+        return topics[:limit]
+
+    def _op_get_topic_hosts(self, topic, subtopics=None):
+        path = subtopic_path(subtopics)
+        cache_key = "topic/%s/%s" % (topic, path or "")
+        if self.cache is not None:
+            hosts = self.cache.get(cache_key)
+            if hosts is not None:
+                return hosts
+        hosts = yield from self._op_get_topic_hosts_uncached(topic, path)
+        if self.cache is not None:
+            self.cache.set(cache_key, hosts)
+        return hosts
+
+    def _op_get_topic_hosts_uncached(self, topic, path):
+        pipe = self._read_pipeline("topic/", "topic/%s/" % topic)
+        matches = None
+        if path is None:
+            pipe.smembers(K_TOPIC_HOSTS % topic)
+            topic_hosts, = yield pipe
+            topic_hosts = [host.decode() for host in topic_hosts]
+        else:
+            # Only the hosts with the subtopic, or a subtopic below it, are touched
+            exact = (path + "\0").encode()
+            below = (path + "/").encode()
+            pipe.zrangebylex(K_TOPIC_SUBTOPICS % topic, b"[" + exact, b"[" + exact + b"\xff")
+            pipe.zrangebylex(K_TOPIC_SUBTOPICS % topic, b"[" + below, b"[" + below + b"\xff")
+            exact_members, below_members = yield pipe
+            matches = parse_subtopic_members(exact_members + below_members)
+            topic_hosts = list(matches.keys())
+        return (yield from self._op_check_topic_hosts(topic, topic_hosts, matches))
+
+    def _op_get_topic_hosts_page(self, topic, subtopics=None, cursor=None,
+                                 count=HOST_PAGE_SIZE):
+        path = subtopic_path(subtopics)
+        pipe = self._read_pipeline("topic/", "topic/%s/" % topic)
+        matches = None
+        if path is None:
+            try:
+                cursor = int(cursor or 0)
+            except ValueError:
+                raise_bad_cursor()
+            if cursor < 0:
+                raise_bad_cursor()
+            pipe.sscan(K_TOPIC_HOSTS % topic, cursor, count=count)
+            (next_cursor, topic_hosts), = yield pipe
+            topic_hosts = [host.decode() for host in topic_hosts]
+            next_cursor = str(next_cursor) if next_cursor != 0 else None
+        else:
+            # The cursor is the last index member returned, so continue after it. Members for
+            # the subtopic itself sort before those below it.
+            exact = (path + "\0").encode()
+            below = (path + "/").encode()
+            try:
+                after = base64.urlsafe_b64decode(cursor) if cursor is not None else None
+            except ValueError:
+                raise_bad_cursor()
+            # A cursor outside the subtopic would read the hosts of other subtopics
+            if after is not None and not after.startswith((exact, below)):
+                raise_bad_cursor()
+            if after is None or not after.startswith(below):
+                start = b"(" + after if after is not None else b"[" + exact
+                pipe.zrangebylex(K_TOPIC_SUBTOPICS % topic, start, b"[" + exact + b"\xff",
+                                 start=0, num=count)
+            start = b"(" + after if after is not None and after.startswith(below) else b"[" + below
+            pipe.zrangebylex(K_TOPIC_SUBTOPICS % topic, start, b"[" + below + b"\xff",
+                             start=0, num=count)
+            results = yield pipe
+            members = [member for result in results for member in result]
+            more = len(members) > count or any(len(result) == count for result in results)
+            members = members[:count]
+            next_cursor = base64.urlsafe_b64encode(members[-1]).decode() if more else None
+            matches = parse_subtopic_members(members)
+            topic_hosts = list(matches.keys())
+        hosts = yield from self._op_check_topic_hosts(topic, topic_hosts, matches)
+        return hosts, next_cursor
+
+    def _op_check_topic_hosts(self, topic, topic_hosts, matches):
+        if len(topic_hosts) == 0:
+            return {}
+        # Fetch everything needed to evaluate every host in one pipelined batch, rather
+        # than several round-trips per host.
+        pipe = self._read_pipeline("topic/", "topic/%s/" % topic)
+        pipe.zmscore(K_HOSTS_EXPIRY, topic_hosts)
+        pipe.smismember(K_TOMBSTONES, topic_hosts)
+        for host in topic_hosts:
+            pipe.get(topic_host_key(K_TOPIC_HOST_SIG, topic, host))
+            if matches is None:
+                pipe.lrange(topic_host_key(K_TOPIC_SUBTOPIC_HOSTS, topic, host), 0, -1)
+        results = yield pipe
+        expiry = results.pop(0)
+        tombstones = results.pop(0)
+        stride = 2 if matches is None else 1
+        now = curr_time()
+        hosts = {}
+        for i, host in enumerate(topic_hosts):
+            sig = results[i * stride]
+            if expiry[i] is None or expiry[i] < now or tombstones[i] or sig is None:
+                continue
+            hosts[host] = {
+                "hds.signature": sig.decode(),
+                # Only the subtopics that matched the query are given
+                "subtopics": matches[host] if matches is not None else [
+                    subtopic.decode() for subtopic in results[i * stride + 1]
+                ],
+            }
+        return hosts
+
+    def _op_store_host_topic(self, server, topic, subtopics, signature):
+        pipe = self._pipeline()
+        self._queue_script(
+            pipe, redis_scripts.STORE_HOST_TOPIC,
+            [host_key(K_HOST_STATE, server), K_TOPICS, K_TOPIC_HOSTS % topic,
+             host_key(K_HOST_TOPICS, server),
+             topic_host_key(K_TOPIC_SUBTOPIC_HOSTS, topic, server),
+             topic_host_key(K_TOPIC_HOST_SIG, topic, server), K_TOPIC_SUBTOPICS % topic,
+             K_TOPICS_VERSION],
+            [server, topic, signature, K_INVALIDATE] + list(subtopics))
+        (tombstoned, new_topic, new_host), = yield pipe
+        if tombstoned:
+            raise_tombstoned()
+        self._stored_host_topic(server, topic, new_topic, new_host)
+
+    def _stored_host_topic(self, server, topic, new_topic, new_host):
+        self._invalidate("topic/%s/" % topic)
+        self._mark_written("topic/%s/" % topic)
+        if new_topic:
+            logger.debug("Added %s to %s" % (topic, K_TOPICS))
+        if new_host:
+            logger.debug("Added %s/%s to %s" % (topic, server, K_TOPIC_HOSTS % topic))
+
+    def _op_get_host_state(self, server):
+        state, _ = yield from self._op_get_versioned_host_state(server)
+        return state
+
+    def _op_get_versioned_host_state(self, server):
+        if self.cache is not None:
+            versioned = self.cache.get("host/" + server)
+            if versioned is not None:
+                return versioned
+        server = yield from self._op_find_host(server)
+        if self.cache is not None:
+            versioned = self.cache.get("host/" + server, count=False)
+            if versioned is not None:
+                return versioned
+        # All keys are held in one hash, so this is a single round-trip
+        pipe = self._read_pipeline("host/" + server)
+        pipe.hgetall(host_key(K_HOST_STATE, server))
+        pipe.get(host_key(K_HOST_VERSION, server))
+        raw, version = yield pipe
+        state = build_host_state(raw)
+        version = int(version or 0)
+        if self.cache is not None:
+            # Don't cache past the point where a key would become expired
+            expires_at = host_state_expires_at(state)
+            ttl = expires_at - curr_time() if expires_at is not None else None
+            self.cache.set("host/" + server, (state, version), ttl)
+        return state, version
+
+    def _op_get_topics_version(self):
+        pipe = self._read_pipeline("topic/")
+        pipe.get(K_TOPICS_VERSION)
+        version, = yield pipe
+        return int(version or 0)
+
+    def _op_get_host_states(self, servers):
+        pipe = self._read_pipeline(*["host/" + server for server in servers])
+        for server in servers:
+            pipe.hgetall(host_key(K_HOST_STATE, server))
+        results = yield pipe
+        return {
+            server: build_host_state(raw)
+            for server, raw in zip(servers, results) if len(raw) > 0
+        }
+
+    def _op_has_host_expired(self, server):
+        pipe = self._read_pipeline("host/" + server)
+        pipe.zscore(K_HOSTS_EXPIRY, server)
+        expires_at, = yield pipe
+        return expires_at is None or expires_at < curr_time()
+
+    def _op_find_host(self, server):
+        if is_server_id(server):
+            return (yield from self._op_find_server_id(server))
+        found, servers = yield from self._op_search_hosts(
+            self._read_pipeline("host/" + server), server)
+        if not found and len(servers) == 0 and len(self.replicas) > 0:
+            # The replica may not have seen a host that registered moments ago
+            found, servers = yield from self._op_search_hosts(self._pipeline(), server)
+        if found:
+            return server
+        servers = [s.decode() for s in servers]
+        if len(servers) == 0:
+            raise HDSFailure("No hosts found", type="hds.error.hosts.none")
+        elif len(servers) > 1:
+            raise HDSFailure(
+                "Multiple hosts found matching that ID",
+                type="hds.error.hosts.conflict")
+        return servers[0]
+
+    def _op_find_server_id(self, sid):
+        pipe = self._read_pipeline()
+        pipe.hget(K_SERVER_IDS, sid)
+        server, = yield pipe
+        if server is None and len(self.replicas) > 0:
+            pipe = self._pipeline()
+            pipe.hget(K_SERVER_IDS, sid)
+            server, = yield pipe
+        if server is None:
+            raise HDSFailure("No hosts found", type="hds.error.hosts.none")
+        return server.decode()
+
+    def _op_search_hosts(self, pipe, server):
+        self._queue_script(pipe, redis_scripts.SEARCH_HOSTS, [K_HOSTS], [server])
+        (found, servers), = yield pipe
+        return found, servers
+
+    def _op_store_host_state(self, server, key, value, ttl, signature, last_updated=None):
+        last_updated = curr_time() if last_updated is None else last_updated
+        store_val = encode_state_value(signature, ttl, last_updated, value)
+        # The tombstone check, write, index updates and eviction are one round-trip
+        pipe = self._pipeline()
+        self._queue_script(
+            pipe, redis_scripts.STORE_HOST_STATE,
+            [host_key(K_HOST_STATE, server), host_key(K_HOST_STATE_UPDATED, server), K_HOSTS,
+             K_HOSTS_EXPIRY, host_key(K_HOST_VERSION, server), K_TOMBSTONES,
+             host_key(K_HOST_TOPICS, server)],
+            [server, key, store_val, last_updated, STATE_STORAGE_LIMIT,
+             last_updated + ttl * 1000, K_INVALIDATE, curr_time()])
+        pipe.hsetnx(K_SERVER_IDS, server_id(server), server)
+        (tombstoned, added, evicted, topics), _ = yield pipe
+        if tombstoned:
+            raise_tombstoned()
+        self._stored_host_state(server, key, added, evicted, topics)
+
+    def _stored_host_state(self, server, key, added, evicted, topics):
+        self._invalidate("host/" + server)
+        self._mark_written("host/" + server)
+        if key == "hds.host":
+            self._invalidate("topic/")
+            self._mark_written("topic/")
+        # A tombstoned host is dropped from the hosts of each of its topics
+        for topic in topics:
+            self._invalidate("topic/%s/" % topic.decode())
+            self._mark_written("topic/%s/" % topic.decode())
+        if added:
+            logger.debug("Added new key %s to %s" % (key, server[:16]))
+        logger.debug("Updated key %s for %s" % (key, server[:16]))
+        for evicted_key in evicted:
+            logger.debug(
+                "Removed key %s for %s as it has exceeded the key count" %
+                (evicted_key.decode(), server)
+            )
+
+    def _op_is_host_tombstoned(self, server, throw=True):
+        pipe = self._pipeline()
+        pipe.hexists(host_key(K_HOST_STATE, server), "hds.tombstone")
+        tombstoned, = yield pipe
+        if tombstoned:
+            if throw:
+                raise_tombstoned()
+            return True
+        return False
+
+    def _op_reap_expired_hosts(self, grace=REAP_GRACE_MS, limit=REAP_BATCH_SIZE):
+        cutoff = curr_time() - grace
+        pipe = self._pipeline()
+        pipe.zrangebyscore(K_HOSTS_EXPIRY, "-inf", cutoff, start=0, num=limit)
+        expired, = yield pipe
+        expired = [host.decode() for host in expired]
+        if len(expired) == 0:
+            return []
+        # A host can be refreshed after it was read here, so the script checks it again
+        pipe = self._pipeline()
+        for host in expired:
+            self._queue_script(
+                pipe, redis_scripts.REAP_HOST,
+                [K_HOSTS_EXPIRY, K_HOSTS, K_TOMBSTONES, K_SERVER_IDS, host_key(K_HOST_STATE, host),
+                 host_key(K_HOST_TOPICS, host), host_key(K_HOST_STATE_UPDATED, host),
+                 host_key(K_HOST_VERSION, host)],
+                [host, server_id(host), cutoff] + self._reap_args())
+        pipe.publish(K_INVALIDATE, "topic/")
+        reaped = yield pipe
+        return self._reaped_hosts([host for host, ok in zip(expired, reaped) if ok])
+
+    @staticmethod
+    def _reap_args():
+        # The invalidation channel and key patterns the reap scripts take after the cutoff
+        return [K_INVALIDATE, K_TOPIC_HOSTS, K_TOPIC_HOST_SIG, K_TOPIC_SUBTOPIC_HOSTS,
+                K_TOPIC_SUBTOPICS]
+
+    def _reaped_hosts(self, reaped):
+        for host in reaped:
+            self._invalidate("host/" + host)
+        self._invalidate("topic/")
+        logger.info("Purged %i expired hosts", len(reaped))
+        return reaped
+
+    def _op_migrate(self):
+        pipe = self._pipeline()
+        pipe.get(K_SCHEMA_VERSION)
+        version, = yield pipe
+        version = int(version or 0)
+        for step_version, step in self.MIGRATIONS:
+            if step_version <= version:
+                continue
+            logger.info("Migrating store to schema version %i", step_version)
+            yield from self._op_migration_step(step_version, step)
+            pipe = self._pipeline()
+            pipe.set(K_SCHEMA_VERSION, step_version)
+            yield pipe
+            version = step_version
+        return version
+
+    def _op_migration_step(self, step_version, step):
+        yield from getattr(self, step)()
+
+    def _convert_list_to_set(self, key):
+        pipe = self._pipeline()
+        pipe.type(key)
+        key_type, = yield pipe
+        if key_type != b"list":
+            return
+        pipe = self._pipeline()
+        pipe.lrange(key, 0, -1)
+        members, = yield pipe
+        tmp_key = key + "/migrating"
+        pipe = self._pipeline(transaction=True)
+        pipe.delete(tmp_key)
+        if len(members) > 0:
+            pipe.sadd(tmp_key, *members)
+            pipe.rename(tmp_key, key)
+        else:
+            pipe.delete(key)
+        yield pipe
+        logger.debug("Converted %s to a set of %i members", key, len(members))
+
+    def _convert_set_to_lex_zset(self, key):
+        pipe = self._pipeline()
+        pipe.type(key)
+        key_type, = yield pipe
+        if key_type != b"set":
+            return
+        pipe = self._pipeline()
+        pipe.smembers(key)
+        members, = yield pipe
+        tmp_key = key + "/migrating"
+        pipe = self._pipeline(transaction=True)
+        pipe.delete(tmp_key)
+        pipe.zadd(tmp_key, {member: 0 for member in members})
+        pipe.rename(tmp_key, key)
+        yield pipe
+        logger.debug("Converted %s to a sorted set of %i members", key, len(members))
+
+    def _scan_clients(self):
+        # Every redis instance holding part of the keyspace
+        return [self.r]
+
+    def _op_scan(self, client, match, batch=REAP_BATCH_SIZE):
+        keys = []
+        cursor = 0
+        while True:
+            pipe = client.pipeline(transaction=False)
+            pipe.scan(cursor, match=match, count=batch)
+            (cursor, found), = yield pipe
+            keys.extend(key.decode() for key in found)
+            if cursor == 0:
+                return keys
+
+    def _op_get_members(self, key):
+        # The members of an index that has been a LIST, SET and ZSET across schema versions. A
+        # keyspace with no schema version may already have the newest layout, so the type is
+        # read before the members.
+        pipe = self._pipeline()
+        pipe.type(key)
+        key_type, = yield pipe
+        pipe = self._pipeline()
+        if key_type == b"list":
+            pipe.lrange(key, 0, -1)
+        elif key_type == b"set":
+            pipe.smembers(key)
+        elif key_type == b"zset":
+            pipe.zrange(key, 0, -1)
+        else:
+            return []
+        members, = yield pipe
+        return [m.decode() for m in members]
+
+    def _migrate_list_indexes(self):
+        # v1: hds/topics, hds/hosts and hds/topic/{topic}/hosts went from LIST to SET
+        yield from self._convert_list_to_set(K_TOPICS)
+        yield from self._convert_list_to_set(K_HOSTS)
+        for topic in (yield from self._op_get_members(K_TOPICS)):
+            yield from self._convert_list_to_set(K_TOPIC_HOSTS % topic)
+
+    def _migrate_state_hashes(self):
+        # v2: hds/host/{host}/state went from a LIST of keys, with each value in
+        # hds/host/{host}/state/{key}, to a single HASH of key => value
+        for server in (yield from self._op_get_members(K_HOSTS)):
+            keys_key = K_HOST_STATE % server
+            pipe = self._pipeline()
+            pipe.type(keys_key)
+            key_type, = yield pipe
+            if key_type not in (b"list", b"none"):
+                continue
+            pipe = self._pipeline()
+            pipe.lrange(keys_key, 0, -1)
+            keys, = yield pipe
+            keys = [k.decode() for k in keys]
+            if "hds.tombstone" not in keys:
+                keys.append("hds.tombstone")
+            legacy_keys = [K_LEGACY_HOST_STATE % (server, k) for k in keys]
+            pipe = self._pipeline()
+            pipe.mget(legacy_keys)
+            values, = yield pipe
+            mapping = {k: v for k, v in zip(keys, values) if v is not None}
+            tmp_key = keys_key + "/migrating"
+            pipe = self._pipeline(transaction=True)
+            pipe.delete(tmp_key)
+            if len(mapping) > 0:
+                pipe.hset(tmp_key, mapping=mapping)
+                pipe.rename(tmp_key, keys_key)
+            else:
+                pipe.delete(keys_key)
+            pipe.delete(*legacy_keys)
+            yield pipe
+            logger.debug("Moved %i state keys for %s into a hash", len(mapping), server[:16])
+
+    def _migrate_host_prefix_index(self):
+        # v3: hds/hosts went from a SET to a ZSET, so that find_host can search by prefix
+        yield from self._convert_set_to_lex_zset(K_HOSTS)
+
+    def _migrate_expiry_index(self):
+        # v4: Added hds/hosts/expiry and hds/host/{host}/topics
+        pipe = self._pipeline()
+        pipe.zrange(K_HOSTS, 0, -1)
+        hosts, = yield pipe
+        topics = yield from self._op_get_members(K_TOPICS)
+        pipe = self._pipeline()
+        for host in hosts:
+            pipe.hget(K_HOST_STATE % host.decode(), "hds.host")
+        for topic in topics:
+            pipe.smembers(K_TOPIC_HOSTS % topic)
+        results = yield pipe
+        pipe = self._pipeline()
+        for host, host_val in zip(hosts, results[:len(hosts)]):
+            if host_val is not None:
+                pipe.zadd(K_HOSTS_EXPIRY, {
+                    host: state_value_expires_at(parse_state_value(host_val))
+                })
+        for topic, topic_hosts in zip(topics, results[len(hosts):]):
+            for host in topic_hosts:
+                pipe.sadd(K_HOST_TOPICS % host.decode(), topic)
+        yield pipe
+
+    def _migrate_eviction_index(self):
+        # v5: Added hds/host/{host}/updated
+        pipe = self._pipeline()
+        pipe.zrange(K_HOSTS, 0, -1)
+        hosts, = yield pipe
+        hosts = [host.decode() for host in hosts]
+        pipe = self._pipeline()
+        for host in hosts:
+            pipe.hgetall(K_HOST_STATE % host)
+        results = yield pipe
+        pipe = self._pipeline()
+        for host, raw_state in zip(hosts, results):
+            updated = {
+                key: parse_state_value(raw)["hds.last_updated"]
+                for key, raw in raw_state.items() if key not in (b"hds.host", b"hds.tombstone")
+            }
+            if len(updated) > 0:
+                pipe.zadd(K_HOST_STATE_UPDATED % host, updated)
+        yield pipe
+
+    def _migrate_state_records(self):
+        # v6: State values went from HOST_STATE_FORMAT text to binary STATE_RECORDs
+        pipe = self._pipeline()
+        pipe.zrange(K_HOSTS, 0, -1)
+        hosts, = yield pipe
+        hosts = [host.decode() for host in hosts]
+        pipe = self._pipeline()
+        for host in hosts:
+            pipe.hgetall(K_HOST_STATE % host)
+        results = yield pipe
+        pipe = self._pipeline()
+        for host, raw_state in zip(hosts, results):
+            records = {}
+            for key, raw in raw_state.items():
+                if raw[0] == STATE_RECORD_VERSION:
+                    continue
+                entry = parse_state_value(raw)
+                records[key] = encode_state_value(
+                    entry["hds.signature"], entry["hds.ttl"], entry["hds.last_updated"],
+                    entry["value"])
+            if len(records) > 0:
+                pipe.hset(K_HOST_STATE % host, mapping=records)
+        yield pipe
+
+    def _migrate_subtopic_index(self):
+        # v7: Added hds/topic/{topic}/subtopics, and hds/topic/{topic}/hosts/{host}/subtopics
+        # went from reversed (LPUSH) to the given order (RPUSH)
+        for topic in (yield from self._op_get_members(K_TOPICS)):
+            pipe = self._pipeline()
+            pipe.exists(K_TOPIC_SUBTOPICS % topic)
+            pipe.smembers(K_TOPIC_HOSTS % topic)
+            indexed, hosts = yield pipe
+            if indexed:
+                continue
+            hosts = [host.decode() for host in hosts]
+            pipe = self._pipeline()
+            for host in hosts:
+                pipe.lrange(K_TOPIC_SUBTOPIC_HOSTS % (topic, host), 0, -1)
+            results = yield pipe
+            pipe = self._pipeline(transaction=True)
+            for host, subtopics in zip(hosts, results):
+                if len(subtopics) == 0:
+                    continue
+                subtopics.reverse()
+                pipe.delete(K_TOPIC_SUBTOPIC_HOSTS % (topic, host))
+                pipe.rpush(K_TOPIC_SUBTOPIC_HOSTS % (topic, host), *subtopics)
+                pipe.zadd(K_TOPIC_SUBTOPICS % topic, {
+                    subtopic + b"\0" + host.encode(): 0 for subtopic in subtopics
+                })
+            yield pipe
+
+    def _migrate_topic_index(self):
+        # v8: hds/topics went from a SET to a ZSET, so that find_topics can search by prefix
+        yield from self._convert_set_to_lex_zset(K_TOPICS)
+
+    def _migrate_server_ids(self):
+        # v9: Per-host keys went from the server name to the server ID, see host_key, and
+        # hds/server_ids was added. Keys are found by scanning, as tombstoned hosts that have been
+        # reaped are no longer in hds/hosts. Keys are renamed where they are found, and a sharded
+        # store's rebalance moves them on to their new shards.
+        servers = {}
+        for client in self._scan_clients():
+            keys = yield from self._op_scan(client, "hds/host/*")
+            keys += yield from self._op_scan(client, "hds/topic/*/host/*/signature")
+            keys += yield from self._op_scan(client, "hds/topic/*/hosts/*/subtopics")
+            pipe = client.pipeline(transaction=False)
+            for key in keys:
+                parts = key.split("/")
+                i = 2 if parts[1] == "host" else 4
+                if is_server_id(parts[i]):
+                    continue
+                servers[server_id(parts[i])] = parts[i]
+                parts[i] = server_id(parts[i])
+                pipe.rename(key, "/".join(parts))
+            renamed = len(pipe)
+            if renamed > 0:
+                yield pipe
+                logger.debug("Renamed %i keys", renamed)
+        if len(servers) > 0:
+            pipe = self._pipeline()
+            pipe.hset(K_SERVER_IDS, mapping=servers)
+            yield pipe
+
+    def _migrate_tombstone_index(self):
+        # v10: hds/tombstones was added, so that a sharded store can tell a host is tombstoned
+        # before its keys have been moved to the shard that now owns it
+        sids = []
+        for client in self._scan_clients():
+            keys = yield from self._op_scan(client, K_HOST_STATE % "*")
+            if len(keys) == 0:
+                continue
+            pipe = client.pipeline(transaction=False)
+            for key in keys:
+                pipe.hexists(key, "hds.tombstone")
+            tombstoned = yield pipe
+            sids += [key.split("/")[2] for key, t in zip(keys, tombstoned) if t]
+        if len(sids) > 0:
+            pipe = self._pipeline()
+            pipe.hmget(K_SERVER_IDS, sids)
+            servers, = yield pipe
+            servers = [server for server in servers if server is not None]
+            if len(servers) > 0:
+                pipe = self._pipeline()
+                pipe.sadd(K_TOMBSTONES, *servers)
+                yield pipe
+
+
+class RedisStore(BaseRedisStore):
+    def __init__(self, cache=None, replicas=REPLICAS):
         logger.info("Starting new redis store instance")
+        self._scripts = {}
+        self.cache = cache
 
         self.r = redis.Redis(
             host=HOST,
             port=PORT,
             password=PASSWORD)
+        self.replicas = [
+            redis.Redis(host=host, port=port, password=PASSWORD)
+            for host, port in map(parse_redis_address, replicas)
+        ]
+        self._next_replica = 0
+        # Cache key => time.monotonic() until which it is read from the primary
+        self._recent_writes = OrderedDict()
+
+        logger.info("Connecting to %s (%i replicas)", HOST, len(self.replicas))
 
-        logger.info("Connecting to %s", HOST)
+    def _run(self, op):
+        try:
+            pipe = next(op)
+            while True:
+                pipe = op.send(pipe.execute())
+        except StopIteration as ex:
+            return ex.value
 
     def get_topics(self):
         """
@@ -57,42 +979,46 @@ class RedisStore():
 
         :return: A list of topic strings
         """
-        logger.debug("redis://%s" % K_TOPICS)
-        return [t.decode() for t in self.r.lrange(K_TOPICS, 0, -1)]
+        return self._run(self._op_get_topics())
+
+    def find_topics(self, pattern, limit=TOPIC_QUERY_LIMIT, after=None):
+        """
+        Find topics matching a pattern, see compile_topic_pattern. Only topics sharing the
+        literal prefix of the pattern are read.
+
+        :param pattern: The topic pattern string, e.g. "uk.half-shot.*"
+        :param limit: The most topics to return
+        :param after: Only return topics after this one, to continue from a previous call
+        :return: A sorted list of topic strings
+        """
+        return self._run(self._op_find_topics(pattern, limit, after))
 
     def get_topic_hosts(self, topic, subtopics=None):
         """
-        Get all hosts which implement the topic, and optionally the subtopics(s).
+        Get all hosts which implement the topic, or only those with a subtopic at or below a
+        subtopic path.
 
         :param topic: A topic string
-        :param subtopic: A list of subtopics. Optional
+        :param subtopics: A "/" separated subtopic path like "local/portsmouth", or a list of its
+                          segments, which are joined. Optional, see subtopic_path
         :return: A dict of hosts
         """
-        path = K_TOPIC_HOSTS % topic
-        topic_hosts = [host.decode() for host in self.r.lrange(path, 0, -1)
-                       if not self.has_host_expired(host.decode()) and
-                       not self.is_host_tombstoned(host.decode(), throw=False)]
-        hosts = {}
-        for host in topic_hosts:
-            sig = self.r.get(K_TOPIC_HOST_SIG % (topic, host)).decode()
-            host_entry = {
-                "hds.signature": sig,
-            }
+        return self._run(self._op_get_topic_hosts(topic, subtopics))
 
-            host_entry["subtopics"] = [
-                s.decode() for s in self.r.lrange(K_TOPIC_SUBTOPIC_HOSTS % (topic, host), 0, -1)
-            ]
-            print(topic, subtopics)
-            print(host, host_entry)
-
-            if subtopics is not None:
-                for i in range(len(subtopics)):
-                    if subtopics[i] not in host_entry["subtopics"][i]:
-                        host_entry = None
-                        break
-            if host_entry is not None:
-                hosts[host] = host_entry
-        return hosts
+    def get_topic_hosts_page(self, topic, subtopics=None, cursor=None, count=HOST_PAGE_SIZE):
+        """
+        Get one page of the hosts of a topic, as get_topic_hosts. Pages are walked with a cursor,
+        so the whole listing is never held at once. A page may be empty while there are more to
+        come, and when a subtopic is given a host may be repeated in a later page with further
+        matching subtopics.
+
+        :param topic: A topic string
+        :param subtopics: A subtopic path or list of its segments, as get_topic_hosts. Optional
+        :param cursor: The cursor returned with the previous page, or None for the first page
+        :param count: Roughly how many hosts to return
+        :return: A tuple of a dict of hosts, and the cursor of the next page or None if done
+        """
+        return self._run(self._op_get_topic_hosts_page(topic, subtopics, cursor, count))
 
     def store_host_topic(self, server, topic: str, subtopics: list, signature):
         """
@@ -104,24 +1030,7 @@ class RedisStore():
         :param signature: Signature of the payload
         :return:
         """
-        self.is_host_tombstoned(server)
-        # Store the topic in the master list if its not there already
-        if topic not in [t.decode() for t in self.r.lrange(K_TOPICS, 0, -1)]:
-            logger.debug("Added %s to %s" % (topic, K_TOPICS))
-            self.r.lpush(K_TOPICS, topic)
-
-        # Store the host in the topic
-        if server not in [s.decode() for s in self.r.lrange(K_TOPIC_HOSTS % topic, 0, -1)]:
-            logger.debug("Added %s/%s to %s" % (topic, server, K_TOPIC_HOSTS % topic))
-            self.r.lpush(K_TOPIC_HOSTS % topic, server)
-
-        if len(subtopics) > 0:
-            self.r.delete(K_TOPIC_SUBTOPIC_HOSTS % (topic, server))
-            for subtopic in subtopics:
-                self.r.lpush(K_TOPIC_SUBTOPIC_HOSTS % (topic, server), subtopic)
-                print(K_TOPIC_SUBTOPIC_HOSTS % (topic, server), subtopics)
-
-        self.r.set(K_TOPIC_HOST_SIG % (topic, server), signature)
+        return self._run(self._op_store_host_topic(server, topic, subtopics, signature))
 
     def get_host_state(self, server):
         """
@@ -130,25 +1039,36 @@ class RedisStore():
         :param server: The server name string
         :return: A object containing all the state of the host
         """
-        server = self.find_host(server)
-        state = {
-            "hds.expired": [],
-        }
-        # Get all keys
-        for key in self.r.lrange(K_HOST_STATE_KEYS % server, 0, -1):
-            key = key.decode()
-            vals = self.r.get(K_HOST_STATE % (server, key)).decode().split(":", 3)
-            ttl = int(vals[1])
-            last_updated = int(vals[2])
-            state[key] = {
-                "hds.signature": vals[0],
-                "hds.ttl": ttl,
-                "hds.last_updated": last_updated,
-                "value": vals[3],
-            }
-            if curr_time() - last_updated > ttl:
-                state["hds.expired"].append(key)
-        return state
+        return self._run(self._op_get_host_state(server))
+
+    def get_versioned_host_state(self, server):
+        """
+        Get the full state of a given host, as get_host_state, along with its version. The
+        version changes whenever the state is written, but not when keys expire.
+
+        :param server: The server name string
+        :return: A tuple of the state object, and the version number
+        """
+        return self._run(self._op_get_versioned_host_state(server))
+
+    def get_topics_version(self):
+        """
+        Get the version of the topic list, which changes whenever a topic is added.
+
+        :return: The version number
+        """
+        return self._run(self._op_get_topics_version())
+
+    def get_host_states(self, servers):
+        """
+        Get the full state of several hosts in a single round-trip. Unlike get_host_state,
+        the server names must be complete.
+
+        :param servers: A list of server name strings
+        :return: A dict of server name => state object, as returned by get_host_state.
+                 Hosts with no state are omitted.
+        """
+        return self._run(self._op_get_host_states(servers))
 
     def has_host_expired(self, server):
         """
@@ -157,10 +1077,7 @@ class RedisStore():
 
         :return: True if expired, False otherwise
         """
-        vals = self.r.get(K_HOST_STATE % (server, "hds.host")).decode().split(":", 3)
-        ttl = int(vals[1]) * 1000
-        last_updated = int(vals[2])
-        return curr_time() - last_updated > ttl
+        return self._run(self._op_has_host_expired(server))
 
     def find_host(self, server):
         """
@@ -170,15 +1087,7 @@ class RedisStore():
         :param server: The server name string, either partial or full
         :return: A full server name.
         """
-        servers = [
-            s.decode() for s in self.r.lrange(K_HOSTS, 0, -1) if s.decode().startswith(server)]
-        if len(servers) == 0:
-            raise HDSFailure("No hosts found", type="hds.error.hosts.none")
-        elif len(servers) > 1:
-            raise HDSFailure(
-                "Multiple hosts found matching that ID",
-                type="hds.error.hosts.conflict")
-        return servers[0]
+        return self._run(self._op_find_host(server))
 
     def store_host_state(self, server, key, value, ttl, signature, last_updated=None):
         """
@@ -191,44 +1100,29 @@ class RedisStore():
         :param signature: The signature of the key value set
         :param last_updated: The time of the state update, will use current time if not defined
         """
-        self.is_host_tombstoned(server)
-        last_updated = curr_time() if last_updated is None else last_updated
-        store_val = HOST_STATE_FORMAT % (signature, ttl, last_updated, value)
-        existing_keys = [s.decode() for s in self.r.lrange(K_HOST_STATE_KEYS % server, 0, -1)]
-        if server not in [s.decode() for s in self.r.lrange(K_HOSTS, 0, -1)]:
-            self.r.lpush(K_HOSTS, server)
-        if key not in existing_keys:
-            logger.debug("Added new key %s to %s" % (key, server[:16]))
-            self.r.lpush(K_HOST_STATE_KEYS % server, key)
-        logger.debug("Updated key %s for %s" % (key, server[:16]))
-        self.r.set(K_HOST_STATE % (server, key), store_val)
-        self._check_host_state_size(server, len(existing_keys))
+        return self._run(self._op_store_host_state(
+            server, key, value, ttl, signature, last_updated))
 
     def is_host_tombstoned(self, server, throw=True):
-        if self.r.get(K_HOST_STATE % (server, "hds.tombstone")) is not None:
-            if throw:
-                raise HDSFailure("Host is tombstoned, it cannot be used",
-                                 type="hds.error.host.tombstone")
-            return True
-        return False
+        return self._run(self._op_is_host_tombstoned(server, throw))
+
+    def reap_expired_hosts(self, grace=REAP_GRACE_MS, limit=REAP_BATCH_SIZE):
+        """
+        Purge hosts whose hds.host has been expired for longer than the grace period, removing
+        them from all topics and indexes. Tombstoned hosts keep their state.
 
-    def _check_host_state_size(self, server, keysize: int):
-        if keysize > STATE_STORAGE_LIMIT:
-            full_state = self.get_host_state(server)
-            while len(full_state.keys()) > STATE_STORAGE_LIMIT + 1:  # + 1 for hds.expired
-                key_to_remove = None
-                oldest_ts = 9223372036854775807  # maxint
-                # TODO: refactor this
-                for k, v in full_state.items():
-                    if k == "hds.expired" or k == "hds.host":
-                        continue
-                    upd = v.get("hds.last_updated")
-                    if upd < oldest_ts:
-                        oldest_ts = upd
-                        key_to_remove = k
-                logger.debug(
-                    "Removed key %s for %s as it has exceeded the key count" %
-                    (key_to_remove, server)
-                )
-                del full_state[key_to_remove]
-                self.r.lrem(K_HOST_STATE_KEYS % server, 1, key_to_remove)
+        :param grace: How long, in milliseconds, the host must have been expired for
+        :param limit: The maximum number of hosts to purge in one go
+        :return: A list of purged server names
+        """
+        return self._run(self._op_reap_expired_hosts(grace, limit))
+
+    def migrate(self):
+        """
+        Bring an existing keyspace up to SCHEMA_VERSION. Each migration step is run once, in
+        order, and the version is recorded in hds/schema_version so that restarting the
+        service is a no-op.
+
+        :return: The schema version the store is now at
+        """
+        return self._run(self._op_migrate())
@@ -0,0 +1,438 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import redis
+
+from . import redis_scripts
+from .async_redis_store import AsyncRedisStore, MAX_CONNECTIONS
+from .redis_store import (RedisStore, BaseRedisStore, PASSWORD, K_HOSTS, K_HOSTS_EXPIRY,
+                          K_HOST_STATE, K_HOST_STATE_UPDATED, K_HOST_TOPICS, K_TOPICS,
+                          K_TOPIC_HOSTS, K_TOPIC_HOST_SIG, K_TOPIC_SUBTOPIC_HOSTS,
+                          K_TOPIC_SUBTOPICS, K_INVALIDATE, K_SERVER_IDS, K_HOST_VERSION,
+                          K_TOPICS_VERSION, K_TOMBSTONES, STATE_STORAGE_LIMIT, REAP_GRACE_MS,
+                          REAP_BATCH_SIZE, curr_time, encode_state_value, raise_tombstoned,
+                          parse_redis_address, parse_state_value, state_value_expires_at,
+                          host_key, topic_host_key)
+from ..util import server_id
+
+# Comma separated host:port list. The first shard is the coordinator.
+SHARDS = [s for s in os.environ.get("REDIS_SHARDS", "").split(",") if s != ""]
+# Points each shard is given on the hash ring. More points spread hosts more evenly.
+RING_VNODES = 160
+REBALANCE_BATCH_SIZE = 100
+# Every key under this prefix belongs to the host whose server ID is the next segment
+K_HOST_PREFIX = "hds/host/"
+# The first schema version that could have been written by a sharded store. Older keyspaces
+# were written by a single RedisStore, so are all on the coordinator.
+SHARDED_SCHEMA_VERSION = 9
+
+logger = logging.getLogger(__name__)
+
+# The sharded stores partition the keyspace of RedisStore across several redis instances:
+#
+# hds/host/{server id}/* => The shard that owns {server id} on the ShardRing
+# everything else => The coordinator shard. This is the topic and host indexes, the schema
+#                    version and the invalidation channel.
+#
+# Writes touching both halves run the host half first, so a tombstoned host never reaches the
+# indexes, but the two halves are not atomic with each other.
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+def merge_state_args(moved, current):
+    """
+    :param moved: A state hash moved from another shard
+    :param current: The same host's state hash on its new shard
+    :return: The field arguments of MERGE_SHARD_HOST_STATE, for each moved field that is newer
+    """
+    args = []
+    for field, raw in moved.items():
+        last_updated = parse_state_value(raw)["hds.last_updated"]
+        existing = current.get(field)
+        if existing is not None and parse_state_value(existing)["hds.last_updated"] >= last_updated:
+            continue
+        args += [field, existing or b"", raw,
+                 b"" if field in (b"hds.host", b"hds.tombstone") else last_updated]
+    return args
+
+
+class ShardRing():
+    """
+    A consistent hash ring of shard names. Each shard is placed at several points on the ring,
+    and a server belongs to the shard at the first point after the hash of its server ID. Adding
+    a shard only moves the servers that now land on one of its points.
+    """
+
+    def __init__(self, shards=(), vnodes=RING_VNODES):
+        self.vnodes = vnodes
+        self.points = []
+        self.__hashes = []
+        for shard in shards:
+            self.add(shard)
+
+    def add(self, shard):
+        for i in range(self.vnodes):
+            bisect.insort(self.points, (ring_hash("%s#%i" % (shard, i)), shard))
+        self.__hashes = [point for point, _ in self.points]
+
+    def get(self, server):
+        """
+        :param server: The server ID string
+        :return: The name of the shard that owns the server
+        """
+        i = bisect.bisect(self.__hashes, ring_hash(server)) % len(self.points)
+        return self.points[i][1]
+
+
+class ShardedPipeline():
+    """
+    A pipeline that routes each command to the shard owning its first key, and puts the replies
+    back in the order the commands were queued. It only supports commands whose keys all live
+    on the same shard, which is true of every command the stores issue.
+    """
+
+    def __init__(self, store, transaction=False):
+        self.store = store
+        self.transaction = transaction
+        self.pipes = {}
+        self.order = []
+
+    def route(self, shard):
+        """
+        Get the pipeline for a shard, for exactly one command to be queued on.
+        """
+        pipe = self.pipes.get(shard)
+        if pipe is None:
+            pipe = self.pipes[shard] = self.store.shards[shard].pipeline(
+                transaction=self.transaction)
+        self.order.append((shard, len(pipe)))
+        return pipe
+
+    def __getattr__(self, command):
+        def queue(key, *args, **kwargs):
+            getattr(self.route(self.store._shard_for_key(key)), command)(key, *args, **kwargs)
+            return self
+        return queue
+
+    def _collate(self, results):
+        return [results[shard][i] for shard, i in self.order]
+
+    def execute(self):
+        return self._collate({shard: pipe.execute() for shard, pipe in self.pipes.items()})
+
+
+class AsyncShardedPipeline(ShardedPipeline):
+    async def execute(self):
+        shards = list(self.pipes.keys())
+        results = await asyncio.gather(*[self.pipes[shard].execute() for shard in shards])
+        return self._collate(dict(zip(shards, results)))
+
+
+class BaseShardedRedisStore(BaseRedisStore):
+    """
+    Store logic shared by ShardedRedisStore and AsyncShardedRedisStore. Operations are those of
+    BaseRedisStore, run over a ShardedPipeline.
+    """
+
+    PIPELINE = ShardedPipeline
+    # Set while migrating a keyspace from before SHARDED_SCHEMA_VERSION, to send every command
+    # to the coordinator
+    _unsharded = False
+
+    def _init_shards(self, shards):
+        if len(shards) == 0:
+            raise Exception("No redis shards given, cannot continue")
+        self._scripts = {}
+        self.shards = {}
+        self.ring = ShardRing()
+        self.coordinator = shards[0]
+        for shard in shards:
+            self.add_shard(shard)
+        logger.info("Sharding across %s, coordinator is %s", ", ".join(shards), self.coordinator)
+
+    @property
+    def r(self):
+        return self.shards[self.coordinator]
+
+    def add_shard(self, shard, client=None):
+        """
+        Add a shard to the ring. Hosts that now belong to it will not be found there until
+        rebalance has been run.
+
+        :param shard: The host:port of the shard
+        :param client: A redis client to use, rather than connecting to the shard
+        """
+        self.shards[shard] = client if client is not None else self._connect_shard(shard)
+        self.ring.add(shard)
+
+    def _shard_for_key(self, key):
+        if key.startswith(K_HOST_PREFIX):
+            return self.ring.get(key.split("/")[2])
+        return self.coordinator
+
+    def _pipeline(self, transaction=False):
+        if self._unsharded:
+            return self.r.pipeline(transaction=transaction)
+        return self.PIPELINE(self, transaction=transaction)
+
+    def _scan_clients(self):
+        if self._unsharded:
+            return [self.r]
+        return list(self.shards.values())
+
+    def _op_migration_step(self, step_version, step):
+        self._unsharded = step_version < SHARDED_SCHEMA_VERSION
+        try:
+            yield from super()._op_migration_step(step_version, step)
+        finally:
+            self._unsharded = False
+
+    def _queue_script(self, pipe, source, keys, args):
+        # Every key given to a script must be on the same shard
+        super()._queue_script(pipe.route(self._shard_for_key(keys[0])), source, keys, args)
+
+    def _op_is_host_tombstoned(self, server, throw=True):
+        # Until a rebalance has moved its keys, the shard that now owns a host may not know it is
+        # tombstoned, so ask the coordinator
+        pipe = self._pipeline()
+        pipe.sismember(K_TOMBSTONES, server)
+        tombstoned, = yield pipe
+        if tombstoned:
+            if throw:
+                raise_tombstoned()
+            return True
+        return False
+
+    def _op_store_host_topic(self, server, topic, subtopics, signature):
+        yield from self._op_is_host_tombstoned(server)
+        pipe = self._pipeline()
+        self._queue_script(
+            pipe, redis_scripts.STORE_SHARD_HOST_TOPIC,
+            [host_key(K_HOST_STATE, server), host_key(K_HOST_TOPICS, server)], [topic])
+        tombstoned, = yield pipe
+        if tombstoned:
+            raise_tombstoned()
+        pipe = self._pipeline()
+        self._queue_script(
+            pipe, redis_scripts.STORE_COORDINATOR_TOPIC,
+            [K_TOPICS, K_TOPIC_HOSTS % topic, topic_host_key(K_TOPIC_SUBTOPIC_HOSTS, topic, server),
+             topic_host_key(K_TOPIC_HOST_SIG, topic, server), K_TOPIC_SUBTOPICS % topic,
+             K_TOPICS_VERSION],
+            [server, topic, signature, K_INVALIDATE] + list(subtopics))
+        (new_topic, new_host), = yield pipe
+        self._stored_host_topic(server, topic, new_topic, new_host)
+
+    def _op_store_host_state(self, server, key, value, ttl, signature, last_updated=None):
+        last_updated = curr_time() if last_updated is None else last_updated
+        yield from self._op_is_host_tombstoned(server)
+        pipe = self._pipeline()
+        self._queue_script(
+            pipe, redis_scripts.STORE_SHARD_HOST_STATE,
+            [host_key(K_HOST_STATE, server), host_key(K_HOST_STATE_UPDATED, server),
+             host_key(K_HOST_VERSION, server), host_key(K_HOST_TOPICS, server)],
+            [key, encode_state_value(signature, ttl, last_updated, value), last_updated,
+             STATE_STORAGE_LIMIT, curr_time()])
+        (tombstoned, added, evicted, topics), = yield pipe
+        if tombstoned:
+            raise_tombstoned()
+        pipe = self._pipeline()
+        pipe.zadd(K_HOSTS, {server: 0})
+        pipe.hsetnx(K_SERVER_IDS, server_id(server), server)
+        if key == "hds.tombstone":
+            pipe.sadd(K_TOMBSTONES, server)
+            for topic in topics:
+                pipe.publish(K_INVALIDATE, "topic/%s/" % topic.decode())
+        if key == "hds.host":
+            pipe.zadd(K_HOSTS_EXPIRY, {server: last_updated + ttl * 1000})
+            pipe.publish(K_INVALIDATE, "topic/")
+        pipe.publish(K_INVALIDATE, "host/" + server)
+        yield pipe
+        self._stored_host_state(server, key, added, evicted, topics)
+
+    def _op_reap_expired_hosts(self, grace=REAP_GRACE_MS, limit=REAP_BATCH_SIZE):
+        cutoff = curr_time() - grace
+        pipe = self._pipeline()
+        pipe.zrangebyscore(K_HOSTS_EXPIRY, "-inf", cutoff, start=0, num=limit)
+        expired, = yield pipe
+        expired = [host.decode() for host in expired]
+        if len(expired) == 0:
+            return []
+        pipe = self._pipeline()
+        pipe.smismember(K_TOMBSTONES, expired)
+        for host in expired:
+            pipe.hget(host_key(K_HOST_STATE, host), "hds.host")
+        tombstones, *hostnames = yield pipe
+        # Hosts refreshed since they were found are skipped here, and the host's shard only
+        # removes it if hds.host is as read here. The coordinator checks the expiry again before
+        # unindexing it, in case it is refreshed in between.
+        expired = [
+            (host, hostname, tombstoned)
+            for host, hostname, tombstoned in zip(expired, hostnames, tombstones)
+            if hostname is None or state_value_expires_at(parse_state_value(hostname)) <= cutoff
+        ]
+        pipe = self._pipeline()
+        for host, hostname, tombstoned in expired:
+            self._queue_script(
+                pipe, redis_scripts.REAP_SHARD_HOST,
+                [host_key(K_HOST_STATE, host), host_key(K_HOST_TOPICS, host),
+                 host_key(K_HOST_STATE_UPDATED, host), host_key(K_HOST_VERSION, host)],
+                [hostname or b"", 1 if tombstoned else 0])
+        results = yield pipe
+        reaped = [(host, topics) for (host, _, _), (ok, topics) in zip(expired, results) if ok]
+        pipe = self._pipeline()
+        for host, topics in reaped:
+            self._queue_script(
+                pipe, redis_scripts.REAP_COORDINATOR_HOST,
+                [K_HOSTS_EXPIRY, K_HOSTS, K_TOMBSTONES, K_SERVER_IDS],
+                [host, server_id(host), cutoff] + self._reap_args() + topics)
+        pipe.publish(K_INVALIDATE, "topic/")
+        yield pipe
+        return self._reaped_hosts([host for host, _ in reaped])
+
+    def _op_rebalance(self, batch=REBALANCE_BATCH_SIZE):
+        moved = 0
+        for shard in list(self.shards.keys()):
+            cursor = 0
+            while True:
+                pipe = self.shards[shard].pipeline(transaction=False)
+                pipe.scan(cursor, match=K_HOST_PREFIX + "*", count=batch)
+                (cursor, keys), = yield pipe
+                keys = [key.decode() for key in keys]
+                keys = [key for key in keys if self._shard_for_key(key) != shard]
+                if len(keys) > 0:
+                    moved += yield from self._op_move_keys(shard, keys)
+                if cursor == 0:
+                    break
+        if moved > 0:
+            logger.info("Moved %i keys to their new shards", moved)
+        return moved
+
+    def _op_move_keys(self, shard, keys):
+        source = self.shards[shard]
+        # A state hash is merged with its eviction index, so they are always moved together
+        keys = set(keys)
+        for key in list(keys):
+            sid = key.split("/")[2]
+            if key in (K_HOST_STATE % sid, K_HOST_STATE_UPDATED % sid):
+                keys.update((K_HOST_STATE % sid, K_HOST_STATE_UPDATED % sid))
+        keys = sorted(keys)
+        pipe = source.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+        key_types = yield pipe
+        found = [(key, key_type) for key, key_type in zip(keys, key_types) if key_type != b"none"]
+        if len(found) == 0:
+            return 0
+        keys, key_types = zip(*found)
+        pipe = source.pipeline(transaction=False)
+        for key, key_type in zip(keys, key_types):
+            if key_type == b"hash":
+                pipe.hgetall(key)
+            elif key_type == b"set":
+                pipe.smembers(key)
+            elif key_type == b"zset":
+                pipe.zrange(key, 0, -1, withscores=True)
+            elif key_type == b"string":
+                pipe.get(key)
+            else:
+                pipe.dump(key)
+        values = yield pipe
+        # State on the new shard was written after it was added, but may still be older than
+        # the moved copy, so each field is compared
+        pipe = self._pipeline()
+        for key, key_type in zip(keys, key_types):
+            if key_type == b"hash":
+                pipe.hgetall(key)
+        current = iter((yield pipe))
+        # Merge into the new shard, the newest of each value winning
+        pipe = self._pipeline()
+        for key, key_type, value in zip(keys, key_types, values):
+            sid = key.split("/")[2]
+            if key_type == b"hash":
+                self._queue_script(
+                    pipe, redis_scripts.MERGE_SHARD_HOST_STATE,
+                    [key, K_HOST_STATE_UPDATED % sid],
+                    [STATE_STORAGE_LIMIT] + merge_state_args(value, next(current)))
+            elif key == K_HOST_STATE_UPDATED % sid:
+                # Merged along with the state
+                continue
+            elif key_type == b"set" and len(value) > 0:
+                pipe.sadd(key, *value)
+            elif key_type == b"zset" and len(value) > 0:
+                pipe.zadd(key, dict(value), gt=True)
+            elif key_type == b"string" and value is not None:
+                pipe.set(key, value, nx=True)
+            elif value is not None:
+                pipe.restore(key, 0, value, replace=True)
+        yield pipe
+        pipe = source.pipeline(transaction=False)
+        pipe.delete(*keys)
+        yield pipe
+        # Cached state is keyed by the server name
+        pipe = self._pipeline()
+        pipe.hmget(K_SERVER_IDS, list(set(key.split("/")[2] for key in keys)))
+        servers, = yield pipe
+        for server in servers:
+            if server is not None:
+                self._invalidate("host/" + server.decode())
+        return len(keys)
+
+
+class ShardedRedisStore(BaseShardedRedisStore, RedisStore):
+    """
+    A RedisStore whose per-host keys are spread over several redis instances by consistent
+    hashing on the server ID. The topic and host indexes live on the first, coordinator,
+    shard.
+    """
+
+    def __init__(self, shards=SHARDS, cache=None):
+        logger.info("Starting new sharded redis store instance")
+        self.cache = cache
+        self._init_shards(shards)
+
+    def _connect_shard(self, shard):
+        host, port = parse_redis_address(shard)
+        return redis.Redis(host=host, port=port, password=PASSWORD)
+
+    def rebalance(self, batch=REBALANCE_BATCH_SIZE):
+        """
+        Move every host key that is not on the shard that owns it, after a shard has been
+        added. It is safe to run while writes are being made, and to run again.
+
+        :param batch: How many keys to scan at a time on each shard
+        :return: The number of keys moved
+        """
+        return self._run(self._op_rebalance(batch))
+
+
+class AsyncShardedRedisStore(BaseShardedRedisStore, AsyncRedisStore):
+    """
+    An asyncio version of ShardedRedisStore. Commands for different shards in the same
+    round-trip are sent concurrently.
+    """
+
+    PIPELINE = AsyncShardedPipeline
+
+    def __init__(self, shards=SHARDS, max_connections=MAX_CONNECTIONS, cache=None):
+        logger.info("Starting new async sharded redis store instance")
+        self.cache = cache
+        self.max_connections = max_connections
+        self._init_shards(shards)
+
+    def _connect_shard(self, shard):
+        return self._connect(*parse_redis_address(shard), self.max_connections)
+
+    async def close(self):
+        for client in self.shards.values():
+            await client.aclose()
+
+    async def rebalance(self, batch=REBALANCE_BATCH_SIZE):
+        """
+        See ShardedRedisStore.rebalance
+        """
+        return await self._run(self._op_rebalance(batch))
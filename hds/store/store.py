@@ -2,9 +2,9 @@ import pymongo
 import os
 import logging
 import time
-import re
 
 from ..util import HDSFailure
+from .redis_store import compile_topic_pattern, TOPIC_QUERY_LIMIT
 
 logger = logging.getLogger(__name__)
 MONGOSTRING = os.environ.get("MONGOSTRING")
@@ -24,31 +24,51 @@ class Store():
             [('topic', pymongo.ASCENDING)],
             unique=True
         )
-        self.db.get_collection("server").create_index(
+        # Hosts are looked up by prefix with a range over this index, see find_host
+        self.db.get_collection("hosts").create_index(
             [('server', pymongo.ASCENDING)],
             unique=True
         )
 
     def get_topics(self):
-        db = self.client.get_database()
         topics = []
-        for topic in db.get_collection("topics").find():
+        for topic in self.db.get_collection("topics").find({}, {"topic": 1, "_id": 0}):
             topics.append(self.unescape_field_name(topic["topic"]))
         return topics
 
+    def find_topics(self, pattern, limit=TOPIC_QUERY_LIMIT, after=None):
+        """
+        See RedisStore.find_topics
+        """
+        literal, regex = compile_topic_pattern(pattern)
+        literal = self.escape_field_name(literal)
+        query = {"$gte": literal}
+        if len(literal) > 0:
+            query["$lt"] = literal[:-1] + chr(ord(literal[-1]) + 1)
+        # Escaping keeps prefixes, so the range finds the topics sharing the literal prefix, but
+        # "．" and "＄" don't sort like "." and "$". The topics are ordered and paged by their real
+        # names instead, as the other stores do.
+        topics = (
+            self.unescape_field_name(topic["topic"])
+            for topic in self.db.get_collection("topics").find(
+                {"topic": query}, {"topic": 1, "_id": 0})
+        )
+        return sorted(
+            topic for topic in topics
+            if regex.fullmatch(topic) and (after is None or topic > after)
+        )[:limit]
+
     def get_topic_hosts(self, topic, subtopic=None):
         topic = self.escape_field_name(topic)
         if subtopic is not None:
             subtopic = self.unescape_field_name(subtopic)
         db_topic: dict = self.db.get_collection("topics").find_one({
             "topic": topic,
-        })
+        }, {"_id": 0, "topic": 0})
         if db_topic is None:
             return None
         hosts = {}
         for servername, details in db_topic.items():
-            if servername == "_id" or servername == "topic":
-                continue
             if subtopic is not None:
                 match = False
                 for x in details["subtopics"]:
@@ -61,7 +81,7 @@ class Store():
         return hosts
 
     def store_host_topic(self, server, topic: str, subtopics: list, signature):
-        topics = self.client.get_database().get_collection("topics")
+        topics = self.db.get_collection("topics")
         topic = self.escape_field_name(topic)
         subtopics = [self.escape_field_name(x) for x in subtopics]
         topics.update_one({
@@ -78,25 +98,70 @@ class Store():
             }
         }, upsert=True)
 
-    def get_host_state(self, server):
-        hosts = self.client.get_database().get_collection("hosts")
-        regx = re.compile("^" + server)
-        results: dict = hosts.count_documents({"server": regx})
-        if results == 0:
+    def find_host(self, server):
+        """
+        Find a host by a partial or full servername. Will return a match if exactly
+        one hosts matches, otherwise will throw a HDSFailure exception.
+
+        :param server: The server name string, either partial or full
+        :return: A full server name.
+        """
+        return self.find_host_document(server)["server"]
+
+    def find_host_document(self, server, projection=None):
+        """
+        Find a host document with a single range query over the server index. An exact
+        match wins over longer servernames sharing the prefix.
+
+        :param server: The server name string, either partial or full
+        :param projection: Fields of the host document to return. Defaults to just the server
+        :return: The host document
+        """
+        query = {"$gte": server}
+        if len(server) > 0:
+            # The first string after every string starting with server
+            query["$lt"] = server[:-1] + chr(ord(server[-1]) + 1)
+        db_hosts = list(self.db.get_collection("hosts").find(
+            {"server": query},
+            projection if projection is not None else {"server": 1, "_id": 0},
+        ).sort("server", pymongo.ASCENDING).limit(2))
+        if len(db_hosts) == 0:
             raise HDSFailure("No hosts found", type="hds.error.hosts.none")
-        elif results > 1:
+        elif len(db_hosts) > 1 and db_hosts[0]["server"] != server:
             raise HDSFailure(
                 "Multiple hosts found matching that ID",
                 type="hds.error.hosts.conflict")
+        return db_hosts[0]
+
+    def get_host_state(self, server):
+        db_host = self.find_host_document(server, {"_id": 0})
+        return self.build_host_state(db_host)
 
-        db_host = hosts.find_one({"server": regx})
+    def get_host_states(self, servers):
+        """
+        Get the full state of several hosts in a single query. Unlike get_host_state,
+        the server names must be complete.
 
+        :param servers: A list of server name strings
+        :return: A dict of server name => state object, as returned by get_host_state.
+        """
+        db_hosts = self.db.get_collection("hosts").find(
+            {"server": {"$in": list(servers)}}, {"_id": 0})
+        return {db_host["server"]: self.build_host_state(db_host) for db_host in db_hosts}
+
+    def has_host_expired(self, server):
+        db_host = self.db.get_collection("hosts").find_one(
+            {"server": server}, {"_id": 0, self.escape_field_name("hds.host"): 1})
         if db_host is None:
-            return None
+            return True
+        state = self.build_host_state(db_host)
+        return "hds.host" not in state or "hds.host" in state["hds.expired"]
 
+    def build_host_state(self, db_host):
         host = {
             "hds.expired": [],
         }
+        now = int(time.time() * 1000)
         for k in db_host.keys():
             val = db_host.get(k)
             if not isinstance(val, dict):
@@ -106,32 +171,47 @@ class Store():
                 "value": val.get("value"),
                 "hds.signature": val.get("signature"),
                 "hds.ttl": val.get("ttl"),
+                "hds.last_updated": val.get("last_updated"),
             }
-            if int(time.time() * 1000) - val.get("last_updated") > (val.get("ttl") * 1000):
-                host["hds.expired"].append(key)
+            if now - val.get("last_updated") > (val.get("ttl") * 1000):
                 host["hds.expired"].append(key)
         return host
 
-    def store_host_state(self, server, key, value, ttl, signature):
-        hosts = self.client.get_database().get_collection("hosts")
-        key = self.escape_field_name(key)
-        if not isinstance(value, str) and not isinstance(value, int):
-            raise Exception("Cannot store values that are not strings or integers")
-        hosts.update_one({
-            "server": server,
-        }, {
-            "$setOnInsert": {
-                "server": server,
-            },
-            "$set": {
-                key: {
-                    "value": value,
-                    "ttl": ttl,
-                    "signature": signature,
-                    "last_updated": int(time.time() * 1000)  # We want the milliseconds kept
-                }
+    def store_host_state(self, server, key, value, ttl, signature, last_updated=None):
+        self.store_host_states([(server, key, value, ttl, signature, last_updated)])
+
+    def store_host_states(self, states):
+        """
+        Store many state keys, for any number of hosts, in one bulk write. Keys for the same
+        host are folded into a single update.
+
+        :param states: A list of (server, key, value, ttl, signature, last_updated) tuples.
+                       last_updated may be None, to use the current time
+        """
+        now = int(time.time() * 1000)  # We want the milliseconds kept
+        updates = {}
+        for server, key, value, ttl, signature, last_updated in states:
+            if not isinstance(value, str) and not isinstance(value, int):
+                raise Exception("Cannot store values that are not strings or integers")
+            updates.setdefault(server, {})[self.escape_field_name(key)] = {
+                "value": value,
+                "ttl": ttl,
+                "signature": signature,
+                "last_updated": now if last_updated is None else int(last_updated),
             }
-        }, upsert=True)
+        if len(updates) == 0:
+            return
+        self.db.get_collection("hosts").bulk_write([
+            pymongo.UpdateOne({
+                "server": server,
+            }, {
+                "$setOnInsert": {
+                    "server": server,
+                },
+                "$set": fields,
+            }, upsert=True)
+            for server, fields in updates.items()
+        ], ordered=False)
 
     def escape_field_name(self, field: str):
         if "．" in field or "＄" in field:
@@ -1,9 +1,18 @@
 from .util import (HDSFailure, HDSBadKeyFailure,
-                   verify_payload,
+                   verify_payload, verify_payloads, load_public_key, public_key_cache_info,
+                   verified_signatures, server_id, is_server_id,
                    determine_our_host)
+from .crypto_pool import CryptoPool
 
 __all__ = [
     HDSFailure,
     HDSBadKeyFailure,
     verify_payload,
-    determine_our_host]
+    verify_payloads,
+    load_public_key,
+    public_key_cache_info,
+    verified_signatures,
+    server_id,
+    is_server_id,
+    determine_our_host,
+    CryptoPool]
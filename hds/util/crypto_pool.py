@@ -0,0 +1,62 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from os import environ, cpu_count
+from .util import HDSFailure
+
+logger = logging.getLogger(__name__)
+
+# "thread", "process", or "inline" to run on the calling thread
+POOL_KIND = environ.get("HDS_CRYPTO_POOL", "thread")
+# Defaults to the number of cores
+POOL_WORKERS = int(environ.get("HDS_CRYPTO_WORKERS", "0")) or None
+# How many jobs may be queued or running before new ones are turned away
+POOL_MAX_PENDING = int(environ.get("HDS_CRYPTO_MAX_PENDING", "256"))
+
+
+class CryptoPool():
+    """
+    Runs CPU-bound signing and verification off the event loop. The cryptography library
+    releases the GIL while it works, so threads spread over every core. A process pool can only
+    run module level functions given picklable arguments, like verify_payload.
+
+    Once max_pending jobs are waiting, further jobs fail with hds.error.busy rather than
+    queueing without bound.
+    """
+
+    def __init__(self, kind=POOL_KIND, workers=POOL_WORKERS, max_pending=POOL_MAX_PENDING):
+        self.kind = kind
+        self.workers = workers or cpu_count() or 1
+        self.max_pending = max_pending
+        self.pending = 0
+        if kind == "thread":
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="hds-crypto")
+        elif kind == "process":
+            self.executor = ProcessPoolExecutor(self.workers)
+        elif kind == "inline":
+            self.workers = 1
+            self.executor = None
+        else:
+            raise Exception("Unknown crypto pool '%s'" % kind)
+
+    async def run(self, fn, *args):
+        """
+        Run fn(*args) on the pool.
+
+        :return: What fn returns. Anything it raises is raised here
+        :raises HDSFailure: If max_pending jobs are already waiting
+        """
+        if self.executor is None:
+            return fn(*args)
+        if self.pending >= self.max_pending:
+            logger.warning("Crypto pool is full, turning away a job")
+            raise HDSFailure("The directory is busy, try again later", type="hds.error.busy")
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
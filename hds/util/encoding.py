@@ -0,0 +1,65 @@
+import base64
+import binascii
+import cbor2
+
+JSON_CONTENT_TYPE = "application/json"
+CBOR_CONTENT_TYPE = "application/cbor"
+
+# Bodies are the same documents in JSON and CBOR, except that in CBOR each hds.signature is a byte
+# string rather than base64 text.
+
+
+def _signatures_to_bytes(document):
+    if isinstance(document, dict):
+        converted = {}
+        for key, value in document.items():
+            if key == "hds.signature" and isinstance(value, str):
+                try:
+                    sig = base64.b64decode(value, validate=True)
+                    # Only send the bytes if they give back exactly the string we were given
+                    if base64.b64encode(sig).decode() == value:
+                        value = sig
+                except binascii.Error:
+                    pass
+            converted[key] = _signatures_to_bytes(value)
+        return converted
+    if isinstance(document, list):
+        return [_signatures_to_bytes(value) for value in document]
+    return document
+
+
+def _signatures_to_text(document):
+    if isinstance(document, dict):
+        return {
+            key: base64.b64encode(value).decode()
+            if key == "hds.signature" and isinstance(value, bytes)
+            else _signatures_to_text(value)
+            for key, value in document.items()
+        }
+    if isinstance(document, list):
+        return [_signatures_to_text(value) for value in document]
+    return document
+
+
+def dumps_cbor(document):
+    """
+    Encode a request or response body as CBOR.
+
+    :param document: The body, as it would be given to JSON
+    :return: The CBOR bytes
+    """
+    return cbor2.dumps(_signatures_to_bytes(document))
+
+
+def loads_cbor(data):
+    """
+    Decode a CBOR request or response body.
+
+    :param data: The CBOR bytes
+    :return: The body, as it would have been parsed from JSON
+    :raises ValueError: If the data is not valid CBOR
+    """
+    try:
+        return _signatures_to_text(cbor2.loads(data))
+    except cbor2.CBORDecodeError as e:
+        raise ValueError("Invalid CBOR: %s" % e)
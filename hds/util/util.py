@@ -1,16 +1,29 @@
 import base64
 import base58
+import hashlib
 import logging
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
 from os import environ
 from canonicaljson import encode_canonical_json
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, ed25519
 from cryptography.hazmat.primitives.asymmetric import utils
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives.serialization import load_der_public_key
 
 logger = logging.getLogger(__name__)
 
+# How many parsed server public keys to keep. The same few hosts publish over and over.
+PUBKEY_CACHE_SIZE = int(environ.get("HDS_PUBKEY_CACHE_SIZE", "1024"))
+# How many verified signatures to remember. Federation and re-registration resend identical
+# payloads, which then skip verification.
+VERIFIED_CACHE_SIZE = int(environ.get("HDS_VERIFIED_CACHE_SIZE", "4096"))
+# Server IDs are this many lowercase base32 characters, from 120 bits of SHA-256
+SERVER_ID_LENGTH = 24
+SERVER_ID_CHARS = frozenset("abcdefghijklmnopqrstuvwxyz234567")
+
 
 class HDSFailure(Exception):
     def __init__(self, msg, type="hds.error.unknown"):
@@ -25,10 +38,105 @@ class HDSBadKeyFailure(HDSFailure):
         self.msg = msg
 
 
-def verify_payload(b58_server_key, body):
+@lru_cache(maxsize=PUBKEY_CACHE_SIZE)
+def _load_der_public_key(b58_server_key):
+    return load_der_public_key(base58.b58decode(b58_server_key), backend=default_backend())
+
+
+def load_public_key(b58_server_key):
+    """
+    Parse a server name into its public key. Parsed keys are cached, see public_key_cache_info.
+
+    :param b58_server_key: The base58 encoded DER public key of the server
+    :return: The RSAPublicKey or Ed25519PublicKey
+    """
+    public_key = _load_der_public_key(b58_server_key)
+    if not isinstance(public_key, (rsa.RSAPublicKey, ed25519.Ed25519PublicKey)):
+        logger.warning("Servername is not a RSA or Ed25519 public key")
+        # The error type predates Ed25519 support, and is kept for existing clients
+        raise HDSFailure("Not a RSA or Ed25519 public key", type="hds.error.servername.not_rsa")
+    return public_key
+
+
+def public_key_cache_info():
+    """
+    :return: The hits, misses, maxsize and currsize of the parsed public key cache
+    """
+    return _load_der_public_key.cache_info()
+
+
+@lru_cache(maxsize=PUBKEY_CACHE_SIZE)
+def server_id(b58_server_key):
+    """
+    A short, fixed length ID for a server, used in place of its full name in storage keys and
+    URLs. The full name is still needed to verify the server's payloads.
+
+    :param b58_server_key: The server name
+    :return: The server ID string
+    """
+    digest = hashlib.sha256(b58_server_key.encode()).digest()[:SERVER_ID_LENGTH * 5 // 8]
+    return base64.b32encode(digest).decode().lower()
+
+
+def is_server_id(server):
+    """
+    Whether a string is a server ID rather than a server name, or a prefix of one. Server names
+    are DER keys, whose headers always give upper case characters in the first few, so the two
+    never look alike.
+    """
+    return len(server) == SERVER_ID_LENGTH and SERVER_ID_CHARS.issuperset(server)
+
+
+class VerifiedSignatures():
+    """
+    A bounded set of (server key, payload digest, signature) that have verified, least recently
+    used first. It is shared by the threads of a CryptoPool, so access is locked.
+    """
+
+    def __init__(self, max_size=VERIFIED_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def check(self, entry):
+        """
+        :param entry: A (server key, payload digest, signature) tuple
+        :return: Whether the entry has verified before
+        """
+        with self.__lock:
+            if entry not in self.__entries:
+                self.misses += 1
+                return False
+            self.__entries.move_to_end(entry)
+            self.hits += 1
+            return True
+
+    def add(self, entry):
+        with self.__lock:
+            self.__entries[entry] = True
+            self.__entries.move_to_end(entry)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+
+verified_signatures = VerifiedSignatures()
+
+
+def verify_payload(b58_server_key, body, public_key=None, cache=True):
     """
     :param b58_server_key:
     :param body:
+    :param public_key: The already parsed public key of b58_server_key. Optional
+    :param cache: Whether to use and add to verified_signatures
     :return:
     """
     try:
@@ -38,27 +146,46 @@ def verify_payload(b58_server_key, body):
         logger.warning("Failed trying to decode signature %s", e)
         raise HDSFailure("Could not decode signature bytes", type="hds.error.payload.bad_signature")
 
-    public_key = load_der_public_key(base58.b58decode(b58_server_key), backend=default_backend())
-
-    if not isinstance(public_key, rsa.RSAPublicKey):
-        logger.warning("Servername is not a RSA public key")
-        raise HDSFailure("Not a RSA public key", type="hds.error.servername.not_rsa")
     sig_body = body
     del sig_body["hds.signature"]
     logger.debug("verify_payload %s %s", encSig, str(sig_body))
+    canonical_body = encode_canonical_json(sig_body)
+    verified = (b58_server_key, hashlib.sha256(canonical_body).digest(), encSig)
+    if cache and verified_signatures.check(verified):
+        return
+    if public_key is None:
+        public_key = load_public_key(b58_server_key)
     try:
-        public_key.verify(
-            sig,
-            encode_canonical_json(sig_body),
-            padding.PSS(
-                mgf=padding.MGF1(utils.hashes.SHA512()),
-                salt_length=padding.PSS.MAX_LENGTH,
-            ),
-            utils.hashes.SHA512()
-        )
+        # The algorithm follows from the type of the DER key in the server name
+        if isinstance(public_key, ed25519.Ed25519PublicKey):
+            public_key.verify(sig, canonical_body)
+        else:
+            public_key.verify(
+                sig,
+                canonical_body,
+                padding.PSS(
+                    mgf=padding.MGF1(utils.hashes.SHA512()),
+                    salt_length=padding.PSS.MAX_LENGTH,
+                ),
+                utils.hashes.SHA512()
+            )
     except Exception:
         logger.error("Signature didn't match!")
         raise HDSFailure("Signature failed to verify", type="hds.error.payload.bad_signature")
+    if cache:
+        verified_signatures.add(verified)
+
+
+def verify_payloads(b58_server_key, bodies, cache=True):
+    """
+    Verify several payloads from the same server, parsing its key once. As it only takes
+    picklable arguments, it can be run on any CryptoPool.
+
+    :raises HDSFailure: On the first payload that fails to verify
+    """
+    public_key = load_public_key(b58_server_key)
+    for body in bodies:
+        verify_payload(b58_server_key, body, public_key, cache)
 
 
 def determine_our_host():
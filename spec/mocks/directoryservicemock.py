@@ -1,37 +1,66 @@
+from urllib.parse import parse_qs
+from hds.store.redis_store import compile_topic_pattern
+from hds.util.encoding import JSON_CONTENT_TYPE, CBOR_CONTENT_TYPE, dumps_cbor, loads_cbor
+
+
 class MockResponse():
 
-    def __init__(self, status=200, json=None):
+    def __init__(self, status=200, json=None, headers=None):
         self.status = status
+        self.content_type = JSON_CONTENT_TYPE
+        self.headers = headers or {}
         self.__json = json
 
     async def json(self):
         return self.__json
 
+    async def read(self):
+        return dumps_cbor(self.__json)
+
 class MockClientSession():
     def __init__(self, opts, state={}):
         self.requests = []
         self.topics = opts.get("topics", {})
         self.all_topics = opts.get("all_topics", [])
         self.state = state
+        # server => version, given as the ETag of its state
+        self.versions = {}
         pass
 
-    async def store_method(self, method, url=None, json=None):
+    async def store_method(self, method, url=None, json=None, data=None, headers=None):
         if url is None:
             raise Exception("URL expected")
+        headers = headers or {}
+        if data is not None:
+            if headers.get("Content-Type") != CBOR_CONTENT_TYPE:
+                raise Exception("CBOR Content-Type expected")
+            json = loads_cbor(data)
         if json is None and method != "GET":
             raise Exception("JSON expected")
         self.requests.append({
             "url": url,
             "json": json,
             "method": method,
+            "headers": headers,
         })
 
-    async def put(self, url=None, json=None, ssl=None):
-        await self.store_method("PUT", url, json)
+    async def put(self, url=None, json=None, data=None, headers=None, ssl=None):
+        await self.store_method("PUT", url, json, data, headers)
         return MockResponse(201)
 
-    async def get(self, url=None, ssl=None):
-        await self.store_method("GET", url)
+    async def get(self, url=None, headers=None, ssl=None):
+        await self.store_method("GET", url, headers=headers)
+        res = self.__route(url)
+        etag = res.headers.get("ETag")
+        if etag is not None and etag == (headers or {}).get("If-None-Match"):
+            res = MockResponse(304, headers=res.headers)
+        if CBOR_CONTENT_TYPE in (headers or {}).get("Accept", ""):
+            res.content_type = CBOR_CONTENT_TYPE
+        return res
+
+    def __route(self, url):
+        url, _, query = url.partition("?")
+        query = parse_qs(query)
         parts = url.split("/")
         req_type = parts[4]
         if req_type == "topics" and len(parts) > 5:
@@ -43,7 +72,21 @@ class MockClientSession():
                     "hds.error.text": "Topic could not be found",
                     "hds.error": "hds.error.topic.missing",
                 })
+            if "limit" in query:
+                page, next_cursor = self.page(list(hosts.items()), query)
+                return MockResponse(200, {"hosts": dict(page), "next_cursor": next_cursor})
             return MockResponse(200, {"hosts": hosts})
+        elif req_type == "topics" and ("match" in query or "limit" in query):
+            _, regex = compile_topic_pattern(query.get("match", ["**"])[0])
+            topics = [t for t in self.all_topics if regex.fullmatch(t)]
+            next_cursor = None
+            if "limit" in query:
+                topics, next_cursor = self.page(topics, query)
+            if "hosts" in query:
+                topics = {t: self.topics.get(t, []) for t in topics}
+            if "limit" in query:
+                return MockResponse(200, {"topics": topics, "next_cursor": next_cursor})
+            return MockResponse(200, {"topics": topics})
         elif req_type == "topics":
             return MockResponse(200, {"topics": self.all_topics})
         elif req_type == "hosts" and len(parts) == 6:
@@ -54,7 +97,10 @@ class MockClientSession():
                     "hds.error.text": "Host could not be found",
                     "hds.error": "hds.error.host.missing",
                 })
-            return MockResponse(200, s)
+            return MockResponse(200, s, headers={
+                "ETag": 'W/"%i"' % self.versions.get(srv, 1),
+                "Cache-Control": "max-age=60",
+            })
         elif req_type == "identify":
             return MockResponse(200, {
                 "hds.servername": "a_server_name",
@@ -62,6 +108,13 @@ class MockClientSession():
             })
         raise Exception("Mock client didn't understand the request")
 
+    @staticmethod
+    def page(items, query):
+        # The cursor is just the offset of the next item
+        start = int(query.get("cursor", ["0"])[0])
+        end = start + int(query["limit"][0])
+        return items[start:end], str(end) if end < len(items) else None
+
     async def __aexit__(self, exc_type, exc, tb):
         return len(self.requests) > 0
 
@@ -1,7 +1,10 @@
 import unittest
 import asyncio
-from hds.client import DirectoryClient
-from hds.util import HDSBadKeyFailure, HDSFailure, verify_payload
+from collections import OrderedDict
+from hds.client import DirectoryClient, generate_key
+from hds.util.crypto_pool import CryptoPool
+from hds.util import (HDSBadKeyFailure, HDSFailure, verify_payload, load_public_key,
+                      public_key_cache_info, verified_signatures)
 from spec.mocks.directoryservicemock import MockClientSession
 
 GOOD_PUB_KEY = "2TuPVgMCHJy5atawrsADEzjP7MCVbyyCA89UW6Wvjp9HrC1rUKkbd"
@@ -79,6 +82,39 @@ class ClientTestCase(unittest.TestCase):
         # Check signature is valid, this will raise if not.
         verify_payload(GOOD_PUB_KEY, signed)
 
+    def test_public_key_cache(self):
+        load_public_key(GOOD_PUB_KEY)
+        before = public_key_cache_info()
+        client = self.gen_client()
+        verify_payload(GOOD_PUB_KEY, client.sign_payload({"hds.test.state": "Hello world!"}))
+        after = public_key_cache_info()
+        self.assertEqual(after.hits, before.hits + 1)
+        self.assertEqual(after.misses, before.misses)
+
+    def test_verified_signatures(self):
+        client = self.gen_client()
+        signed = client.sign_payload({"hds.test.state": "Hello world!"})
+        verify_payload(GOOD_PUB_KEY, dict(signed))
+        hits = verified_signatures.hits
+        verify_payload(GOOD_PUB_KEY, dict(signed))
+        self.assertEqual(verified_signatures.hits, hits + 1)
+        # The same signature over a different payload is still checked
+        with self.assertRaises(HDSFailure):
+            verify_payload(GOOD_PUB_KEY, dict(signed, **{"hds.test.state": "Goodbye world!"}))
+
+    def test_ed25519_key(self):
+        client = DirectoryClient("http://localhost:11111",
+                                 private_key_data=generate_key("ed25519"))
+        self.assertLess(len(client.pub_key), 80)
+        signed = client.sign_payload({"hds.test.state": "Hello world!"})
+        verify_payload(client.pub_key, dict(signed))
+        signed["hds.test.state"] = "Goodbye world!"
+        with self.assertRaises(HDSFailure):
+            verify_payload(client.pub_key, signed)
+        # A RSA server name cannot claim an Ed25519 signature
+        with self.assertRaises(HDSFailure):
+            verify_payload(GOOD_PUB_KEY, client.sign_payload({"hds.test.state": "Hi"}))
+
     def test_sign_payload_empty(self):
         client = self.gen_client()
         with self.assertRaises(HDSFailure):
@@ -213,6 +249,44 @@ class ClientTestCase(unittest.TestCase):
             self.assertEqual(res, ["foo", "bar", "baz"])
         asyncio.run(go(), debug=True)
 
+    def test_find_topics(self):
+        async def go():
+            client = self.gen_client({
+                "all_topics": ["uk.half-shot.weather", "uk.half-shot.weather.rain", "uk.other"],
+                "topics": {"uk.half-shot.weather": [GOOD_PUB_KEY]},
+            })
+            res = await client.find_topics("uk.half-shot.*")
+            req = client.mock_session.requests[0]
+            self.assertEqual(req["method"], "GET")
+            self.assertEqual(req["url"], "http://localhost:11111/_hds/topics?match=uk.half-shot.%2A")
+            self.assertEqual(res, ["uk.half-shot.weather"])
+            res = await client.find_topics("uk.**", hosts=True)
+            self.assertEqual(res, {
+                "uk.half-shot.weather": [GOOD_PUB_KEY],
+                "uk.half-shot.weather.rain": [],
+                "uk.other": [],
+            })
+        asyncio.run(go(), debug=True)
+
+    def test_iter_topics(self):
+        async def go():
+            client = self.gen_client({
+                "all_topics": ["uk.a", "uk.b", "uk.c"],
+                "topics": {"uk.a": {
+                    "alice": {"hds.signature": "sig", "subtopics": []},
+                    "bob": {"hds.signature": "sig", "subtopics": []},
+                    "carol": {"hds.signature": "sig", "subtopics": []},
+                }},
+            })
+            res = [topic async for topic in client.iter_topics(page_size=2)]
+            self.assertEqual(res, ["uk.a", "uk.b", "uk.c"])
+            self.assertEqual(len(client.mock_session.requests), 2)
+            self.assertEqual(client.mock_session.requests[1]["url"],
+                             "http://localhost:11111/_hds/topics?limit=2&cursor=2")
+            res = [host async for host, _ in client.iter_topic("uk.a", page_size=2)]
+            self.assertEqual(res, ["alice", "bob", "carol"])
+        asyncio.run(go(), debug=True)
+
     def test_get_state(self):
         async def go():
             # Generate a state payload
@@ -237,6 +311,72 @@ class ClientTestCase(unittest.TestCase):
             self.assertNotIn("hds.test.expired_key", res.keys())
         asyncio.run(go(), debug=True)
 
+    def test_get_state_on_pool(self):
+        async def go():
+            state = {"hds.test.key%i" % i: "Foobar%i" % i for i in range(10)}
+            client = self.gen_client({"state": {GOOD_PUB_KEY: dict(state, **{"hds.expired": []})}})
+            client.crypto_pool = CryptoPool("thread", workers=3)
+            client.cache_verified = False
+            self.assertEqual(await client.get_state(GOOD_PUB_KEY), state)
+            signed = [client.sign_payload({"hds.test.key": "Foobar%i" % i}) for i in range(10)]
+            signed[5]["hds.test.key"] = "Tampered"
+            with self.assertRaises(HDSFailure):
+                await client.verify_payloads(GOOD_PUB_KEY, signed)
+            client.crypto_pool.shutdown()
+        asyncio.run(go(), debug=True)
+
+    def test_send_state_cbor(self):
+        async def go():
+            client = self.gen_client()
+            client.use_cbor = True
+            await client.send_state("hds.test.state", "Foobar")
+            req = client.mock_session.requests[0]
+            self.assertEqual(req["headers"]["Content-Type"], "application/cbor")
+            self.assertEqual(req["json"]["hds.test.state"], "Foobar")
+            verify_payload(GOOD_PUB_KEY, req["json"], cache=False)
+        asyncio.run(go(), debug=True)
+
+    def test_get_state_cbor(self):
+        async def go():
+            client = self.gen_client({"state": {GOOD_PUB_KEY: {
+                "hds.test.key": "Foobar",
+                "hds.expired": [],
+            }}})
+            client.use_cbor = True
+            client.cache_verified = False
+            res = await client.get_state(GOOD_PUB_KEY)
+            req = client.mock_session.requests[0]
+            self.assertEqual(req["headers"]["Accept"], "application/cbor")
+            self.assertEqual(res, {"hds.test.key": "Foobar"})
+        asyncio.run(go(), debug=True)
+
+    def test_get_state_cached(self):
+        async def go():
+            client = self.gen_client({"state": {GOOD_PUB_KEY: {
+                "hds.test.key": "Foobar",
+                "hds.expired": [],
+            }}})
+            client.response_cache = OrderedDict()
+            self.assertEqual(await client.get_state(GOOD_PUB_KEY), {"hds.test.key": "Foobar"})
+            # Fresh for the max-age, so not requested again
+            self.assertEqual(await client.get_state(GOOD_PUB_KEY), {"hds.test.key": "Foobar"})
+            self.assertEqual(len(client.mock_session.requests), 1)
+            url = client.mock_session.requests[0]["url"]
+            etag, _, body = client.response_cache[url]
+            client.response_cache[url] = (etag, 0, body)
+            self.assertEqual(await client.get_state(GOOD_PUB_KEY), {"hds.test.key": "Foobar"})
+            self.assertEqual(len(client.mock_session.requests), 2)
+            self.assertEqual(client.mock_session.requests[1]["headers"]["If-None-Match"], etag)
+            # A changed state has a new ETag, so is sent in full
+            client.response_cache[url] = (etag, 0, body)
+            client.mock_session.versions[GOOD_PUB_KEY] = 2
+            client.mock_session.state[GOOD_PUB_KEY]["hds.test.key"] = client.sign_payload(
+                {"hds.test.key": "Changed", "hds.ttl": 60000})
+            client.mock_session.state[GOOD_PUB_KEY]["hds.test.key"]["value"] = "Changed"
+            self.assertEqual(await client.get_state(GOOD_PUB_KEY), {"hds.test.key": "Changed"})
+            self.assertEqual(client.response_cache[url][0], 'W/"2"')
+        asyncio.run(go(), debug=True)
+
     def test_get_state_not_paranoid(self):
         async def go():
             # Generate a state payload
@@ -0,0 +1,36 @@
+import unittest
+import asyncio
+from threading import Event
+from hds.client import DirectoryClient
+from hds.util import CryptoPool, HDSFailure, verify_payload
+
+
+class CryptoPoolTestCase(unittest.TestCase):
+
+    def test_verify_on_pool(self):
+        async def go():
+            pool = CryptoPool("thread", workers=2)
+            client = DirectoryClient(private_key_path="spec/unit/privkey.pem", crypto_pool=pool)
+            payload = await client.sign_payload_async({"hds.test.state": "Hello world!"})
+            await pool.run(verify_payload, client.pub_key, payload)
+            payload = await client.sign_payload_async({"hds.test.state": "Hello world!"})
+            payload["hds.test.state"] = "Goodbye world!"
+            with self.assertRaises(HDSFailure):
+                await pool.run(verify_payload, client.pub_key, payload)
+            pool.shutdown()
+        asyncio.run(go(), debug=True)
+
+    def test_max_pending(self):
+        async def go():
+            pool = CryptoPool("thread", workers=1, max_pending=1)
+            release = Event()
+            job = asyncio.ensure_future(pool.run(release.wait))
+            await asyncio.sleep(0)
+            with self.assertRaises(HDSFailure) as cm:
+                await pool.run(release.wait)
+            self.assertEqual(cm.exception.type, "hds.error.busy")
+            release.set()
+            await job
+            self.assertEqual(pool.pending, 0)
+            pool.shutdown()
+        asyncio.run(go(), debug=True)
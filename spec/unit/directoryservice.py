@@ -0,0 +1,186 @@
+import unittest
+import asyncio
+import json
+from time import time
+from aiohttp.test_utils import TestClient, TestServer
+import hds.directoryservice as directoryservice
+from hds.directoryservice import DirectoryService, NDJSON
+from hds.client import DirectoryClient
+from hds.store.redis_store import TOPIC_QUERY_LIMIT
+from hds.util.encoding import CBOR_CONTENT_TYPE, dumps_cbor, loads_cbor
+
+CLIENT = DirectoryClient(private_key_path="spec/unit/privkey.pem")
+
+
+class DirectoryServiceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.globals = {
+            name: getattr(directoryservice, name)
+            for name in ("STORE", "STORE_PATH", "PRIVKEY_PATH")
+        }
+        directoryservice.STORE = "memory"
+        directoryservice.STORE_PATH = None
+        directoryservice.PRIVKEY_PATH = "spec/unit/privkey.pem"
+
+    def tearDown(self):
+        for name, value in self.globals.items():
+            setattr(directoryservice, name, value)
+
+    def run_service(self, test):
+        """
+        Run test(service, client) against a DirectoryService backed by a MemoryStore.
+        """
+        async def go():
+            service = DirectoryService()
+            async with TestClient(TestServer(service.app)) as client:
+                await test(service, client)
+            service.crypto_pool.shutdown()
+        asyncio.run(go(), debug=True)
+
+    def test_find_topics_unlimited(self):
+        async def test(service, client):
+            topics = ["uk.topic%04i" % i for i in range(TOPIC_QUERY_LIMIT + 1)]
+            for topic in topics:
+                await service.store.store_host_topic("alice", topic, [], "sig")
+            res = await client.get("/_hds/topics?match=uk.*")
+            self.assertEqual(res.status, 200)
+            self.assertEqual(await res.json(), {"topics": topics})
+        self.run_service(test)
+
+    async def store_state(self, service, key, value, ttl=100, last_updated=None):
+        payload = CLIENT.sign_payload({"hds.ttl": ttl, key: value})
+        await service.store.store_host_state(
+            CLIENT.get_pubkey(), key, value, ttl, payload["hds.signature"], last_updated)
+
+    def test_get_state_etag(self):
+        async def test(service, client):
+            await self.store_state(service, "hds.host", "hostname")
+            url = "/_hds/hosts/" + CLIENT.get_server_id()
+            res = await client.get(url)
+            self.assertEqual(res.status, 200)
+            etag = res.headers["ETag"]
+            self.assertRegex(etag, r'^W/"\d+\.0"$')
+            self.assertIn(res.headers["Cache-Control"], ("max-age=99", "max-age=100"))
+            self.assertEqual(res.headers["Vary"], "Accept")
+            for if_none_match in (etag, etag[2:], '"other", ' + etag, "*"):
+                res = await client.get(url, headers={"If-None-Match": if_none_match})
+                self.assertEqual(res.status, 304)
+                self.assertEqual(res.headers["ETag"], etag)
+                self.assertEqual(await res.read(), b"")
+            res = await client.get(url, headers={"If-None-Match": 'W/"other"'})
+            self.assertEqual(res.status, 200)
+            await self.store_state(service, "hds.name", "Alice")
+            res = await client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(res.status, 200)
+            self.assertNotEqual(res.headers["ETag"], etag)
+            self.assertEqual((await res.json())["hds.name"]["value"], "Alice")
+        self.run_service(test)
+
+    def test_get_state_etag_expiry(self):
+        async def test(service, client):
+            await self.store_state(service, "hds.host", "hostname")
+            # Expires in half a second
+            await self.store_state(service, "hds.name", "Alice", 100, time() * 1000 - 99500)
+            url = "/_hds/hosts/" + CLIENT.get_server_id()
+            res = await client.get(url)
+            etag = res.headers["ETag"]
+            # Only cached until the first key expires
+            self.assertEqual(res.headers["Cache-Control"], "max-age=0")
+            await asyncio.sleep(0.6)
+            # The version is the same, but the state is not
+            res = await client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(res.status, 200)
+            self.assertEqual(res.headers["ETag"], etag[:-2] + '1"')
+            self.assertEqual((await res.json())["hds.expired"], ["hds.name"])
+            self.assertIn(res.headers["Cache-Control"], ("max-age=99", "max-age=100"))
+        self.run_service(test)
+
+    def test_get_topics_etag(self):
+        async def test(service, client):
+            await service.store.store_host_topic("alice", "foo", [], "sig")
+            res = await client.get("/_hds/topics")
+            etag = res.headers["ETag"]
+            self.assertEqual(res.headers["Cache-Control"], "no-cache")
+            res = await client.get("/_hds/topics", headers={"If-None-Match": etag})
+            self.assertEqual(res.status, 304)
+            # Listings with hosts change as the hosts expire
+            res = await client.get("/_hds/topics?hosts=true", headers={"If-None-Match": etag})
+            self.assertEqual(res.status, 200)
+            self.assertNotIn("ETag", res.headers)
+            await service.store.store_host_topic("alice", "bar", [], "sig")
+            res = await client.get("/_hds/topics", headers={"If-None-Match": etag})
+            self.assertEqual(res.status, 200)
+            self.assertEqual(sorted((await res.json())["topics"]), ["bar", "foo"])
+        self.run_service(test)
+
+    def test_cbor(self):
+        async def test(service, client):
+            payload = CLIENT.sign_payload({"hds.ttl": 100, "hds.host": "hostname"})
+            url = "/_hds/hosts/" + CLIENT.get_pubkey()
+            res = await client.put(url + "/state/hds.host", data=dumps_cbor(payload),
+                                   headers={"Content-Type": CBOR_CONTENT_TYPE})
+            self.assertEqual(res.status, 201)
+            res = await client.get("/_hds/hosts/" + CLIENT.get_server_id(),
+                                   headers={"Accept": CBOR_CONTENT_TYPE})
+            self.assertEqual(res.content_type, CBOR_CONTENT_TYPE)
+            state = loads_cbor(await res.read())
+            self.assertEqual(state["hds.host"]["value"], "hostname")
+            self.assertEqual(state["hds.host"]["hds.signature"], payload["hds.signature"])
+            res = await client.put(url + "/state/hds.host", data=b"\xff",
+                                   headers={"Content-Type": CBOR_CONTENT_TYPE,
+                                            "Accept": CBOR_CONTENT_TYPE})
+            self.assertEqual(res.status, 400)
+            self.assertEqual(loads_cbor(await res.read())["hds.error"], "hds.error.body.invalid")
+            res = await client.put(url + "/state/hds.host", data=b"{}",
+                                   headers={"Content-Type": "text/plain"})
+            self.assertEqual(res.status, 400)
+            self.assertEqual((await res.json())["hds.error"], "hds.error.headers.unsupported")
+        self.run_service(test)
+
+    def test_accept(self):
+        async def test(service, client):
+            await service.store.store_host_topic("alice", "foo", [], "sig")
+            for accept, content_type in (
+                (CBOR_CONTENT_TYPE, CBOR_CONTENT_TYPE),
+                (CBOR_CONTENT_TYPE + ", */*", CBOR_CONTENT_TYPE),
+                (CBOR_CONTENT_TYPE + ";q=0, application/json", "application/json"),
+                ("application/json, " + CBOR_CONTENT_TYPE + ";q=0.5", "application/json"),
+                ("application/*;q=0.5, " + CBOR_CONTENT_TYPE + ";q=0.8", CBOR_CONTENT_TYPE),
+                ("*/*", "application/json"),
+                (NDJSON, NDJSON),
+                (NDJSON + "; q=0, application/json", "application/json"),
+            ):
+                res = await client.get("/_hds/topics", headers={"Accept": accept})
+                self.assertEqual(res.status, 200)
+                self.assertEqual(res.content_type, content_type, accept)
+        self.run_service(test)
+
+    def test_stream(self):
+        async def test(service, client):
+            for i in range(5):
+                await service.store.store_host_state("host%i" % i, "hds.host", "h", 100, "sig")
+                await service.store.store_host_topic("host%i" % i, "foo", [], "sig")
+                await service.store.store_host_topic("host%i" % i, "foo%i" % i, [], "sig")
+            res = await client.get("/_hds/topics/foo?limit=2", headers={"Accept": NDJSON})
+            self.assertEqual(res.status, 200)
+            self.assertEqual(res.content_type, NDJSON)
+            lines = [json.loads(line) for line in (await res.text()).splitlines()]
+            self.assertEqual(sorted(line["host"] for line in lines),
+                             ["host%i" % i for i in range(5)])
+            res = await client.get("/_hds/topics?match=foo*&limit=2", headers={"Accept": NDJSON})
+            self.assertNotIn("ETag", res.headers)
+            lines = [json.loads(line) for line in (await res.text()).splitlines()]
+            topics = ["foo"] + ["foo%i" % i for i in range(5)]
+            self.assertEqual(lines, [{"topic": topic} for topic in topics])
+        self.run_service(test)
+
+    def test_get_topic_bad_cursor(self):
+        async def test(service, client):
+            await service.store.store_host_topic("alice", "foo", ["bar"], "sig")
+            for accept in ("application/json", NDJSON):
+                res = await client.get("/_hds/topics/foo/bar?cursor=nonsense",
+                                       headers={"Accept": accept})
+                self.assertEqual(res.status, 400)
+                self.assertEqual((await res.json())["hds.error"], "hds.error.topic.bad_query")
+        self.run_service(test)
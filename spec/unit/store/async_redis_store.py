@@ -0,0 +1,99 @@
+import unittest
+import asyncio
+import fakeredis.aioredis
+from hds.store.async_redis_store import AsyncRedisStore
+from hds.store.lrucache import LRUCache
+from hds.util import HDSFailure
+
+
+class AsyncRedisStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def createStore(self):
+        r = AsyncRedisStore()
+        r.r = fakeredis.aioredis.FakeRedis()
+        return r
+
+    def test_create_redis(self):
+        self.createStore()
+
+    def test_set_and_get_topics(self):
+        async def go():
+            r = self.createStore()
+            await r.store_host_topic("alice", "foo", [], "fakesig")
+            await r.store_host_topic("bob", "bar", [], "fakesig")
+            self.assertSetEqual(set(await r.get_topics()), set(["foo", "bar"]))
+        asyncio.run(go(), debug=True)
+
+    def test_get_topic_hosts(self):
+        async def go():
+            r = self.createStore()
+            await r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+            await r.store_host_topic("alice", "foo", [], "fakesig")
+            await r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig")
+            await r.store_host_topic("bob", "foo", [], "fakesig")
+            self.assertSetEqual(set(await r.get_topic_hosts("foo")), set(["alice", "bob"]))
+        asyncio.run(go(), debug=True)
+
+    def test_set_and_get_state(self):
+        async def go():
+            r = self.createStore()
+            await r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig", 1000)
+            res = await r.get_host_state("ali")
+            self.assertEqual(res["hds.host"], {
+                "hds.signature": "fakesig",
+                "hds.ttl": 100,
+                "value": "hostname",
+                "hds.last_updated": 1000})
+            states = await r.get_host_states(["alice"])
+            self.assertEqual(states["alice"]["hds.host"]["value"], "hostname")
+        asyncio.run(go(), debug=True)
+
+    def test_get_state_no_host(self):
+        async def go():
+            r = self.createStore()
+            with self.assertRaises(HDSFailure):
+                await r.get_host_state("fakeserver")
+        asyncio.run(go(), debug=True)
+
+    def test_migrate(self):
+        async def go():
+            r = self.createStore()
+            await r.r.lpush("hds/hosts", "alice")
+            await r.r.lpush("hds/host/alice/state", "hds.host")
+            await r.r.set("hds/host/alice/state/hds.host", "fakesig:100:1000:hostname")
+            self.assertEqual(await r.migrate(), 10)
+            self.assertEqual(await r.find_host("a"), "alice")
+            res = await r.get_host_state("alice")
+            self.assertEqual(res["hds.host"]["value"], "hostname")
+        asyncio.run(go(), debug=True)
+
+    def test_cache_invalidation(self):
+        async def go():
+            r = self.createStore()
+            r.cache = LRUCache()
+            # A second process sharing the same redis
+            other = self.createStore()
+            other.r = r.r
+            subscribed = asyncio.Event()
+            listener = asyncio.ensure_future(r.listen_for_invalidations(subscribed.set))
+            await asyncio.wait_for(subscribed.wait(), 1)
+            await r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+            await r.store_host_topic("alice", "foo", [], "fakesig")
+            self.assertEqual((await r.get_host_state("alice"))["hds.host"]["value"], "hostname")
+            self.assertEqual(list(await r.get_topic_hosts("foo")), ["alice"])
+            self.assertEqual((await r.get_host_state("alice"))["hds.host"]["value"], "hostname")
+            self.assertEqual(r.cache.hits, 1)
+            await other.store_host_state("alice", "hds.host", "newhost", 100, "fakesig")
+            for _ in range(100):
+                if len(r.cache) == 0:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual((await r.get_host_state("alice"))["hds.host"]["value"], "newhost")
+            listener.cancel()
+        asyncio.run(go(), debug=True)
@@ -0,0 +1,46 @@
+import unittest
+from time import sleep
+from hds.store.lrucache import LRUCache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_get_set(self):
+        c = LRUCache()
+        self.assertIsNone(c.get("foo"))
+        c.set("foo", "bar")
+        self.assertEqual(c.get("foo"), "bar")
+        self.assertEqual(c.hits, 1)
+        self.assertEqual(c.misses, 1)
+
+    def test_evicts_least_recently_used(self):
+        c = LRUCache(max_size=2)
+        c.set("a", 1)
+        c.set("b", 2)
+        c.get("a")
+        c.set("c", 3)
+        self.assertEqual(len(c), 2)
+        self.assertIn("a", c)
+        self.assertNotIn("b", c)
+        self.assertIn("c", c)
+
+    def test_ttl(self):
+        c = LRUCache(ttl=50)
+        c.set("a", 1)
+        c.set("b", 2, ttl=10000)
+        c.set("c", 3, ttl=-1)
+        self.assertIn("a", c)
+        self.assertNotIn("c", c)
+        sleep(0.1)
+        self.assertNotIn("a", c)
+        # Entries can't outlive the cache's own ttl
+        self.assertNotIn("b", c)
+
+    def test_invalidate_prefix(self):
+        c = LRUCache()
+        c.set("topic/foo/", 1)
+        c.set("topic/foo/bar", 2)
+        c.set("topic/food/", 3)
+        c.invalidate_prefix("topic/foo/")
+        self.assertEqual(len(c), 1)
+        self.assertIn("topic/food/", c)
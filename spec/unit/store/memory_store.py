@@ -0,0 +1,200 @@
+import unittest
+import asyncio
+import tempfile
+from os import path
+from time import time
+from hds.store.memory_store import MemoryStore
+from hds.store.redis_store import STATE_STORAGE_LIMIT
+from hds.util import HDSFailure, server_id
+
+
+class MemoryStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_set_and_get_topics(self):
+        async def go():
+            r = MemoryStore()
+            await r.store_host_topic("alice", "foo", [], "fakesig")
+            await r.store_host_topic("bob", "bar", [], "fakesig")
+            await r.store_host_topic("bob", "foo", [], "fakesig")
+            self.assertSetEqual(set(await r.get_topics()), set(["foo", "bar"]))
+        asyncio.run(go(), debug=True)
+
+    def test_find_topics(self):
+        async def go():
+            r = MemoryStore()
+            for topic in ["uk.half-shot.weather", "uk.half-shot.weather.rain", "org.matrix"]:
+                await r.store_host_topic("alice", topic, [], "fakesig")
+            self.assertEqual(await r.find_topics("uk.half-shot.*"), ["uk.half-shot.weather"])
+            self.assertEqual(await r.find_topics("**", limit=2),
+                             ["org.matrix", "uk.half-shot.weather"])
+        asyncio.run(go(), debug=True)
+
+    def test_get_topic_hosts(self):
+        async def go():
+            r = MemoryStore()
+            await r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+            await r.store_host_topic("alice", "foo", ["bar"], "fakesig")
+            await r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig", 0)
+            await r.store_host_topic("bob", "foo", [], "fakesig")
+            self.assertEqual(await r.get_topic_hosts("foo"), {
+                "alice": {"hds.signature": "fakesig", "subtopics": ["bar"]}
+            })
+        asyncio.run(go(), debug=True)
+
+    def test_get_hierarchical_subtopics(self):
+        async def go():
+            r = MemoryStore()
+            await r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+            await r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig")
+            await r.store_host_topic("alice", "news", ["local/portsmouth", "tech"], "sig")
+            await r.store_host_topic("bob", "news", ["local", "local-ish"], "sig")
+            self.assertEqual(await r.get_topic_hosts("news", "local"), {
+                "alice": {"hds.signature": "sig", "subtopics": ["local/portsmouth"]},
+                "bob": {"hds.signature": "sig", "subtopics": ["local"]},
+            })
+            await r.store_host_topic("alice", "news", ["tech"], "sig")
+            self.assertEqual(list(await r.get_topic_hosts("news", ["local"])), ["bob"])
+            self.assertEqual(await r.get_topic_hosts("news", "loc"), {})
+        asyncio.run(go(), debug=True)
+
+    def test_paging(self):
+        async def go():
+            r = MemoryStore()
+            for host in ["alice", "bob", "carol"]:
+                await r.store_host_state(host, "hds.host", "hostname", 100, "fakesig")
+                await r.store_host_topic(host, "news", ["local/%s" % host], "sig")
+                await r.store_host_topic(host, "uk.%s" % host, [], "sig")
+            self.assertEqual(await r.find_topics("uk.*", limit=1, after="uk.alice"), ["uk.bob"])
+            page, cursor = await r.get_topic_hosts_page("news", count=2)
+            self.assertEqual(list(page), ["alice", "bob"])
+            page, cursor = await r.get_topic_hosts_page("news", cursor=cursor, count=2)
+            self.assertEqual((list(page), cursor), (["carol"], None))
+            page, cursor = await r.get_topic_hosts_page("news", "local", count=2)
+            self.assertEqual(list(page), ["alice", "bob"])
+            page, cursor = await r.get_topic_hosts_page("news", "local", cursor, count=2)
+            self.assertEqual(page, {"carol": {"hds.signature": "sig", "subtopics": ["local/carol"]}})
+            self.assertIsNone(cursor)
+            for cursor in ("abc", "Zm9v"):
+                with self.assertRaises(HDSFailure):
+                    await r.get_topic_hosts_page("news", "local", cursor)
+        asyncio.run(go(), debug=True)
+
+    def test_set_and_get_state(self):
+        async def go():
+            r = MemoryStore()
+            await r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig", 1000)
+            await r.store_host_state("alice", "hds.name", "Alice", 100, "fakesig")
+            res = await r.get_host_state("ali")
+            self.assertEqual(res["hds.host"], {
+                "hds.signature": "fakesig",
+                "hds.ttl": 100,
+                "value": "hostname",
+                "hds.last_updated": 1000})
+            self.assertEqual(res["hds.expired"], ["hds.host"])
+            self.assertTrue(await r.has_host_expired("alice"))
+            self.assertEqual(list(await r.get_host_states(["alice", "bob"])), ["alice"])
+        asyncio.run(go(), debug=True)
+
+    def test_find_host(self):
+        async def go():
+            r = MemoryStore()
+            await r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+            await r.store_host_state("alicebob", "hds.host", "hostname", 100, "fakesig")
+            await r.store_host_state("adam", "hds.host", "hostname", 100, "fakesig")
+            self.assertEqual(await r.find_host("alice"), "alice")
+            self.assertEqual(await r.find_host("aliceb"), "alicebob")
+            self.assertEqual(await r.find_host("ad"), "adam")
+            with self.assertRaises(HDSFailure):
+                await r.find_host("a")
+            with self.assertRaises(HDSFailure):
+                await r.find_host("bob")
+            self.assertEqual(await r.find_host(server_id("alicebob")), "alicebob")
+            with self.assertRaises(HDSFailure):
+                await r.find_host(server_id("bob"))
+        asyncio.run(go(), debug=True)
+
+    def test_tombstoned(self):
+        async def go():
+            r = MemoryStore()
+            await r.store_host_state("alice", "hds.tombstone", "yes", 100, "fakesig")
+            with self.assertRaises(HDSFailure):
+                await r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+            with self.assertRaises(HDSFailure):
+                await r.store_host_topic("alice", "foo", [], "fakesig")
+        asyncio.run(go(), debug=True)
+
+    def test_state_eviction(self):
+        async def go():
+            r = MemoryStore()
+            await r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig", 0)
+            for i in range(STATE_STORAGE_LIMIT + 5):
+                await r.store_host_state("alice", "hds.test.%i" % i, "v", 100, "fakesig", 1000 + i)
+            res = await r.get_host_state("alice")
+            self.assertEqual(len(res), STATE_STORAGE_LIMIT + 1)
+            self.assertIn("hds.host", res)
+            self.assertNotIn("hds.test.5", res)
+            self.assertIn("hds.test.6", res)
+        asyncio.run(go(), debug=True)
+
+    def test_tombstone_not_evicted(self):
+        async def go():
+            r = MemoryStore()
+            for i in range(STATE_STORAGE_LIMIT):
+                await r.store_host_state("alice", "hds.test.%i" % i, "v", 100, "fakesig", 1000 + i)
+            await r.store_host_state("alice", "hds.tombstone", "yes", 100, "fakesig", 0)
+            res = await r.get_host_state("alice")
+            self.assertIn("hds.tombstone", res)
+            self.assertNotIn("hds.test.0", res)
+        asyncio.run(go(), debug=True)
+
+    def test_reap_expired_hosts(self):
+        async def go():
+            r = MemoryStore()
+            await r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+            await r.store_host_topic("alice", "foo", [], "fakesig")
+            await r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig",
+                                     time() * 1000 - 200000)
+            await r.store_host_topic("bob", "foo", [], "fakesig")
+            self.assertEqual(await r.reap_expired_hosts(), [])
+            self.assertEqual(await r.reap_expired_hosts(grace=0), ["bob"])
+            self.assertEqual(list(r.topics["foo"]), ["alice"])
+            with self.assertRaises(HDSFailure):
+                await r.get_host_state("bob")
+        asyncio.run(go(), debug=True)
+
+    def test_versions(self):
+        async def go():
+            r = MemoryStore()
+            await r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+            state, version = await r.get_versioned_host_state("alice")
+            await r.store_host_state("alice", "hds.name", "Alice", 100, "fakesig")
+            self.assertEqual((await r.get_versioned_host_state("alice"))[1], version + 1)
+            topics_version = await r.get_topics_version()
+            await r.store_host_topic("alice", "foo", [], "fakesig")
+            await r.store_host_topic("alice", "foo", ["bar"], "fakesig")
+            self.assertEqual(await r.get_topics_version(), topics_version + 1)
+        asyncio.run(go(), debug=True)
+
+    def test_persistence(self):
+        async def go():
+            store_path = path.join(self.tmpdir.name, "hds")
+            r = MemoryStore(path=store_path, snapshot_every=3)
+            await r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig", 1000)
+            await r.store_host_topic("alice", "foo", ["bar", "baz"], "fakesig")
+            await r.store_host_state("alice", "hds.name", "Alice", 100, "fakesig", 1000)
+            # That was the third write, so the log was folded into a snapshot
+            self.assertTrue(path.exists(store_path + ".snapshot"))
+            await r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig", 1000)
+            await r.close()
+            r2 = MemoryStore(path=store_path)
+            self.assertEqual(await r2.get_host_state("alice"), await r.get_host_state("alice"))
+            self.assertEqual(await r2.find_host("bo"), "bob")
+            self.assertEqual(r2.topics, r.topics)
+            await r2.close()
+        asyncio.run(go(), debug=True)
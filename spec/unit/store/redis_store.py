@@ -1,11 +1,33 @@
 import unittest
+import base64
 import fakeredis
-from hds.store.redis_store import RedisStore
+from hds.store.redis_store import (RedisStore, STATE_STORAGE_LIMIT, HOST_STATE_FORMAT,
+                                   K_HOST_STATE, K_HOST_STATE_UPDATED, K_HOST_TOPICS,
+                                   K_TOPIC_HOST_SIG, K_TOPIC_SUBTOPIC_HOSTS, K_HOST_VERSION,
+                                   K_INVALIDATE,
+                                   encode_state_value, parse_state_value, host_key,
+                                   topic_host_key)
 from time import sleep, time
-from hds.util import HDSFailure
+from hds.store.lrucache import LRUCache
+from hds.util import HDSFailure, server_id
 # import asyncio
 
 
+def interrupted(op, interrupt):
+    """
+    Run a store operation, calling interrupt between each of its round-trips, as a concurrent
+    writer might.
+    """
+    results = yield next(op)
+    try:
+        while True:
+            pipe = op.send(results)
+            interrupt()
+            results = yield pipe
+    except StopIteration as ex:
+        return ex.value
+
+
 class RedisStoreTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -55,6 +77,96 @@ class RedisStoreTestCase(unittest.TestCase):
         # self.assertEqual(r.get_topic_hosts("foo", ["baz", "foobar"]))
         # self.assertEqual(r.get_topic_hosts("foo", ["foobar"]))
 
+    def test_find_topics(self):
+        r = self.createStore()
+        for topic in ["uk.half-shot.weather", "uk.half-shot.weather.rain", "uk.half-shot.wiki",
+                      "uk.half-shotx.news", "org.matrix"]:
+            r.store_host_topic("alice", topic, [], "fakesig")
+        self.assertEqual(r.find_topics("uk.half-shot.*"),
+                         ["uk.half-shot.weather", "uk.half-shot.wiki"])
+        self.assertEqual(r.find_topics("uk.half-shot.**"),
+                         ["uk.half-shot.weather", "uk.half-shot.weather.rain", "uk.half-shot.wiki"])
+        self.assertEqual(r.find_topics("uk.*.weather*"),
+                         ["uk.half-shot.weather"])
+        self.assertEqual(r.find_topics("uk.half-shot**", limit=2),
+                         ["uk.half-shot.weather", "uk.half-shot.weather.rain"])
+        self.assertEqual(r.find_topics("org.matrix"), ["org.matrix"])
+        self.assertEqual(r.find_topics("org"), [])
+
+    def test_find_topics_after(self):
+        r = self.createStore()
+        for topic in ["uk.a", "uk.b", "uk.c", "uk.d", "org.matrix"]:
+            r.store_host_topic("alice", topic, [], "fakesig")
+        self.assertEqual(r.find_topics("uk.*", limit=2), ["uk.a", "uk.b"])
+        self.assertEqual(r.find_topics("uk.*", limit=2, after="uk.b"), ["uk.c", "uk.d"])
+        self.assertEqual(r.find_topics("uk.*", limit=2, after="uk.d"), [])
+        self.assertEqual(r.find_topics("uk.*", after="org.matrix"), ["uk.a", "uk.b", "uk.c", "uk.d"])
+
+    def test_get_topic_hosts_page(self):
+        r = self.createStore()
+        for host in ["alice", "bob", "carol"]:
+            r.store_host_state(host, "hds.host", "hostname", 100, "fakesig")
+            r.store_host_topic(host, "news", ["local/%s" % host, "tech"], "sig")
+        hosts, cursor = {}, None
+        while True:
+            page, cursor = r.get_topic_hosts_page("news", cursor=cursor, count=1)
+            hosts.update(page)
+            if cursor is None:
+                break
+        self.assertEqual(set(hosts), {"alice", "bob", "carol"})
+        page, cursor = r.get_topic_hosts_page("news", "local", count=2)
+        self.assertEqual(page, {
+            "alice": {"hds.signature": "sig", "subtopics": ["local/alice"]},
+            "bob": {"hds.signature": "sig", "subtopics": ["local/bob"]},
+        })
+        page, cursor = r.get_topic_hosts_page("news", "local", cursor, count=2)
+        self.assertEqual(page, {"carol": {"hds.signature": "sig", "subtopics": ["local/carol"]}})
+        self.assertIsNone(cursor)
+        for subtopics, cursor in ((None, "zzzz"), (None, "-1"), ("local", "abc")):
+            with self.assertRaises(HDSFailure):
+                r.get_topic_hosts_page("news", subtopics, cursor)
+
+    def test_get_topic_hosts_page_out_of_range(self):
+        r = self.createStore()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_topic("alice", "news", ["aaa", "foo", "local"], "sig")
+        # Valid cursors, but for other subtopics
+        for after in (b"a", b"aaa\0alice", b"localx\0alice"):
+            with self.assertRaises(HDSFailure):
+                r.get_topic_hosts_page("news", "local", base64.urlsafe_b64encode(after).decode())
+        page, _ = r.get_topic_hosts_page(
+            "news", "local", base64.urlsafe_b64encode(b"local\0").decode())
+        self.assertEqual(list(page), ["alice"])
+
+    def test_migrate_topic_index(self):
+        r = self.createStore()
+        r.r.set("hds/schema_version", 7)
+        r.r.sadd("hds/topics", "foo", "bar")
+        r.migrate()
+        self.assertEqual(r.r.type("hds/topics"), b"zset")
+        self.assertEqual(r.find_topics("*"), ["bar", "foo"])
+
+    def test_get_hierarchical_subtopics(self):
+        r = self.createStore()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_topic("alice", "news", ["local/portsmouth", "local/london", "tech"], "sig")
+        r.store_host_topic("bob", "news", ["local", "local-ish", "localportsmouth"], "sig")
+        self.assertEqual(r.get_topic_hosts("news")["alice"]["subtopics"],
+                         ["local/portsmouth", "local/london", "tech"])
+        self.assertEqual(r.get_topic_hosts("news", "local"), {
+            "alice": {"hds.signature": "sig", "subtopics": ["local/london", "local/portsmouth"]},
+            "bob": {"hds.signature": "sig", "subtopics": ["local"]},
+        })
+        self.assertEqual(list(r.get_topic_hosts("news", ["local", "portsmouth"])), ["alice"])
+        self.assertEqual(r.get_topic_hosts("news", "local/portsmouth/"), {
+            "alice": {"hds.signature": "sig", "subtopics": ["local/portsmouth"]},
+        })
+        self.assertEqual(r.get_topic_hosts("news", "loc"), {})
+        # Replacing the subtopics drops the old ones from the index
+        r.store_host_topic("alice", "news", ["tech"], "sig")
+        self.assertEqual(list(r.get_topic_hosts("news", "local")), ["bob"])
+
     def test_get_topic_hosts(self):
         r = self.createStore()
         # Need to store host state before we can store topics
@@ -116,7 +228,363 @@ class RedisStoreTestCase(unittest.TestCase):
         with self.assertRaises(HDSFailure):
             r.find_host("a")
 
+    def test_find_host_full_name(self):
+        r = self.createStore()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_state("alicebob", "hds.host", "hostname", 100, "fakesig")
+        self.assertEqual(r.find_host("alice"), "alice")
+        self.assertEqual(r.find_host("aliceb"), "alicebob")
+        with self.assertRaises(HDSFailure):
+            r.find_host("ali")
+
+    def test_find_host_server_id(self):
+        r = self.createStore()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        self.assertTrue(r.r.exists(host_key(K_HOST_STATE, "alice")))
+        self.assertFalse(r.r.exists("hds/host/alice/state"))
+        self.assertEqual(r.find_host(server_id("alice")), "alice")
+        self.assertEqual(r.get_host_state(server_id("alice"))["hds.host"]["value"], "hostname")
+        with self.assertRaises(HDSFailure):
+            r.find_host(server_id("bob"))
+
     def test_find_host_none(self):
         r = self.createStore()
         with self.assertRaises(HDSFailure):
             r.find_host("alice")
+
+    def test_migrate_empty(self):
+        r = self.createStore()
+        self.assertEqual(r.migrate(), 10)
+        self.assertEqual(r.r.get("hds/schema_version"), b"10")
+        self.assertEqual(r.get_topics(), [])
+
+    def test_migrate_list_indexes(self):
+        r = self.createStore()
+        r.r.lpush("hds/topics", "foo", "bar")
+        r.r.lpush("hds/hosts", "alice", "bob")
+        r.r.lpush("hds/topic/foo/hosts", "alice")
+        r.r.lpush("hds/topic/bar/hosts", "alice", "bob")
+        r.migrate()
+        self.assertEqual(r.r.type("hds/topics"), b"zset")
+        self.assertEqual(r.r.type("hds/hosts"), b"zset")
+        self.assertSetEqual(set(r.get_topics()), set(["foo", "bar"]))
+        self.assertEqual(r.find_host("ali"), "alice")
+        self.assertSetEqual(r.r.smembers("hds/topic/bar/hosts"), set([b"alice", b"bob"]))
+        # Running again is a no-op
+        self.assertEqual(r.migrate(), 10)
+
+    def test_migrate_state_hashes(self):
+        r = self.createStore()
+        r.r.set("hds/schema_version", 1)
+        r.r.sadd("hds/hosts", "alice")
+        r.r.lpush("hds/host/alice/state", "hds.host", "hds.name")
+        r.r.set("hds/host/alice/state/hds.host", "fakesig:100:1000:hostname")
+        r.r.set("hds/host/alice/state/hds.name", "fakesig:100:1000:Alice")
+        r.r.set("hds/host/alice/state/hds.tombstone", "fakesig:100:1000:yes")
+        r.migrate()
+        self.assertEqual(r.r.type(host_key(K_HOST_STATE, "alice")), b"hash")
+        self.assertIsNone(r.r.get("hds/host/alice/state/hds.host"))
+        res = r.get_host_state("alice")
+        self.assertEqual(res["hds.name"]["value"], "Alice")
+        self.assertEqual(res["hds.host"]["hds.last_updated"], 1000)
+        self.assertTrue(r.is_host_tombstoned("alice", throw=False))
+
+    def test_get_state_single_round_trip(self):
+        r = self.createStore()
+        for i in range(10):
+            r.store_host_state("alice", "hds.test.%i" % i, "value", 100, "fakesig")
+        self.assertEqual(r.r.type(host_key(K_HOST_STATE, "alice")), b"hash")
+        self.assertEqual(r.r.hlen(host_key(K_HOST_STATE, "alice")), 10)
+        self.assertEqual(len(r.get_host_state("alice")), 11)
+
+    def test_get_host_states(self):
+        r = self.createStore()
+        r.store_host_state("alice", "hds.host", "alicehost", 100, "fakesig")
+        r.store_host_state("bob", "hds.host", "bobhost", 100, "fakesig")
+        res = r.get_host_states(["alice", "bob", "carol"])
+        self.assertSetEqual(set(res.keys()), set(["alice", "bob"]))
+        self.assertEqual(res["alice"]["hds.host"]["value"], "alicehost")
+        self.assertEqual(res["bob"]["hds.host"]["value"], "bobhost")
+
+    def test_get_topic_hosts_tombstoned(self):
+        r = self.createStore()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_topic("alice", "foo", [], "fakesig")
+        r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_topic("bob", "foo", [], "fakesig")
+        r.store_host_state("bob", "hds.tombstone", "yes", 100, "fakesig")
+        self.assertEqual(list(r.get_topic_hosts("foo")), ["alice"])
+
+    def test_migrate_tombstone_index(self):
+        r = self.createStore()
+        r.r.set("hds/schema_version", 9)
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig")
+        r.r.hset(host_key(K_HOST_STATE, "bob"), "hds.tombstone", "fakesig:100:0:yes")
+        r.migrate()
+        self.assertEqual(r.r.smembers("hds/tombstones"), set([b"bob"]))
+
+    def test_has_host_expired(self):
+        r = self.createStore()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig", 0)
+        self.assertFalse(r.has_host_expired("alice"))
+        self.assertTrue(r.has_host_expired("bob"))
+        self.assertTrue(r.has_host_expired("carol"))
+
+    def test_get_topic_hosts_excludes_expired(self):
+        r = self.createStore()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_topic("alice", "foo", [], "fakesig")
+        r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig", 0)
+        r.store_host_topic("bob", "foo", [], "fakesig")
+        self.assertEqual(list(r.get_topic_hosts("foo")), ["alice"])
+
+    def test_reap_expired_hosts(self):
+        r = self.createStore()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_topic("alice", "foo", [], "fakesig")
+        r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig", time() * 1000 - 200000)
+        r.store_host_topic("bob", "foo", ["bar"], "fakesig")
+        # Still within the grace period
+        self.assertEqual(r.reap_expired_hosts(), [])
+        self.assertEqual(r.reap_expired_hosts(grace=0), ["bob"])
+        self.assertEqual(list(r.r.smembers("hds/topic/foo/hosts")), [b"alice"])
+        self.assertFalse(r.r.exists(topic_host_key(K_TOPIC_SUBTOPIC_HOSTS, "foo", "bob")))
+        self.assertFalse(r.r.exists("hds/topic/foo/subtopics"))
+        with self.assertRaises(HDSFailure):
+            r.get_host_state("bob")
+        self.assertEqual(r.find_host("alice"), "alice")
+
+    def test_reap_refreshed_host(self):
+        r = self.createStore()
+        r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig", 0)
+        r.store_host_topic("bob", "foo", [], "fakesig")
+
+        def refresh():
+            r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig")
+        self.assertEqual(r._run(interrupted(r._op_reap_expired_hosts(grace=0), refresh)), [])
+        self.assertEqual(r.find_host("bob"), "bob")
+        self.assertEqual(list(r.get_topic_hosts("foo")), ["bob"])
+
+    def test_reap_host_storing_topic(self):
+        r = self.createStore()
+        r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig", 0)
+        r.store_host_topic("bob", "foo", [], "fakesig")
+
+        topics = iter(["bar", "baz", "qux"])
+
+        def store_topic():
+            r.store_host_topic("bob", next(topics), ["quux"], "fakesig")
+        self.assertEqual(
+            r._run(interrupted(r._op_reap_expired_hosts(grace=0), store_topic)), ["bob"])
+        self.assertEqual(r.r.keys("hds/host/*"), [])
+        self.assertEqual(r.r.keys("hds/topic/*"), [])
+
+    def test_versions(self):
+        r = self.createStore()
+        r.cache = LRUCache()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        state, version = r.get_versioned_host_state("alice")
+        self.assertEqual(state["hds.host"]["value"], "hostname")
+        self.assertEqual(r.get_versioned_host_state("alice"), (state, version))
+        r.store_host_state("alice", "hds.name", "Alice", 100, "fakesig")
+        self.assertEqual(r.get_versioned_host_state("alice")[1], version + 1)
+        topics_version = r.get_topics_version()
+        r.store_host_topic("alice", "foo", [], "fakesig")
+        r.store_host_topic("alice", "foo", ["bar"], "fakesig")
+        self.assertEqual(r.get_topics_version(), topics_version + 1)
+        r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig", time() * 1000 - 200000)
+        r.reap_expired_hosts(grace=0)
+        self.assertFalse(r.r.exists(host_key(K_HOST_VERSION, "bob")))
+
+    def test_migrate_current_keyspace(self):
+        r = self.createStore()
+        # Written by this version, but without a schema version
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_topic("alice", "foo", ["bar"], "fakesig")
+        r.store_host_state("bob", "hds.tombstone", "yes", 100, "fakesig")
+        keys = {key: r.r.type(key) for key in r.r.keys()}
+        self.assertEqual(r.migrate(), 10)
+        r.r.delete("hds/schema_version")
+        self.assertEqual({key: r.r.type(key) for key in r.r.keys()}, keys)
+        self.assertEqual(r.get_host_state("alice")["hds.host"]["value"], "hostname")
+        self.assertEqual(r.get_topic_hosts("foo")["alice"]["subtopics"], ["bar"])
+        self.assertTrue(r.is_host_tombstoned("bob", throw=False))
+
+    def test_migrate_expiry_index(self):
+        r = self.createStore()
+        r.r.set("hds/schema_version", 3)
+        r.r.zadd("hds/hosts", {"alice": 0})
+        r.r.hset("hds/host/alice/state", "hds.host", "fakesig:100:1000:hostname")
+        r.r.sadd("hds/topics", "foo")
+        r.r.sadd("hds/topic/foo/hosts", "alice")
+        r.migrate()
+        self.assertEqual(r.r.zscore("hds/hosts/expiry", "alice"), 101000)
+        self.assertEqual(r.r.smembers(host_key(K_HOST_TOPICS, "alice")), set([b"foo"]))
+
+    def test_tombstone_not_evicted(self):
+        r = self.createStore()
+        for i in range(STATE_STORAGE_LIMIT):
+            r.store_host_state("alice", "hds.test.%i" % i, "value", 100, "fakesig", 1000 + i)
+        # Older than every other key, but it is the one that must be kept
+        r.store_host_state("alice", "hds.tombstone", "yes", 100, "fakesig", 0)
+        res = r.get_host_state("alice")
+        self.assertIn("hds.tombstone", res)
+        self.assertNotIn("hds.test.0", res)
+        self.assertTrue(r.is_host_tombstoned("alice", throw=False))
+
+    def test_tombstone_invalidates_topics(self):
+        r = self.createStore()
+        r.cache = LRUCache()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_topic("alice", "foo", ["bar"], "fakesig")
+        r.store_host_topic("alice", "baz", [], "fakesig")
+        self.assertEqual(list(r.get_topic_hosts("foo")), ["alice"])
+        self.assertEqual(list(r.get_topic_hosts("foo", "bar")), ["alice"])
+        pubsub = r.r.pubsub()
+        pubsub.subscribe(K_INVALIDATE)
+        pubsub.get_message()
+        r.store_host_state("alice", "hds.tombstone", "yes", 100, "fakesig")
+        self.assertEqual(r.get_topic_hosts("foo"), {})
+        self.assertEqual(r.get_topic_hosts("foo", "bar"), {})
+        published = set()
+        message = pubsub.get_message()
+        while message is not None:
+            published.add(message["data"])
+            message = pubsub.get_message()
+        self.assertEqual(published, {b"topic/foo/", b"topic/baz/", b"host/alice"})
+
+    def test_state_eviction(self):
+        r = self.createStore()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig", 0)
+        for i in range(STATE_STORAGE_LIMIT + 5):
+            r.store_host_state("alice", "hds.test.%i" % i, "value", 100, "fakesig", 1000 + i)
+        res = r.get_host_state("alice")
+        self.assertEqual(r.r.hlen(host_key(K_HOST_STATE, "alice")), STATE_STORAGE_LIMIT)
+        self.assertEqual(r.r.zcard(host_key(K_HOST_STATE_UPDATED, "alice")), STATE_STORAGE_LIMIT - 1)
+        self.assertIn("hds.host", res)
+        for i in range(6):
+            self.assertNotIn("hds.test.%i" % i, res)
+        self.assertIn("hds.test.6", res)
+        # Rewriting an evicted key makes it the most recent
+        r.store_host_state("alice", "hds.test.0", "value", 100, "fakesig", 5000)
+        res = r.get_host_state("alice")
+        self.assertIn("hds.test.0", res)
+        self.assertNotIn("hds.test.6", res)
+
+    def test_migrate_eviction_index(self):
+        r = self.createStore()
+        r.r.set("hds/schema_version", 4)
+        r.r.zadd("hds/hosts", {"alice": 0})
+        r.r.hset("hds/host/alice/state", mapping={
+            "hds.host": "fakesig:100:1000:hostname",
+            "hds.name": "fakesig:100:2000:Alice",
+        })
+        r.migrate()
+        self.assertEqual(r.r.zrange(host_key(K_HOST_STATE_UPDATED, "alice"), 0, -1, withscores=True),
+                         [(b"hds.name", 2000)])
+
+    def test_store_tombstoned(self):
+        r = self.createStore()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        r.r.hset(host_key(K_HOST_STATE, "alice"), "hds.tombstone", "fakesig:100:0:yes")
+        with self.assertRaises(HDSFailure):
+            r.store_host_state("alice", "hds.name", "Alice", 100, "fakesig")
+        with self.assertRaises(HDSFailure):
+            r.store_host_topic("alice", "foo", [], "fakesig")
+        self.assertFalse(r.r.hexists(host_key(K_HOST_STATE, "alice"), "hds.name"))
+        self.assertEqual(r.get_topics(), [])
+
+    def test_store_scripts_cached(self):
+        r = self.createStore()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_topic("alice", "foo", ["bar"], "fakesig")
+        shas = [script.sha for script in r._scripts.values()]
+        self.assertEqual(len(shas), 2)
+        self.assertEqual(r.r.script_exists(*shas), [True, True])
+        self.assertEqual(r.r.lrange(topic_host_key(K_TOPIC_SUBTOPIC_HOSTS, "foo", "alice"), 0, -1), [b"bar"])
+        self.assertEqual(r.r.get(topic_host_key(K_TOPIC_HOST_SIG, "foo", "alice")), b"fakesig")
+
+    def test_state_record_encoding(self):
+        sig = base64.b64encode(b"\x00\x01signature" * 50).decode()
+        raw = encode_state_value(sig, 100, 1000, "hostname")
+        self.assertEqual(raw[0], 1)
+        # The signature is stored as raw bytes, rather than base64
+        self.assertLess(len(raw), len(HOST_STATE_FORMAT % (sig, 100, 1000, "hostname")))
+        self.assertEqual(parse_state_value(raw), {
+            "hds.signature": sig,
+            "hds.ttl": 100,
+            "hds.last_updated": 1000,
+            "value": "hostname"})
+        # Signatures which aren't valid base64 are kept as they are
+        self.assertEqual(parse_state_value(encode_state_value("fakesig", -1, 0, "a:b"))["value"],
+                         "a:b")
+        self.assertEqual(parse_state_value(b"fakesig:100:1000:a:b"), {
+            "hds.signature": "fakesig",
+            "hds.ttl": 100,
+            "hds.last_updated": 1000,
+            "value": "a:b"})
+
+    def test_migrate_state_records(self):
+        r = self.createStore()
+        r.r.set("hds/schema_version", 5)
+        r.r.zadd("hds/hosts", {"alice": 0})
+        r.r.hset("hds/host/alice/state", "hds.host", "c2ln:100:1000:hostname")
+        r.migrate()
+        self.assertEqual(r.r.hget(host_key(K_HOST_STATE, "alice"), "hds.host"),
+                         encode_state_value("c2ln", 100, 1000, "hostname"))
+        self.assertEqual(r.get_host_state("alice")["hds.host"]["hds.signature"], "c2ln")
+
+    def test_migrate_subtopic_index(self):
+        r = self.createStore()
+        r.r.set("hds/schema_version", 6)
+        r.r.sadd("hds/topics", "foo")
+        r.r.sadd("hds/topic/foo/hosts", "alice")
+        r.r.lpush("hds/topic/foo/hosts/alice/subtopics", "bar", "baz/qux")
+        r.migrate()
+        self.assertEqual(r.r.lrange(topic_host_key(K_TOPIC_SUBTOPIC_HOSTS, "foo", "alice"), 0, -1),
+                         [b"bar", b"baz/qux"])
+        self.assertEqual(r.r.zrange("hds/topic/foo/subtopics", 0, -1),
+                         [b"bar\0alice", b"baz/qux\0alice"])
+
+    def test_migrate_server_ids(self):
+        r = self.createStore()
+        r.r.set("hds/schema_version", 8)
+        r.r.zadd("hds/hosts", {"alice": 0})
+        r.r.hset("hds/host/alice/state", "hds.host", encode_state_value("sig", 100, 1000, "a"))
+        r.r.sadd("hds/host/alice/topics", "foo")
+        r.r.set("hds/topic/foo/host/alice/signature", "sig")
+        r.r.rpush("hds/topic/foo/hosts/alice/subtopics", "bar")
+        # Tombstoned and reaped, so only found by its state
+        r.r.hset("hds/host/bob/state", "hds.tombstone", encode_state_value("sig", 100, 0, "yes"))
+        self.assertEqual(r.migrate(), 10)
+        self.assertEqual(r.r.keys("hds/host/alice/*"), [])
+        self.assertEqual(r.r.hget(host_key(K_HOST_STATE, "alice"), "hds.host"),
+                         encode_state_value("sig", 100, 1000, "a"))
+        self.assertEqual(r.r.smembers(host_key(K_HOST_TOPICS, "alice")), {b"foo"})
+        self.assertEqual(r.r.get(topic_host_key(K_TOPIC_HOST_SIG, "foo", "alice")), b"sig")
+        self.assertEqual(
+            r.r.lrange(topic_host_key(K_TOPIC_SUBTOPIC_HOSTS, "foo", "alice"), 0, -1), [b"bar"])
+        self.assertTrue(r.is_host_tombstoned("bob", throw=False))
+        self.assertEqual(r.find_host(server_id("alice")), "alice")
+
+    def test_read_replicas(self):
+        r = RedisStore(replicas=["replica:6379"])
+        r.r = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+        r.replicas = [fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())]
+        # The replica has fallen behind, and still has an older value
+        lagging = RedisStore()
+        lagging.r = r.replicas[0]
+        lagging.store_host_state("alice", "hds.host", "old", 100, "fakesig")
+        r.store_host_state("alice", "hds.host", "new", 100, "fakesig")
+        r.store_host_state("bob", "hds.host", "new", 100, "fakesig")
+        # Recently written, so read from the primary
+        self.assertEqual(r.get_host_state("alice")["hds.host"]["value"], "new")
+        r._recent_writes.clear()
+        self.assertEqual(r.get_host_state("alice")["hds.host"]["value"], "old")
+        # Hosts missing from the replica are looked up on the primary
+        self.assertEqual(r.find_host("bo"), "bob")
+        r.read_your_writes = 0
+        r.store_host_state("alice", "hds.host", "newer", 100, "fakesig")
+        self.assertEqual(r.get_host_state("alice")["hds.host"]["value"], "old")
@@ -0,0 +1,199 @@
+import unittest
+import asyncio
+import fakeredis
+import fakeredis.aioredis
+from hds.store.sharded_redis_store import (ShardedRedisStore, AsyncShardedRedisStore, ShardRing)
+from hds.store.redis_store import K_HOST_STATE, STATE_STORAGE_LIMIT, host_key
+from hds.store.lrucache import LRUCache
+from hds.util import HDSFailure, server_id
+from .redis_store import interrupted
+
+SHARDS = ["redis-a:6379", "redis-b:6379", "redis-c:6379"]
+SERVERS = ["server%i" % i for i in range(30)]
+
+
+class ShardedRedisStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def createStore(self, shards=SHARDS):
+        r = ShardedRedisStore(shards)
+        for shard in shards:
+            r.shards[shard] = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+        return r
+
+    def test_ring_is_consistent(self):
+        ring = ShardRing(SHARDS)
+        before = {server: ring.get(server) for server in SERVERS}
+        self.assertEqual(set(before.values()), set(SHARDS))
+        ring.add("redis-d:6379")
+        after = {server: ring.get(server) for server in SERVERS}
+        # Servers only ever move to the new shard
+        for server in SERVERS:
+            self.assertIn(after[server], (before[server], "redis-d:6379"))
+
+    def test_set_and_get_state(self):
+        r = self.createStore()
+        for server in SERVERS:
+            r.store_host_state(server, "hds.host", "hostname", 100, "fakesig", 1000)
+        for server in SERVERS:
+            owner = r.shards[r.ring.get(server_id(server))]
+            self.assertTrue(owner.exists(host_key(K_HOST_STATE, server)))
+            self.assertEqual(r.get_host_state(server)["hds.host"]["value"], "hostname")
+        # The indexes are all on the coordinator
+        self.assertEqual(r.shards[SHARDS[0]].zcard("hds/hosts"), len(SERVERS))
+        self.assertEqual(r.find_host("server29"), "server29")
+        with self.assertRaises(HDSFailure):
+            r.find_host("server")
+        self.assertEqual(set(r.get_host_states(SERVERS[:5])), set(SERVERS[:5]))
+
+    def test_get_topic_hosts(self):
+        r = self.createStore()
+        for server in SERVERS:
+            r.store_host_state(server, "hds.host", "hostname", 100, "fakesig")
+            r.store_host_topic(server, "foo", ["bar"], "fakesig")
+        self.assertEqual(r.get_topics(), ["foo"])
+        hosts = r.get_topic_hosts("foo")
+        self.assertEqual(set(hosts), set(SERVERS))
+        self.assertEqual(hosts["server1"]["subtopics"], ["bar"])
+
+    def test_tombstoned(self):
+        r = self.createStore()
+        r.store_host_state("alice", "hds.tombstone", "yes", 100, "fakesig")
+        with self.assertRaises(HDSFailure):
+            r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        with self.assertRaises(HDSFailure):
+            r.store_host_topic("alice", "foo", [], "fakesig")
+        self.assertEqual(r.get_topics(), [])
+
+    def test_tombstone_invalidates_topics(self):
+        r = self.createStore()
+        r.cache = LRUCache()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_topic("alice", "foo", [], "fakesig")
+        self.assertEqual(list(r.get_topic_hosts("foo")), ["alice"])
+        r.store_host_state("alice", "hds.tombstone", "yes", 100, "fakesig")
+        self.assertEqual(r.get_topic_hosts("foo"), {})
+
+    def test_tombstoned_after_add_shard(self):
+        r = self.createStore()
+        for server in SERVERS:
+            r.store_host_state(server, "hds.host", "hostname", 100, "fakesig")
+            r.store_host_state(server, "hds.tombstone", "yes", 100, "fakesig")
+        r.add_shard("redis-d:6379", fakeredis.FakeStrictRedis(server=fakeredis.FakeServer()))
+        moved = [server for server in SERVERS if r.ring.get(server_id(server)) == "redis-d:6379"]
+        # The new shard has none of the host's keys yet
+        with self.assertRaises(HDSFailure):
+            r.store_host_state(moved[0], "hds.host", "hijacked", 100, "fakesig")
+        with self.assertRaises(HDSFailure):
+            r.store_host_topic(moved[0], "foo", [], "fakesig")
+        r.rebalance()
+        self.assertEqual(r.get_host_state(moved[0])["hds.host"]["value"], "hostname")
+        self.assertEqual(r.get_topics(), [])
+
+    def test_reap_expired_hosts(self):
+        r = self.createStore()
+        for server in SERVERS:
+            r.store_host_state(server, "hds.host", "hostname", 100, "fakesig", 1000)
+            r.store_host_topic(server, "foo", [], "fakesig")
+        self.assertEqual(set(r.reap_expired_hosts(grace=0)), set(SERVERS))
+        for shard in r.shards.values():
+            self.assertEqual(shard.keys("hds/host/*"), [])
+        self.assertEqual(r.get_topic_hosts("foo"), {})
+
+    def test_reap_refreshed_host(self):
+        r = self.createStore()
+        for server in SERVERS:
+            r.store_host_state(server, "hds.host", "hostname", 100, "fakesig", 1000)
+            r.store_host_topic(server, "foo", [], "fakesig")
+
+        def refresh():
+            r.store_host_state("server0", "hds.host", "hostname", 100, "fakesig")
+        reaped = r._run(interrupted(r._op_reap_expired_hosts(grace=0), refresh))
+        self.assertEqual(set(reaped), set(SERVERS[1:]))
+        self.assertEqual(r.find_host("server0"), "server0")
+        self.assertEqual(list(r.get_topic_hosts("foo")), ["server0"])
+
+    def test_rebalance(self):
+        r = self.createStore()
+        for server in SERVERS:
+            r.store_host_state(server, "hds.host", "hostname", 100, "fakesig")
+            r.store_host_state(server, "hds.name", server, 100, "fakesig", 1000)
+            r.store_host_topic(server, "foo", [], "fakesig")
+        r.add_shard("redis-d:6379", fakeredis.FakeStrictRedis(server=fakeredis.FakeServer()))
+        moved = [server for server in SERVERS if r.ring.get(server_id(server)) == "redis-d:6379"]
+        self.assertGreater(len(moved), 0)
+        # Written to the new shard before the rebalance, so it must win
+        r.store_host_state(moved[0], "hds.name", "newer", 100, "fakesig", 2000)
+        _, version = r.get_versioned_host_state(moved[0])
+        self.assertEqual(r.rebalance(), len(moved) * 4)
+        self.assertEqual(r.rebalance(), 0)
+        self.assertEqual(r.get_versioned_host_state(moved[0])[1], version)
+        for server in SERVERS:
+            state = r.get_host_state(server)
+            self.assertEqual(state["hds.host"]["value"], "hostname")
+            self.assertEqual(state["hds.name"]["value"],
+                             "newer" if server == moved[0] else server)
+        self.assertEqual(set(r.get_topic_hosts("foo")), set(SERVERS))
+
+    def test_rebalance_merges_state(self):
+        r = self.createStore()
+        ring = ShardRing(SHARDS + ["redis-d:6379"])
+        server = next(s for s in SERVERS if ring.get(server_id(s)) == "redis-d:6379")
+        for i in range(200):
+            r.store_host_state(server, "old%i" % i, "value", 100, "fakesig", 1000 + i)
+        r.store_host_state(server, "hds.name", "newer", 100, "fakesig", 5000)
+        r.add_shard("redis-d:6379", fakeredis.FakeStrictRedis(server=fakeredis.FakeServer()))
+        # Written to the new shard before the rebalance, but older than the moved copy
+        r.store_host_state(server, "hds.name", "older", 100, "fakesig", 4000)
+        for i in range(200):
+            r.store_host_state(server, "new%i" % i, "value", 100, "fakesig", 2000 + i)
+        r.rebalance()
+        state = r.get_host_state(server)
+        self.assertEqual(state["hds.name"]["value"], "newer")
+        # The least recently updated keys were evicted to get back to the limit
+        self.assertEqual(len(state) - 1, STATE_STORAGE_LIMIT)
+        self.assertNotIn("old145", state)
+        self.assertIn("old146", state)
+        self.assertIn("new0", state)
+
+    def test_migrate_legacy_keyspace(self):
+        r = self.createStore()
+        # Written by a single RedisStore, before schema version 2
+        coordinator = r.shards[SHARDS[0]]
+        coordinator.set("hds/schema_version", 1)
+        for server in SERVERS:
+            coordinator.sadd("hds/hosts", server)
+            coordinator.lpush("hds/host/%s/state" % server, "hds.host")
+            coordinator.set("hds/host/%s/state/hds.host" % server, "fakesig:100:1000:hostname")
+            coordinator.sadd("hds/topic/foo/hosts", server)
+        coordinator.sadd("hds/topics", "foo")
+        coordinator.set("hds/host/server0/state/hds.tombstone", "fakesig:100:1000:yes")
+        self.assertEqual(r.migrate(), 10)
+        self.assertGreater(r.rebalance(), 0)
+        for server in SERVERS:
+            owner = r.shards[r.ring.get(server_id(server))]
+            self.assertTrue(owner.exists(host_key(K_HOST_STATE, server)))
+            self.assertEqual(r.get_host_state(server)["hds.host"]["hds.last_updated"], 1000)
+        self.assertTrue(r.is_host_tombstoned("server0", throw=False))
+        self.assertFalse(r.is_host_tombstoned("server1", throw=False))
+        self.assertEqual(r.get_topics(), ["foo"])
+
+    def test_async_store(self):
+        async def go():
+            r = AsyncShardedRedisStore(SHARDS)
+            for shard in SHARDS:
+                r.shards[shard] = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer())
+            self.assertEqual(await r.migrate(), 10)
+            for server in SERVERS:
+                await r.store_host_state(server, "hds.host", "hostname", 100, "fakesig")
+                await r.store_host_topic(server, "foo", [], "fakesig")
+            self.assertEqual(set(await r.get_topic_hosts("foo")), set(SERVERS))
+            self.assertEqual(len(await r.get_host_states(SERVERS)), len(SERVERS))
+            self.assertEqual(await r.rebalance(), 0)
+            await r.close()
+        asyncio.run(go(), debug=True)
@@ -0,0 +1,85 @@
+import unittest
+from time import time
+from hds.store.store import Store, MONGOSTRING
+from hds.util import HDSFailure
+
+
+@unittest.skipIf(MONGOSTRING is None, "MONGOSTRING is not set")
+class StoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        self.store.client.drop_database(self.store.db)
+
+    def createStore(self):
+        # Each test has the database to itself, and drops it afterwards
+        self.store = Store()
+        return self.store
+
+    def test_find_topics(self):
+        r = self.createStore()
+        for topic in ["uk.half-shot.weather", "uk.half-shot.weather.rain", "uk.half-shot.wiki",
+                      "uk.half-shot-weather", "org.matrix"]:
+            r.store_host_topic("alice", topic, [], "fakesig")
+        self.assertEqual(r.find_topics("uk.half-shot.*"),
+                         ["uk.half-shot.weather", "uk.half-shot.wiki"])
+        self.assertEqual(r.find_topics("uk.half-shot.**"),
+                         ["uk.half-shot.weather", "uk.half-shot.weather.rain", "uk.half-shot.wiki"])
+        self.assertEqual(r.find_topics("org.matrix"), ["org.matrix"])
+        self.assertEqual(r.find_topics("org"), [])
+
+    def test_find_topics_order(self):
+        r = self.createStore()
+        # Escaped, "." and "$" would sort after every letter
+        topics = ["uk.$a", "uk.a", "uk.a.b", "uk.a-b", "uk.ab"]
+        for topic in topics:
+            r.store_host_topic("alice", topic, [], "fakesig")
+        self.assertEqual(r.find_topics("uk.**"), sorted(topics))
+        self.assertEqual(r.find_topics("uk.**", limit=2), ["uk.$a", "uk.a"])
+        self.assertEqual(r.find_topics("uk.**", limit=2, after="uk.a"), ["uk.a-b", "uk.a.b"])
+        self.assertEqual(r.find_topics("uk.**", after="uk.a.b"), ["uk.ab"])
+        self.assertEqual(r.find_topics("uk.**", after="uk.ab"), [])
+
+    def test_find_host(self):
+        r = self.createStore()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_state("alicebob", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_state("adam", "hds.host", "hostname", 100, "fakesig")
+        self.assertEqual(r.find_host("alice"), "alice")
+        self.assertEqual(r.find_host("aliceb"), "alicebob")
+        self.assertEqual(r.find_host("ad"), "adam")
+        with self.assertRaises(HDSFailure):
+            r.find_host("ali")
+        with self.assertRaises(HDSFailure):
+            r.find_host("bob")
+
+    def test_store_host_states(self):
+        r = self.createStore()
+        r.store_host_states([
+            ("alice", "hds.host", "hostname", 100, "fakesig", None),
+            ("alice", "hds.name", "Alice", 100, "fakesig", 1000),
+            ("bob", "hds.host", "bobhost", 100, "fakesig", None),
+        ])
+        # Both of alice's keys were folded into one document
+        self.assertEqual(r.db.get_collection("hosts").count_documents({}), 2)
+        state = r.get_host_state("ali")
+        self.assertEqual(state["hds.host"]["value"], "hostname")
+        self.assertEqual(state["hds.name"]["hds.last_updated"], 1000)
+        self.assertEqual(state["hds.expired"], ["hds.name"])
+        states = r.get_host_states(["alice", "bob", "carol"])
+        self.assertEqual(set(states), {"alice", "bob"})
+        self.assertEqual(states["bob"]["hds.host"]["value"], "bobhost")
+        self.assertEqual(states["alice"], state)
+
+    def test_has_host_expired(self):
+        r = self.createStore()
+        r.store_host_state("alice", "hds.host", "hostname", 100, "fakesig")
+        r.store_host_state("bob", "hds.host", "hostname", 100, "fakesig",
+                           time() * 1000 - 200000)
+        r.store_host_state("carol", "hds.name", "Carol", 100, "fakesig")
+        self.assertFalse(r.has_host_expired("alice"))
+        self.assertTrue(r.has_host_expired("bob"))
+        self.assertTrue(r.has_host_expired("carol"))
+        self.assertTrue(r.has_host_expired("dave"))
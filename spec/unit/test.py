@@ -2,7 +2,14 @@ import unittest
 import logging
 from sys import argv
 from .client import ClientTestCase
+from .crypto_pool import CryptoPoolTestCase
+from .directoryservice import DirectoryServiceTestCase
 from .store.redis_store import RedisStoreTestCase
+from .store.async_redis_store import AsyncRedisStoreTestCase
+from .store.lrucache import LRUCacheTestCase
+from .store.memory_store import MemoryStoreTestCase
+from .store.sharded_redis_store import ShardedRedisStoreTestCase
+from .store.store import StoreTestCase
 
 if "--verbose" in argv:
     logging.basicConfig(level=logging.DEBUG)